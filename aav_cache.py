@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+
+"""
+Content-addressed cache of summarize_AAV_alignment.py outputs (--cache_dir)
+
+An entry is keyed by the SHA-256 of everything the outputs depend on (input BAM content, annotation,
+thresholds, output options, tool and cache versions), so a changed input gives a different key and
+stale entries are never reused, only evicted.
+
+Layout: <cache_dir>/<key>/ holds the output files (named by their suffix after the output prefix)
+and entry.json, written last, listing them with their sizes. Entries are created in a temporary
+directory and renamed into place, so a partially written entry is never seen. The entry.json mtime
+is the last use time, the least recently used entries are evicted to keep the cache under its size limit.
+"""
+
+CACHE_VERSION = 1 # bump when the cached outputs change without a change of the key fields
+CACHE_SIZE = '20G'
+DIGEST_BUFFER_SIZE = 1 << 20
+
+
+def get_file_digest(filename):
+    """
+    :return: SHA-256 hex digest of the content of <filename>
+    """
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(DIGEST_BUFFER_SIZE)
+            if len(data) == 0: break
+            h.update(data)
+    return h.hexdigest()
+
+
+def get_cache_key(fields):
+    """
+    :param fields: JSON-serializable dict of everything the cached outputs depend on
+    :return: SHA-256 hex digest of <fields>
+    """
+    fields = dict(fields, cache_version=CACHE_VERSION)
+    return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+
+class ResultCache:
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def fetch(self, key, output_prefix):
+        """
+        Copy the outputs of entry <key>, if there is one, to <output_prefix><suffix>
+
+        :return: list of output files, None if <key> is not in the cache (or its entry is incomplete)
+        """
+        entry_dir = self.get_entry_dir(key)
+        entry_json = os.path.join(entry_dir, 'entry.json')
+        try:
+            with open(entry_json) as f:
+                entry = json.load(f)
+            os.utime(entry_json) # mark as recently used
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            outputs = []
+            for suffix, size in entry['files'].items():
+                if os.path.getsize(os.path.join(entry_dir, suffix)) != size:
+                    raise ValueError("{0} has changed".format(suffix))
+                shutil.copyfile(os.path.join(entry_dir, suffix), output_prefix + suffix)
+                outputs.append(output_prefix + suffix)
+        except (FileNotFoundError, ValueError, KeyError):
+            # evicted under us or damaged, a damaged entry is removed so that it can be stored again
+            self.remove(key)
+            return None
+        return outputs
+
+    def store(self, key, output_prefix, filenames):
+        """
+        Add <filenames> (each <output_prefix><suffix>) as entry <key>, then evict old entries if the cache is too large.
+        Entries larger than the whole cache are not stored.
+
+        :return: True if stored
+        """
+        suffixes = [f[len(output_prefix):] for f in filenames]
+        total = sum(os.path.getsize(f) for f in filenames)
+        if total > self.max_bytes or os.path.exists(self.get_entry_dir(key)):
+            return False
+        tmp_dir = os.path.join(self.cache_dir, '.tmp.{0}.{1}'.format(key, os.getpid()))
+        os.makedirs(tmp_dir)
+        for f, suffix in zip(filenames, suffixes):
+            shutil.copyfile(f, os.path.join(tmp_dir, suffix))
+        with open(os.path.join(tmp_dir, 'entry.json'), 'w') as f:
+            json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'output_prefix': os.path.abspath(output_prefix),
+                       'files': {suffix: os.path.getsize(os.path.join(tmp_dir, suffix)) for suffix in suffixes}}, f, indent=2)
+        try:
+            os.rename(tmp_dir, self.get_entry_dir(key))
+        except OSError: # stored by another run in the meantime
+            shutil.rmtree(tmp_dir)
+            return False
+        self.evict(keep=key)
+        return True
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries (other than <keep>) until the cache is within max_bytes
+        """
+        entries = []
+        total = 0
+        for key in os.listdir(self.cache_dir):
+            entry_json = os.path.join(self.cache_dir, key, 'entry.json')
+            if key.startswith('.') or not os.path.exists(entry_json):
+                continue
+            try:
+                last_used = os.path.getmtime(entry_json)
+                with open(entry_json) as f:
+                    size = sum(json.load(f)['files'].values())
+            except (FileNotFoundError, ValueError, KeyError):
+                continue
+            entries.append((last_used, key, size))
+            total += size
+        for last_used, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            if self.remove(key):
+                total -= size
+
+    def remove(self, key):
+        """
+        :return: True if entry <key> was removed by this call
+        """
+        # rename first, so that the entry disappears at once rather than file by file
+        trash = os.path.join(self.cache_dir, '.removed.{0}.{1}'.format(key, os.getpid()))
+        try:
+            os.rename(self.get_entry_dir(key), trash)
+        except OSError: # already removed
+            return False
+        shutil.rmtree(trash)
+        return True
@@ -0,0 +1,191 @@
+import sys
+import json
+import time
+
+"""
+Per-stage profiling for summarize_AAV_alignment.py and get_flipflop_config.py (--profile)
+
+Stages nest: the time of a stage excludes the time of the stages run inside it,
+so the stage times of a profile add up to (at most) its total time.
+CPU time is the process CPU time, which includes BGZF compression threads (--io_threads).
+"""
+
+PROGRESS_INTERVAL = 30 # seconds between progress lines
+
+
+class NullProfiler:
+    """
+    Profiler used when --profile is off: every call is a no-op
+    """
+    enabled = False
+
+    def stage(self, name, count=1):
+        return NULL_STAGE
+
+    def start(self, name):
+        pass
+
+    def stop(self, count=1):
+        pass
+
+    def iter(self, name, iterable):
+        return iterable
+
+    def wrap(self, writer, name):
+        return writer
+
+    def progress(self, count=1):
+        pass
+
+
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_STAGE = NullStage()
+
+
+class Stage:
+    def __init__(self, profiler, name, count):
+        self.profiler = profiler
+        self.name = name
+        self.count = count
+
+    def __enter__(self):
+        self.profiler.start(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.stop(self.count)
+        return False
+
+
+class ProfiledWriter:
+    """
+    Wraps a table (writerow) or BAM (write) writer, timing each row/record written as one stage item
+    """
+    def __init__(self, profiler, writer, name):
+        self.profiler = profiler
+        self.writer = writer
+        self.name = name
+
+    def write(self, r):
+        self.profiler.start(self.name)
+        self.writer.write(r)
+        self.profiler.stop()
+
+    def writerow(self, row):
+        self.profiler.start(self.name)
+        self.writer.writerow(row)
+        self.profiler.stop()
+
+    def close(self):
+        self.profiler.start(self.name)
+        result = self.writer.close()
+        self.profiler.stop(count=0)
+        return result
+
+    def __getattr__(self, attr):
+        return getattr(self.writer, attr)
+
+
+class StageProfiler:
+    """
+    Wall time, CPU time and item count per stage, plus periodic reads/sec progress lines (to stderr)
+    """
+    enabled = True
+
+    def __init__(self, name, progress_interval=PROGRESS_INTERVAL):
+        self.name = name
+        self.stages = {} # stage name --> [wall seconds, CPU seconds, item count]
+        self.stack = [] # running stages: [name, wall start, CPU start, wall in nested stages, CPU in nested stages]
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.reads = 0
+        self.progress_interval = progress_interval
+        self.last_progress = self.start_wall
+        self.last_progress_reads = 0
+
+    def stage(self, name, count=1):
+        return Stage(self, name, count)
+
+    def start(self, name):
+        self.stack.append([name, time.perf_counter(), time.process_time(), 0., 0.])
+
+    def stop(self, count=1):
+        name, wall_start, cpu_start, nested_wall, nested_cpu = self.stack.pop()
+        wall = time.perf_counter() - wall_start
+        cpu = time.process_time() - cpu_start
+        s = self.stages.setdefault(name, [0., 0., 0])
+        s[0] += wall - nested_wall
+        s[1] += cpu - nested_cpu
+        s[2] += count
+        if len(self.stack) > 0:
+            self.stack[-1][3] += wall
+            self.stack[-1][4] += cpu
+
+    def iter(self, name, iterable):
+        """
+        Yield from <iterable>, timing each item fetched as one item of stage <name>
+        """
+        it = iter(iterable)
+        while True:
+            self.start(name)
+            try:
+                x = next(it)
+            except StopIteration:
+                self.stop(count=0)
+                return
+            self.stop()
+            yield x
+
+    def wrap(self, writer, name):
+        return ProfiledWriter(self, writer, name)
+
+    def progress(self, count=1):
+        """
+        Count <count> more reads processed, print reads/sec every progress_interval seconds
+        """
+        self.reads += count
+        if self.reads - self.last_progress_reads < 1000: # only look at the clock every 1000 reads
+            return
+        now = time.perf_counter()
+        if now - self.last_progress >= self.progress_interval:
+            print("[{0}] {1} reads processed, {2:.0f} reads/sec (last {3:.0f} sec), {4:.0f} reads/sec overall".format(
+                self.name, self.reads, (self.reads - self.last_progress_reads) / (now - self.last_progress),
+                now - self.last_progress, self.reads / (now - self.start_wall)), file=sys.stderr)
+            self.last_progress = now
+            self.last_progress_reads = self.reads
+
+    def to_dict(self):
+        wall = time.perf_counter() - self.start_wall
+        return {'name': self.name,
+                'wall_sec': round(wall, 4),
+                'cpu_sec': round(time.process_time() - self.start_cpu, 4),
+                'reads': self.reads,
+                'reads_per_sec': round(self.reads / wall, 1) if wall > 0 else None,
+                'stages': {name: {'wall_sec': round(s[0], 4), 'cpu_sec': round(s[1], 4), 'count': s[2]}
+                           for name, s in self.stages.items()}}
+
+    def write(self, filename, workers=None, **extra):
+        """
+        Write the profile as JSON, with the profiles of <workers> (list of to_dict() outputs), if given,
+        and their stages summed up under 'worker_stages', and any <extra> key/values
+        """
+        d = self.to_dict()
+        d.update(extra)
+        if workers is not None:
+            d['workers'] = workers
+            total = {}
+            for w in workers:
+                for name, s in w['stages'].items():
+                    t = total.setdefault(name, {'wall_sec': 0., 'cpu_sec': 0., 'count': 0})
+                    for k in t:
+                        t[k] += s[k]
+            d['worker_stages'] = {name: {'wall_sec': round(t['wall_sec'], 4), 'cpu_sec': round(t['cpu_sec'], 4), 'count': t['count']}
+                                  for name, t in total.items()}
+        with open(filename, 'w') as f:
+            json.dump(d, f, indent=2)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+"""
+Benchmark: wall time of summarize_AAV_alignment.py as the number of BGZF threads (--io_threads) varies,
+at a fixed --cpus. Each setting is run in a fresh process on a fresh output directory.
+
+Usage: python benchmarks/bench_io_threads.py <input.bam> <annotation.txt> [--cpus N] [--io_threads 1,2,4,8] [--repeat N]
+"""
+import os, sys, time, shutil, tempfile, subprocess
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'summarize_AAV_alignment.py')
+
+
+def run(in_bam, annotation, cpus, io_threads):
+    """
+    :return: seconds taken by one summarize_AAV_alignment.py run
+    """
+    out_dir = tempfile.mkdtemp()
+    start = time.perf_counter()
+    subprocess.run([sys.executable, SCRIPT, in_bam, annotation, os.path.join(out_dir, 'bench'),
+                    '--cpus', str(cpus), '--io_threads', str(io_threads)],
+                   check=True, stdout=subprocess.DEVNULL)
+    elapsed = time.perf_counter() - start
+    shutil.rmtree(out_dir)
+    return elapsed
+
+
+def main(in_bam, annotation, cpus, io_threads_list, repeat):
+    print(f"--cpus {cpus}, {repeat} repeat(s), best is reported")
+    baseline = None
+    for io_threads in io_threads_list:
+        best = min(run(in_bam, annotation, cpus, io_threads) for _ in range(repeat))
+        if baseline is None:
+            baseline = best
+        print(f"--io_threads {io_threads:>3}: {best:8.2f} sec  ({baseline/best:.2f}x)")
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("bam_filename", help="Input BAM file, sorted by read name")
+    parser.add_argument("annotation_txt", help="Annotation file")
+    parser.add_argument("--cpus", type=int, default=1, help="--cpus passed to summarize_AAV_alignment.py (default: 1)")
+    parser.add_argument("--io_threads", default="1,2,4,8", help="Comma-separated --io_threads values to compare, the first is the baseline (default: 1,2,4,8)")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of repeats, best is reported (default: 3)")
+
+    args = parser.parse_args()
+    main(args.bam_filename, args.annotation_txt, args.cpus, [int(x) for x in args.io_threads.split(',')], args.repeat)
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: per-record throughput of adding the AT/AY/AX tags to BAM records,
+ - before: to_dict() / append tag strings / AlignedSegment.from_dict()
+ - after: in-place set_tag() (summarize_AAV_alignment.add_assigned_types_to_record)
+
+Usage: python benchmarks/bench_tagging.py <input.bam> [--repeat N]
+"""
+import os, sys, time, tempfile
+import pysam
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from summarize_AAV_alignment import add_assigned_types_to_record
+
+
+def tag_via_dict(r, a_type, a_subtype):
+    d = r.to_dict()
+    d['tags'].append('AT:Z:'+a_type)
+    d['tags'].append('AY:Z:'+a_subtype)
+    d['tags'].append('AX:Z:'+a_type+'-'+a_subtype)
+    return pysam.AlignedSegment.from_dict(d, r.header)
+
+
+def run(records, header, tag_func, out_bam=None):
+    """
+    :return: seconds taken to tag (and write to <out_bam>, if given) all records
+    """
+    writer = pysam.AlignmentFile(out_bam, 'wb', header=header) if out_bam is not None else None
+    start = time.perf_counter()
+    for r in records:
+        r = tag_func(r, 'vector', 'full')
+        if writer is not None:
+            writer.write(r)
+    elapsed = time.perf_counter() - start
+    if writer is not None:
+        writer.close()
+    return elapsed
+
+
+def main(in_bam, repeat):
+    reader = pysam.AlignmentFile(in_bam, 'rb', check_sq=False)
+    header = reader.header
+    records = [r.to_string() for r in reader]
+    reader.close()
+    print(f"{len(records)} records, {repeat} repeat(s), best is reported")
+
+    out_bam = tempfile.NamedTemporaryFile(suffix='.bam', delete=False).name
+    for name, func in (('to_dict/from_dict', tag_via_dict), ('set_tag (in place)', add_assigned_types_to_record)):
+        for label, out in (('tag only', None), ('tag + write BAM', out_bam)):
+            # fresh records for every run, so that every run starts from untagged records
+            best = min(run([pysam.AlignedSegment.fromstring(x, header) for x in records], header, func, out)
+                       for _ in range(repeat))
+            print(f"{name:>20} {label:>16}: {len(records)/best:12.0f} records/sec")
+    os.remove(out_bam)
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("bam_filename", help="Input BAM file (ex: output of summarize_AAV_alignment.py)")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of repeats, best is reported (default: 3)")
+
+    args = parser.parse_args()
+    main(args.bam_filename, args.repeat)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Regression check + benchmark for get_flipflop_config.identify_flip_flop:
+compares its flip/flop calls against the original implementation (parasail.sw_trace of the left ITRs
+against the whole read, of the right ITRs against the last len(ITR)+10 bases) on every vector
+full/left-partial/right-partial record of a tagged BAM, and reports the time taken by each.
+
+Usage: python benchmarks/check_flipflop_calls.py <tagged.bam> [--flipflop_fasta FASTA] [--left_window_pad N] [--right_window_pad N]
+"""
+import os, sys, time
+import parasail
+import pysam
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import get_flipflop_config as ff
+
+
+def call(s1, s2):
+    if s1 > s2 and s1 > 250:
+        return 'flip'
+    elif s2 > s1 and s2 > 250:
+        return 'flop'
+    return 'unknown'
+
+
+def identify_flip_flop_original(r):
+    t = dict(r.tags)
+    if t['AX'] == 'vector-partial':
+        return 'unknown', 'unknown'
+    config_left, config_right = 'unknown', 'unknown'
+    if t['AX'] in ('vector-full', 'vector-left-partial'):
+        o1 = parasail.sw_trace(r.query, ff.SEQ_LEFT_FLIP, 3, 1, ff.SW_SCORE_MATRIX)
+        o2 = parasail.sw_trace(r.query, ff.SEQ_LEFT_FLOP, 3, 1, ff.SW_SCORE_MATRIX)
+        config_left = call(o1.score, o2.score)
+    if t['AX'] in ('vector-full', 'vector-right-partial'):
+        o1 = parasail.sw_trace(r.query[-len(ff.SEQ_RIGHT_FLIP)-10:], ff.SEQ_RIGHT_FLIP, 3, 1, ff.SW_SCORE_MATRIX)
+        o2 = parasail.sw_trace(r.query[-len(ff.SEQ_RIGHT_FLOP)-10:], ff.SEQ_RIGHT_FLOP, 3, 1, ff.SW_SCORE_MATRIX)
+        config_right = call(o1.score, o2.score)
+    return config_left, config_right
+
+
+def main(tagged_bam):
+    records = []
+    for r in pysam.AlignmentFile(tagged_bam, 'rb', check_sq=False):
+        t = dict(r.tags)
+        if t.get('AT') == 'vector' and t.get('AX') in ('vector-full', 'vector-left-partial', 'vector-right-partial'):
+            records.append(r)
+
+    start = time.perf_counter()
+    expected = [identify_flip_flop_original(r) for r in records]
+    t_original = time.perf_counter() - start
+    start = time.perf_counter()
+    got = [ff.identify_flip_flop(r) for r in records]
+    t_new = time.perf_counter() - start
+
+    num_diff = 0
+    for r, a, b in zip(records, expected, got):
+        if a != b:
+            num_diff += 1
+            print(f"MISMATCH {r.qname}: original {a[0]}-{a[1]}, now {b[0]}-{b[1]}")
+    print(f"{len(records)} records, {num_diff} mismatches")
+    print("read-end calls now made: {0}".format(', '.join(f"{v} by {k}" for k, v in ff.ITR_CALL_COUNTS.items())))
+    print(f"original: {t_original:8.2f} sec")
+    print(f"     now: {t_new:8.2f} sec  ({t_original/t_new:.1f}x)")
+    return num_diff
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("tagged_bam", help="Tagged BAM file from summarize_AAV_alignment.py")
+    parser.add_argument("--flipflop_fasta", default=None, help="(optional) flip flop fasta file (if not given, uses AAV2 default)")
+    parser.add_argument("--left_window_pad", type=int, default=ff.ITR_LEFT_WINDOW_PAD)
+    parser.add_argument("--right_window_pad", type=int, default=ff.ITR_RIGHT_WINDOW_PAD)
+    parser.add_argument("--no_kmer_prescreen", action="store_true", default=False)
+    parser.add_argument("--cache_size", type=int, default=ff.ITR_CACHE_SIZE)
+
+    args = parser.parse_args()
+    if args.flipflop_fasta is not None:
+        ff.read_flip_flop_fasta(args.flipflop_fasta)
+    ff.ITR_LEFT_WINDOW_PAD = args.left_window_pad
+    ff.ITR_RIGHT_WINDOW_PAD = args.right_window_pad
+    ff.KMER_PRESCREEN = not args.no_kmer_prescreen
+    ff.ITR_CALL_CACHE = ff.ITRCallCache(args.cache_size)
+    sys.exit(1 if main(args.tagged_bam) > 0 else 0)
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""
+Synthetic AAV CCS reads for benchmarks: writes a read name-sorted BAM of reads aligned to a vector
+(backbone-ITR-transgene-ITR-backbone), rep/cap, helper and host references, with the matching
+annotation file and reference FASTA.
+
+Usage: python benchmarks/generate_synthetic.py <output_prefix> [--num_reads N] [--error_rate F] [--mix scAAV=0.3,...]
+Output: <output_prefix>.bam, <output_prefix>.annotation.txt, <output_prefix>.fasta
+"""
+import os, sys, random
+import pysam
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from get_flipflop_config import SEQ_LEFT_FLIP, SEQ_RIGHT_FLIP
+
+# read categories and their default fraction of the reads
+DEFAULT_MIX = {'ssAAV': 0.25,           # ITR to ITR, primary only
+               'ssAAV-partial': 0.10,   # primary only, starting or ending inside the transgene
+               'scAAV': 0.20,           # primary + reverse strand supplementary of the same region
+               'scAAV-partial': 0.10,
+               'backbone': 0.07,
+               'vector+backbone': 0.06,
+               'host': 0.08,
+               'repcap': 0.04,
+               'helper': 0.03,
+               'chimeric': 0.04,        # vector primary + host supplementary
+               'unmapped': 0.03}
+
+BACKBONE_LEFT_LEN = 1000
+EDGE_JITTER = 30 # full reads start/end within this many bp of the ITR ends
+
+
+def parse_mix(mix):
+    """
+    :param mix: comma-separated category=fraction, ex: scAAV=0.5,ssAAV=0.5 (fractions are normalized)
+    :return: dict of category --> fraction
+    """
+    d = {}
+    for x in mix.split(','):
+        name, frac = x.split('=')
+        if name not in DEFAULT_MIX:
+            raise Exception("Unknown read category {0}, must be one of {1}. Abort!".format(name, ','.join(DEFAULT_MIX)))
+        d[name] = float(frac)
+    return d
+
+
+def get_alignment_score(cigar):
+    """
+    :return: minimap2-like (map-hifi) alignment score of <cigar>: +1 per match, -4 per mismatch, -(6+2*len) per gap up to 100bp
+    """
+    score = 0
+    for op, n in cigar:
+        if op == 7: score += n
+        elif op == 8: score -= 4 * n
+        elif op in (1, 2): score -= 6 + 2 * n
+        elif op == 3: score -= 6 + 2 * min(n, 100)
+    return score
+
+
+class SyntheticGenerator:
+    def __init__(self, transgene_len=3000, backbone_len=2000, host_len=20000, error_rate=0.01, gap_rate=0.00005, seed=1):
+        self.rnd = random.Random(seed)
+        self.error_rate = error_rate
+        self.gap_rate = gap_rate
+        self.vector_start = BACKBONE_LEFT_LEN
+        self.vector_end = BACKBONE_LEFT_LEN + len(SEQ_LEFT_FLIP) + transgene_len + len(SEQ_RIGHT_FLIP)
+        self.refs = {'myVector': self.random_seq(BACKBONE_LEFT_LEN) + SEQ_LEFT_FLIP + self.random_seq(transgene_len) +
+                                 SEQ_RIGHT_FLIP + self.random_seq(backbone_len),
+                     'chrH': self.random_seq(host_len),
+                     'myRepCap': self.random_seq(6000),
+                     'myHelper': self.random_seq(5000)}
+        self.names = list(self.refs)
+        self.header = pysam.AlignmentHeader.from_dict({'HD': {'VN': '1.6', 'SO': 'queryname'},
+                                                       'SQ': [{'SN': k, 'LN': len(v)} for k, v in self.refs.items()]})
+
+    def random_seq(self, n):
+        return ''.join(self.rnd.choice('ACGT') for _ in range(n))
+
+    def write_references(self, annotation_filename, fasta_filename):
+        with open(annotation_filename, 'w') as f:
+            f.write("NAME=chrH;TYPE=host;\n")
+            f.write("NAME=myVector;TYPE=vector;REGION={0}-{1};\n".format(self.vector_start, self.vector_end))
+            f.write("NAME=myRepCap;TYPE=repcap;REGION=500-5000;\n")
+            f.write("NAME=myHelper;TYPE=helper;\n")
+        with open(fasta_filename, 'w') as f:
+            for k, v in self.refs.items():
+                f.write(">{0}\n{1}\n".format(k, v))
+
+    def mutate(self, refseq, gaps):
+        """
+        :return: read sequence, cigar tuples (=/X/I/D, and N if <gaps>) of <refseq> with random errors
+        """
+        rnd = self.rnd
+        rate = self.error_rate + (self.gap_rate if gaps else 0)
+        q, cigar = [], []
+        def push(op, n):
+            if len(cigar) > 0 and cigar[-1][0] == op: cigar[-1][1] += n
+            else: cigar.append([op, n])
+        i = 0
+        while i < len(refseq):
+            step = int(rnd.expovariate(rate)) if rate > 0 else len(refseq)
+            if i + step >= len(refseq):
+                q.append(refseq[i:]); push(7, len(refseq) - i)
+                break
+            if step > 0:
+                q.append(refseq[i:i+step]); push(7, step); i += step
+            x = rnd.random() * rate
+            if x < self.error_rate / 3:
+                q.append(rnd.choice([c for c in 'ACGT' if c != refseq[i]])); push(8, 1); i += 1
+            elif x < self.error_rate * 2 / 3:
+                n = rnd.randint(1, 3); q.append(self.random_seq(n)); push(1, n)
+            elif x < self.error_rate:
+                n = min(rnd.randint(1, 3), len(refseq) - i - 1)
+                if n > 0: push(2, n); i += n
+            elif i + 400 < len(refseq):
+                n = rnd.randint(150, 400); push(3, n); i += n
+        # alignments start and end with a match
+        while cigar[-1][0] in (1, 2, 3):
+            op, n = cigar.pop()
+            if op == 1: del q[-1]
+        return ''.join(q), [tuple(c) for c in cigar]
+
+    def make_record(self, qname, ref, start, end, flag, clip5='', clip3='', hard=False, gaps=False):
+        refseq = self.refs[ref][start:end]
+        seq, cigar = self.mutate(refseq, gaps)
+        if cigar[0][0] != 7:
+            start -= 1
+            seq = self.refs[ref][start] + seq
+            cigar.insert(0, (7, 1))
+        clip_op = 5 if hard else 4
+        if len(clip5) > 0: cigar.insert(0, (clip_op, len(clip5)))
+        if len(clip3) > 0: cigar.append((clip_op, len(clip3)))
+        r = pysam.AlignedSegment(self.header)
+        r.query_name = qname
+        r.query_sequence = seq if hard else clip5 + seq + clip3
+        r.flag = flag
+        r.reference_id = self.names.index(ref)
+        r.reference_start = start
+        r.mapping_quality = 60
+        r.cigartuples = cigar
+        r.query_qualities = pysam.qualitystring_to_array('I' * len(r.query_sequence))
+        # NM and alignment score tags as written by minimap2
+        r.set_tag('NM', sum(n for op, n in cigar if op in (1, 2, 8)), 'i')
+        r.set_tag('AS', get_alignment_score(cigar), 'i')
+        r.set_tag('tp', 'S' if flag & 2048 else 'P', 'A')
+        return r
+
+    def make_unmapped(self, qname, length=3000):
+        r = pysam.AlignedSegment(self.header)
+        r.query_name = qname
+        r.flag = 4
+        r.query_sequence = self.random_seq(length)
+        r.query_qualities = pysam.qualitystring_to_array('I' * length)
+        return r
+
+    def full_ends(self):
+        return (self.vector_start + self.rnd.randint(-EDGE_JITTER, EDGE_JITTER),
+                self.vector_end + self.rnd.randint(-EDGE_JITTER, EDGE_JITTER))
+
+    def partial_ends(self):
+        s, e = self.full_ends()
+        inner = (self.vector_end - self.vector_start) // 3
+        if self.rnd.random() < 0.5:
+            s = self.vector_start + self.rnd.randint(200, inner)
+        else:
+            e = self.vector_end - self.rnd.randint(200, inner)
+        return s, e
+
+    def make_read(self, qname, category):
+        """
+        :return: list of alignment records of one read of <category> (see DEFAULT_MIX)
+        """
+        rnd = self.rnd
+        strand = 16 if rnd.random() < 0.5 else 0
+        if category in ('ssAAV', 'ssAAV-partial'):
+            s, e = self.full_ends() if category == 'ssAAV' else self.partial_ends()
+            return [self.make_record(qname, 'myVector', s, e, strand, gaps=True)]
+        elif category in ('scAAV', 'scAAV-partial'):
+            s, e = self.full_ends() if category == 'scAAV' else self.partial_ends()
+            other_half = 'A' * (e - s)
+            records = [self.make_record(qname, 'myVector', s, e, strand, clip3=other_half),
+                       self.make_record(qname, 'myVector', s, e, (16 - strand) | 2048, clip3=other_half, hard=True)]
+            rnd.shuffle(records)
+            return records
+        elif category == 'backbone':
+            s = rnd.randint(self.vector_end + 200, len(self.refs['myVector']) - 1500)
+            return [self.make_record(qname, 'myVector', s, s + 1200, strand)]
+        elif category == 'vector+backbone':
+            s = self.vector_start + rnd.randint(-20, 20)
+            return [self.make_record(qname, 'myVector', s, min(self.vector_end + 800, len(self.refs['myVector']) - 1), strand)]
+        elif category == 'host':
+            s = rnd.randint(1, len(self.refs['chrH']) - 5000)
+            return [self.make_record(qname, 'chrH', s, s + rnd.randint(500, 4000), strand)]
+        elif category == 'repcap':
+            s = rnd.randint(600, 1000)
+            return [self.make_record(qname, 'myRepCap', s, s + 3000, strand)]
+        elif category == 'helper':
+            s = rnd.randint(1, 3000)
+            return [self.make_record(qname, 'myHelper', s, s + 1500, strand)]
+        elif category == 'chimeric':
+            s, e = self.full_ends()
+            h = rnd.randint(1, len(self.refs['chrH']) - 2000)
+            return [self.make_record(qname, 'myVector', s, e, 0, clip3='C' * 1000),
+                    self.make_record(qname, 'chrH', h, h + 1000, 2048, clip5='A' * (e - s), hard=True)]
+        else:
+            return [self.make_unmapped(qname)]
+
+    def write_bam(self, bam_filename, num_reads, mix):
+        categories = list(mix)
+        weights = [mix[c] for c in categories]
+        reads = []
+        for i in range(num_reads):
+            qname = "m64011_000000_000000/{0}/ccs{1}".format(i, self.rnd.choice(['', '/fwd', '/rev']))
+            reads.append(self.make_read(qname, self.rnd.choices(categories, weights)[0]))
+        reads.sort(key=lambda records: records[0].query_name)
+        with pysam.AlignmentFile(bam_filename, 'wb', header=self.header) as writer:
+            for records in reads:
+                for r in records:
+                    writer.write(r)
+
+
+def generate(output_prefix, num_reads=10000, mix=None, transgene_len=3000, backbone_len=2000, host_len=20000,
+             error_rate=0.01, gap_rate=0.00005, seed=1):
+    """
+    :return: BAM filename, annotation filename, FASTA filename
+    """
+    g = SyntheticGenerator(transgene_len, backbone_len, host_len, error_rate, gap_rate, seed)
+    g.write_references(output_prefix + '.annotation.txt', output_prefix + '.fasta')
+    g.write_bam(output_prefix + '.bam', num_reads, DEFAULT_MIX if mix is None else mix)
+    return output_prefix + '.bam', output_prefix + '.annotation.txt', output_prefix + '.fasta'
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("output_prefix", help="Output prefix")
+    parser.add_argument("-n", "--num_reads", type=int, default=10000, help="Number of reads (default: 10000)")
+    parser.add_argument("--mix", default=None, help="Comma-separated category=fraction of the reads (default: {0})".format(
+        ','.join('{0}={1}'.format(k, v) for k, v in DEFAULT_MIX.items())))
+    parser.add_argument("--transgene_len", type=int, default=3000, help="Length between the two ITRs (default: 3000)")
+    parser.add_argument("--backbone_len", type=int, default=2000, help="Length of the vector backbone after the right ITR (default: 2000)")
+    parser.add_argument("--host_len", type=int, default=20000, help="Length of the host reference (default: 20000)")
+    parser.add_argument("--error_rate", type=float, default=0.01, help="Per-base error rate, split evenly between mismatches, insertions and deletions (default: 0.01)")
+    parser.add_argument("--gap_rate", type=float, default=0.00005, help="Per-base rate of 150-400bp skips (N) in ssAAV reads (default: 0.00005)")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed (default: 1)")
+
+    args = parser.parse_args()
+    files = generate(args.output_prefix, args.num_reads, None if args.mix is None else parse_mix(args.mix),
+                     args.transgene_len, args.backbone_len, args.host_len, args.error_rate, args.gap_rate, args.seed)
+    print("Written: {0}".format(', '.join(files)))
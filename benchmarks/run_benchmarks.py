@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite: times the main steps of summarize_AAV_alignment.py and get_flipflop_config.py on a synthetic
+data set (see generate_synthetic.py) or on a given read name-sorted BAM + annotation, and reports
+reads/sec and peak RSS of each as JSON, for comparing runs.
+
+Each benchmark runs in its own process, so peak RSS is per benchmark. Loading the input records into
+memory (for the per-function benchmarks) is not timed but is included in peak RSS.
+
+Usage: python benchmarks/run_benchmarks.py [--num_reads N] [--bam in.bam --annotation annot.txt] [--cpus 1,2,4] [-o results.json]
+"""
+import os, sys, time, json, shutil, platform, resource, tempfile
+from multiprocessing import Process, Pipe
+import pysam
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH_DIR, '..'))
+import summarize_AAV_alignment as sa
+import get_flipflop_config as ff
+from generate_synthetic import generate
+
+
+def load_reads(bam_filename):
+    """
+    :return: list of reads, each a list of its alignment records (same grouping as process_alignment_bam)
+    """
+    reads = []
+    for r in pysam.AlignmentFile(bam_filename, check_sq=False):
+        if len(reads) > 0 and reads[-1][-1].qname == r.qname:
+            reads[-1].append(r)
+        else:
+            reads.append([r])
+    return reads
+
+
+def bench_iter_cigar_w_aligned_pair(bam_filename, annotation_filename, work_dir):
+    records = [r for rs in load_reads(bam_filename) for r in rs if not r.is_unmapped]
+    start = time.perf_counter()
+    for r in records:
+        sa.iter_cigar_w_aligned_pair(r, None)
+    return time.perf_counter() - start
+
+
+def bench_is_on_target(bam_filename, annotation_filename, work_dir):
+    d = sa.read_annotation_file(annotation_filename)
+    records = [r for rs in load_reads(bam_filename) for r in rs
+               if not r.is_unmapped and r.reference_name in d and d[r.reference_name]['region'] is not None]
+    start = time.perf_counter()
+    for r in records:
+        sa.is_on_target(r, *d[r.reference_name]['region'])
+    return time.perf_counter() - start
+
+
+def bench_assign_read_types(bam_filename, annotation_filename, work_dir):
+    d = sa.read_annotation_file(annotation_filename)
+    records = [r for rs in load_reads(bam_filename) for r in rs]
+    regions = sa.AnnotationRegions(d, records[0].header.references)
+    start = time.perf_counter()
+    for i in range(0, len(records), sa.CLASSIFY_BLOCK_SIZE):
+        sa.assign_read_types(records[i:i+sa.CLASSIFY_BLOCK_SIZE], regions)
+    return time.perf_counter() - start
+
+
+def bench_process_alignment_records_for_a_read(bam_filename, annotation_filename, work_dir):
+    d = sa.read_annotation_file(annotation_filename)
+    reads = load_reads(bam_filename)
+    o = os.path.join(work_dir, 'bench')
+    writer1 = sa.open_table_writer(o + '.summary', sa.SUMMARY_FIELDS)
+    writer2 = sa.open_table_writer(o + '.nonmatch_stat', sa.NONMATCH_FIELDS)
+    writer3 = sa.open_table_writer(o + '.per_read', sa.PER_READ_FIELDS)
+    bam_writer = pysam.AlignmentFile(o + '.tagged.bam', 'wb', header=reads[0][0].header)
+    start = time.perf_counter()
+    for records in reads:
+        sa.process_alignment_records_for_a_read(records, d, writer1, writer2, writer3, bam_writer)
+    elapsed = time.perf_counter() - start
+    for w in (writer1, writer2, writer3, bam_writer):
+        w.close()
+    return elapsed
+
+
+def bench_run_processing_parallel(bam_filename, annotation_filename, cpus, work_dir):
+    d = sa.read_annotation_file(annotation_filename)
+    start = time.perf_counter()
+    sa.run_processing_parallel(bam_filename, d, os.path.join(work_dir, 'bench'), num_chunks=cpus, split_categories=True)
+    return time.perf_counter() - start
+
+
+def bench_subset_sam_by_readname_list(bam_filename, annotation_filename, work_dir):
+    tagged_bam, per_read_csv = prepare_tagged_bam(bam_filename, annotation_filename, work_dir)
+    start = time.perf_counter()
+    sa.subset_sam_by_readname_list(tagged_bam, os.path.join(work_dir, 'bench.scAAV.bam'), per_read_csv, ['scAAV'], None)
+    return time.perf_counter() - start
+
+
+def bench_identify_flip_flop(bam_filename, annotation_filename, work_dir):
+    tagged_bam, per_read_csv = prepare_tagged_bam(bam_filename, annotation_filename, work_dir)
+    records = [r for r in pysam.AlignmentFile(tagged_bam, check_sq=False)
+               if r.get_tag('AT') == 'vector' and r.get_tag('AX') in ff.FLIPFLOP_SUBTYPES]
+    start = time.perf_counter()
+    for r in records:
+        ff.identify_flip_flop(r)
+    return time.perf_counter() - start
+
+
+def prepare_tagged_bam(bam_filename, annotation_filename, work_dir):
+    """
+    :return: tagged BAM, per_read table of <bam_filename> (not timed)
+    """
+    d = sa.read_annotation_file(annotation_filename)
+    return sa.process_alignment_bam(bam_filename, d, os.path.join(work_dir, 'prep'))[::-1]
+
+
+def run_in_child(conn, func, args):
+    work_dir = tempfile.mkdtemp()
+    try:
+        sys.stdout = open(os.devnull, 'w') # the benchmarked functions print progress
+        elapsed = func(*args, work_dir)
+        self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        conn.send((elapsed, self_rss, children_rss))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+def run_benchmark(name, func, args, num_reads, **params):
+    conn_recv, conn_send = Pipe(duplex=False)
+    p = Process(target=run_in_child, args=(conn_send, func, args))
+    p.start()
+    p.join()
+    if p.exitcode != 0:
+        raise Exception("Benchmark {0} failed with exit code {1}. Abort!".format(name, p.exitcode))
+    elapsed, self_rss, children_rss = conn_recv.recv()
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    result = dict(name=name, **params)
+    result.update({'reads': num_reads,
+                   'seconds': round(elapsed, 4),
+                   'reads_per_sec': round(num_reads / elapsed, 1),
+                   'peak_rss_mb': round(self_rss * unit / 2**20, 1),
+                   'peak_child_rss_mb': round(children_rss * unit / 2**20, 1)})
+    print(json.dumps(result), file=sys.stderr)
+    return result
+
+
+def main(bam_filename, annotation_filename, cpus_list, data_info):
+    num_reads = len(set(r.qname for r in pysam.AlignmentFile(bam_filename, check_sq=False)))
+    args = (bam_filename, annotation_filename)
+    results = []
+    for name, func in (('iter_cigar_w_aligned_pair', bench_iter_cigar_w_aligned_pair),
+                       ('is_on_target', bench_is_on_target),
+                       ('assign_read_types', bench_assign_read_types),
+                       ('process_alignment_records_for_a_read', bench_process_alignment_records_for_a_read),
+                       ('subset_sam_by_readname_list', bench_subset_sam_by_readname_list),
+                       ('identify_flip_flop', bench_identify_flip_flop)):
+        results.append(run_benchmark(name, func, args, num_reads))
+    for cpus in cpus_list:
+        results.append(run_benchmark('run_processing_parallel', bench_run_processing_parallel, args + (cpus,), num_reads, cpus=cpus))
+    return {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'pysam': pysam.__version__,
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'input': data_info,
+            'results': results}
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("--bam", default=None, help="Read name-sorted BAM to benchmark on (default: generate synthetic data)")
+    parser.add_argument("--annotation", default=None, help="Annotation file of --bam")
+    parser.add_argument("-n", "--num_reads", type=int, default=10000, help="Number of synthetic reads (default: 10000)")
+    parser.add_argument("--error_rate", type=float, default=0.01, help="Synthetic read error rate (default: 0.01)")
+    parser.add_argument("--seed", type=int, default=1, help="Synthetic data random seed (default: 1)")
+    parser.add_argument("--cpus", default="1,2,4", help="Comma-separated --cpus values for run_processing_parallel (default: 1,2,4)")
+    parser.add_argument("-o", "--output", default=None, help="Write the JSON results to this file (default: stdout)")
+
+    args = parser.parse_args()
+    data_dir = None
+    if args.bam is None:
+        data_dir = tempfile.mkdtemp()
+        bam_filename, annotation_filename, _ = generate(os.path.join(data_dir, 'synthetic'), args.num_reads,
+                                                        error_rate=args.error_rate, seed=args.seed)
+        data_info = {'synthetic': True, 'num_reads': args.num_reads, 'error_rate': args.error_rate, 'seed': args.seed}
+    else:
+        if args.annotation is None:
+            raise Exception("--annotation must be given with --bam. Abort!")
+        bam_filename, annotation_filename = args.bam, args.annotation
+        data_info = {'synthetic': False, 'bam': os.path.abspath(args.bam)}
+
+    report = main(bam_filename, annotation_filename, [int(x) for x in args.cpus.split(',')], data_info)
+    if data_dir is not None:
+        shutil.rmtree(data_dir)
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
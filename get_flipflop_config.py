@@ -1,8 +1,12 @@
 import parasail
 import sys
+import copy
 import pysam
-from csv import DictReader
+from collections import deque, OrderedDict
+from multiprocessing import Pool
 from Bio import SeqIO
+from summarize_AAV_alignment import iter_table_rows, iter_sampled_records, split_io_threads, IO_THREADS
+from aav_profiling import NullProfiler, StageProfiler
 
 """
 Get ITR flip flop configurations
@@ -12,12 +16,147 @@ Required:
 """
 
 SW_SCORE_MATRIX = parasail.matrix_create("ACGT", 2, -5)
+SW_MATCH, SW_MISMATCH, SW_GAP_OPEN, SW_GAP_EXTEND = 2, -5, 3, 1 # scores of SW_SCORE_MATRIX and the gap penalties
+ITR_MIN_SCORE = 250 # a read end is called flip (flop) only if its flip (flop) ITR score is above this
 
 SEQ_LEFT_FLIP='ttggccactccctctctgcgcgctcgctcgctcactgaggccgggcgaccaaaggtcgcccgacgcccgggctttgcccgggcggcctcagtgagcgagcgagcgcgcagagagggagtggccaactccatcactaggggttcct'.upper()
 SEQ_LEFT_FLOP='TTGGCCACTCCCTCTCTGCGCGCTCGCTCGCTCACTGAGGCCGCCCGGGCAAAGCCCGGGCGTCGGGCGACCTTTGGTCGCCCGGCCTCAGTGAGCGAGCGAGCGCGCAGAGAGGGAGTGGCCAACTCCATCACTAGGGGTTCCT'
 SEQ_RIGHT_FLIP='AGGAACCCCTAGTGATGGAGTTGGCCACTCCCTCTCTGCGCGCTCGCTCGCTCACTGAGGCCGCCCGGGCAAAGCCCGGGCGTCGGGCGACCTTTGGTCGCCCGGCCTCAGTGAGCGAGCGAGCGCGCAGAGAGGGAGTGGCCAA'
 SEQ_RIGHT_FLOP='AGGAACCCCTAGTGATGGAGTTGGCCACTCCCTCTCTGCGCGCTCGCTCGCTCACTGAGGCCGGGCGACCAAAGGTCGCCCGACGCCCGGGCTTTGCCCGGGCGGCCTCAGTGAGCGAGCGAGCGCGCAGAGAGGGAGTGGCCAA'
 
+# the left ITR is searched within the first len(ITR)+ITR_LEFT_WINDOW_PAD bases of the read, the right ITR within
+# the last len(ITR)+ITR_RIGHT_WINDOW_PAD bases; a negative pad searches the whole read
+ITR_LEFT_WINDOW_PAD = 200
+ITR_RIGHT_WINDOW_PAD = 10
+
+ITR_PROFILES = {} # ITR sequence --> parasail profile, each built once
+ITR_CACHE_SIZE = 100000 # max number of ITR calls kept in ITR_CALL_CACHE
+
+class ITRCallCache:
+    """
+    Bounded LRU cache of flip/flop calls for one read end, keyed by the exact read window(s) given
+    to parasail and the flip/flop ITR pair they were aligned to (hits are counted in ITR_CALL_COUNTS['cache']).
+    """
+    def __init__(self, max_size=ITR_CACHE_SIZE):
+        self.max_size = max_size
+        self.calls = OrderedDict()
+
+    def get(self, key):
+        if self.max_size <= 0:
+            return None
+        config = self.calls.get(key)
+        if config is not None:
+            self.calls.move_to_end(key)
+        return config
+
+    def put(self, key, config):
+        if self.max_size <= 0:
+            return
+        self.calls[key] = config
+        if len(self.calls) > self.max_size:
+            self.calls.popitem(last=False)
+
+ITR_CALL_CACHE = ITRCallCache()
+
+KMER_SIZE = 10
+KMER_MIN_COVERAGE = 0.8 # fraction of the ITR k-mers a read end must contain to be called by the k-mer pre-screen
+KMER_PRESCREEN = True
+ITR_KMER_INDEXES = {} # (flip ITR, flop ITR) --> ITRKmerIndex, each built once
+ITR_CALL_COUNTS = {'cache': 0, 'kmer': 0, 'align': 0} # how read-end ITR calls were made
+
+def get_kmers(seq, k=KMER_SIZE):
+    return set(seq[i:i+k] for i in range(len(seq)-k+1))
+
+def get_anchored_score(seq, window, tiles, k=KMER_SIZE):
+    """
+    Lower bound of the local alignment score of <seq> against <window> (get_itr_score), from the alignment that
+    chains the non-overlapping k-mers <tiles> of <seq> found in order in <window>, with the bases between two
+    k-mers aligned ungapped and the length difference as one gap (before or after them, whichever scores higher)
+
+    :param tiles: list of (position in seq, k-mer)
+    """
+    best = score = 0
+    prev = None # ends of the last chained k-mer, in seq and in window
+    for i, kmer in tiles:
+        j = window.find(kmer, 0 if prev is None else prev[1])
+        if j < 0:
+            continue
+        if prev is not None:
+            n1, n2 = i - prev[0], j - prev[1]
+            n = min(n1, n2)
+            score += max(sum(SW_MATCH if a == b else SW_MISMATCH for a, b in zip(seq[prev[0]:prev[0]+n], window[prev[1]:prev[1]+n])),
+                         sum(SW_MATCH if a == b else SW_MISMATCH for a, b in zip(seq[i-n:i], window[j-n:j])))
+            if n1 != n2:
+                score -= SW_GAP_OPEN + SW_GAP_EXTEND * abs(n1 - n2)
+        score = max(score, 0) + SW_MATCH * k # or start the local alignment at this k-mer
+        best = max(best, score)
+        prev = (i + k, j + k)
+    return best
+
+def get_tiling_kmers(seq, wanted, k=KMER_SIZE):
+    """
+    :return: non-overlapping k-mers of <seq> (leftmost first) that are in the set <wanted>
+    """
+    kmers = []
+    i = 0
+    while i <= len(seq) - k:
+        if seq[i:i+k] in wanted:
+            kmers.append(seq[i:i+k])
+            i += k
+        else:
+            i += 1
+    return kmers
+
+class ITRKmerIndex:
+    """
+    Non-overlapping k-mers tiling a flip/flop ITR pair: those unique to flip, unique to flop
+    (the inverted B/C arm region) and shared by both. A read end is called flip (flop) without
+    alignment only if it contains none of the k-mers unique to flop (flip), all of the k-mers
+    unique to flip (flop), the first and last k-mer of the ITR and at least KMER_MIN_COVERAGE
+    of the shared k-mers, i.e. a near-complete copy of only one of the two ITRs, and if the ITR score
+    is sure to be above ITR_MIN_SCORE (get_anchored_score), i.e. if alignment would call it the same.
+    """
+    def __init__(self, seq_flip, seq_flop, k=KMER_SIZE, min_coverage=KMER_MIN_COVERAGE):
+        flip = get_kmers(seq_flip, k)
+        flop = get_kmers(seq_flop, k)
+        self.unique_flip = get_tiling_kmers(seq_flip, flip - flop, k)
+        self.unique_flop = get_tiling_kmers(seq_flop, flop - flip, k)
+        self.shared = get_tiling_kmers(seq_flip, flip & flop, k)
+        self.ends_flip = (seq_flip[:k], seq_flip[-k:])
+        self.ends_flop = (seq_flop[:k], seq_flop[-k:])
+        self.min_shared = min_coverage * len(self.shared)
+        self.k = k
+        self.tiles_flip = [(i, seq_flip[i:i+k]) for i in range(0, len(seq_flip) - k + 1, k)]
+        self.tiles_flop = [(i, seq_flop[i:i+k]) for i in range(0, len(seq_flop) - k + 1, k)]
+        self.seq_flip, self.seq_flop = seq_flip, seq_flop
+
+    def call(self, window_flip, window_flop):
+        """
+        :return: flip|flop, or None if the k-mers do not clearly support only one of them
+        """
+        if len(self.unique_flip) == 0 or len(self.unique_flop) == 0:
+            return None
+        n_flip = sum(kmer in window_flip for kmer in self.unique_flip)
+        n_flop = sum(kmer in window_flop for kmer in self.unique_flop)
+        if n_flop == 0 and n_flip == len(self.unique_flip):
+            config, seq, window, ends, tiles = 'flip', self.seq_flip, window_flip, self.ends_flip, self.tiles_flip
+        elif n_flip == 0 and n_flop == len(self.unique_flop):
+            config, seq, window, ends, tiles = 'flop', self.seq_flop, window_flop, self.ends_flop, self.tiles_flop
+        else:
+            return None
+        if ends[0] not in window or ends[1] not in window:
+            return None
+        if sum(kmer in window for kmer in self.shared) < self.min_shared:
+            return None
+        if get_anchored_score(seq, window, tiles, self.k) <= ITR_MIN_SCORE: # could be 'unknown', align instead
+            return None
+        return config
+
+def get_itr_kmer_index(seq_flip, seq_flop):
+    if (seq_flip, seq_flop) not in ITR_KMER_INDEXES:
+        ITR_KMER_INDEXES[seq_flip, seq_flop] = ITRKmerIndex(seq_flip, seq_flop)
+    return ITR_KMER_INDEXES[seq_flip, seq_flop]
+
 #POS_LEFT_FLIP=0 # start position
 #POS_RIGHT_FLIP=4603 # start position
 
@@ -65,6 +204,58 @@ def read_flip_flop_fasta(fasta_filename):
         sys.exit(-1)
 
 
+def get_itr_profile(seq):
+    """
+    :return: parasail score-only profile of the ITR sequence <seq>, built on first use
+    """
+    if seq not in ITR_PROFILES:
+        ITR_PROFILES[seq] = parasail.profile_create_16(seq, SW_SCORE_MATRIX)
+    return ITR_PROFILES[seq]
+
+def get_itr_score(seq, window):
+    """
+    :return: local alignment (Smith-Waterman) score of ITR sequence <seq> against the read window <window>,
+             same as parasail.sw_trace(window, seq, 3, 1, SW_SCORE_MATRIX).score without computing the traceback
+    """
+    o = parasail.sw_striped_profile_16(get_itr_profile(seq), window, 3, 1)
+    if o.saturated: # score does not fit in 16 bits, redo without the profile
+        o = parasail.sw_striped_32(seq, window, 3, 1, SW_SCORE_MATRIX)
+    return o.score
+
+def get_left_window(query, seq):
+    return query if ITR_LEFT_WINDOW_PAD < 0 else query[:len(seq)+ITR_LEFT_WINDOW_PAD]
+
+def get_right_window(query, seq):
+    return query if ITR_RIGHT_WINDOW_PAD < 0 else query[-len(seq)-ITR_RIGHT_WINDOW_PAD:]
+
+def call_itr(seq_flip, seq_flop, window_flip, window_flop):
+    """
+    :return: flip|flop|unknown for one read end, from the scores of <seq_flip> against <window_flip>
+             and of <seq_flop> against <window_flop> (cached in ITR_CALL_CACHE), unless the
+             k-mer pre-screen (ITRKmerIndex) already calls it
+    """
+    key = (seq_flip, seq_flop, window_flip, window_flop)
+    config = ITR_CALL_CACHE.get(key)
+    if config is not None:
+        ITR_CALL_COUNTS['cache'] += 1
+        return config
+    if KMER_PRESCREEN:
+        config = get_itr_kmer_index(seq_flip, seq_flop).call(window_flip, window_flop)
+    if config is not None:
+        ITR_CALL_COUNTS['kmer'] += 1
+    else:
+        ITR_CALL_COUNTS['align'] += 1
+        s1 = get_itr_score(seq_flip, window_flip)
+        s2 = get_itr_score(seq_flop, window_flop)
+        if s1 > s2 and s1 > ITR_MIN_SCORE:
+            config = 'flip'
+        elif s2 > s1 and s2 > ITR_MIN_SCORE:
+            config = 'flop'
+        else:
+            config = 'unknown'
+    ITR_CALL_CACHE.put(key, config)
+    return config
+
 def identify_flip_flop(r):
     """
     Assume record tag:AT is vector, tag:AX can be full|left-partial|right-partial|partial
@@ -76,88 +267,250 @@ def identify_flip_flop(r):
     except AssertionError:
         print("Input BAM records must have a `AX` tag assigned by first running summarize_AAV_alignment.py. Abort!")
         sys.exit(-1)
+    return identify_flip_flop_query(r.query, t['AX'])
+
+def identify_flip_flop_query(query, subtype):
+    """
+    :param query: aligned part of the read sequence (r.query)
+    :param subtype: AX tag of the read (vector-full|vector-left-partial|vector-right-partial|vector-partial)
+    :return: config_left, config_right, each flip|flop|unknown
+    """
     config_left, config_right = 'unknown', 'unknown'
-    if t['AX']=='vector-partial': # ignore, since both sides are missing chunks of ITR
+    if subtype=='vector-partial': # ignore, since both sides are missing chunks of ITR
         return 'unknown', 'unknown'
 
-    if t['AX'] in ('vector-full', 'vector-left-partial'):
-        o1 = parasail.sw_trace(r.query, SEQ_LEFT_FLIP, 3, 1, SW_SCORE_MATRIX)
-        o2 = parasail.sw_trace(r.query, SEQ_LEFT_FLOP, 3, 1, SW_SCORE_MATRIX)
-        if o1.score > o2.score and o1.score > 250: 
-            config_left = 'flip'
-        elif o2.score > o1.score and o2.score > 250:
-            config_left = 'flop'
-        else:
-            config_left = 'unknown'
-    
-    if t['AX'] in ('vector-full', 'vector-right-partial'):
-        o1 = parasail.sw_trace(r.query[-len(SEQ_RIGHT_FLIP)-10:], SEQ_RIGHT_FLIP, 3, 1, SW_SCORE_MATRIX)
-        o2 = parasail.sw_trace(r.query[-len(SEQ_RIGHT_FLOP)-10:], SEQ_RIGHT_FLOP, 3, 1, SW_SCORE_MATRIX)
-        if o1.score > o2.score and o1.score > 250:
-            config_right = 'flip'
-        elif o2.score > o1.score and o2.score > 250:
-            config_right = 'flop'
-        else:
-            config_right = 'unknown'
+    if subtype in ('vector-full', 'vector-left-partial'):
+        config_left = call_itr(SEQ_LEFT_FLIP, SEQ_LEFT_FLOP,
+                               get_left_window(query, SEQ_LEFT_FLIP), get_left_window(query, SEQ_LEFT_FLOP))
+
+    if subtype in ('vector-full', 'vector-right-partial'):
+        config_right = call_itr(SEQ_RIGHT_FLIP, SEQ_RIGHT_FLOP,
+                                get_right_window(query, SEQ_RIGHT_FLIP), get_right_window(query, SEQ_RIGHT_FLOP))
     return config_left, config_right
 
-def main(per_read_csv, tagged_bam, output_prefix):
+BATCH_SIZE = 1000 # records sent to a worker at a time
+FLIPFLOP_SUBTYPES = ('vector-full', 'vector-left-partial', 'vector-right-partial') # AX tags of the records to call
+
+class FlipFlopWriter:
+    """
+    Writer for the flip-flop outputs: <output_prefix>.flipflop_assignments.txt and
+    <output_prefix>.vector-{full,leftpartial,rightpartial}-flipflop.bam, whose records get the AF and AG tags.
+    These small BAM files are compressed without extra BGZF threads.
+    """
+    def __init__(self, output_prefix, header):
+        self.fout = open(output_prefix + '.flipflop_assignments.txt', 'w')
+        self.fout.write("name\ttype\tsubtype\tstart\tend\tleftITR\trightITR\n")
+        self.writer1 = pysam.AlignmentFile(output_prefix+'.vector-full-flipflop.bam', 'wb', header=header)
+        self.writer2 = pysam.AlignmentFile(output_prefix+'.vector-leftpartial-flipflop.bam', 'wb', header=header)
+        self.writer3 = pysam.AlignmentFile(output_prefix+'.vector-rightpartial-flipflop.bam', 'wb', header=header)
+        self.counts_before = dict(ITR_CALL_COUNTS)
+
+    def get_call_counts(self):
+        """
+        :return: dict of how many read-end ITR calls made by add() came from the cache, the k-mer pre-screen and alignment
+        """
+        return {k: ITR_CALL_COUNTS[k] - self.counts_before[k] for k in ITR_CALL_COUNTS}
+
+    def write(self, r, a_type, subtype, c_l, c_r):
+        r.set_tag('AF', c_l + '-' + c_r, 'Z')
+        r.set_tag('AG', a_type, 'Z')
+        if subtype == 'vector-full':
+            writer = self.writer1
+        elif subtype == 'vector-right-partial':
+            writer = self.writer2
+        elif subtype == 'vector-left-partial':
+            writer = self.writer3
+        writer.write(r)
+        self.fout.write(r.qname + '\t' + a_type + '\t' + subtype + '\t' +
+                        str(r.reference_start) + '\t' +
+                        str(r.reference_end) + '\t' +
+                        c_l + '\t' + c_r + '\n')
+
+    def add(self, r, a_type):
+        """
+        Call and write the tagged record <r> of a read assigned <a_type>, if it is a vector
+        full/left-partial/right-partial record of a scAAV/ssAAV read (used by summarize_AAV_alignment.py --flipflop).
+        The AF/AG tags are set on a copy, <r> itself is not changed.
+        """
+        if a_type not in ('scAAV', 'ssAAV'): return
+        subtype = r.get_tag('AX')
+        if r.get_tag('AT') == 'vector' and subtype in FLIPFLOP_SUBTYPES:
+            c_l, c_r = identify_flip_flop_query(r.query, subtype)
+            self.write(copy.copy(r), a_type, subtype, c_l, c_r)
+
+    def close(self):
+        self.writer1.close()
+        self.writer2.close()
+        self.writer3.close()
+        self.fout.close()
 
+def set_call_options(left_window_pad=ITR_LEFT_WINDOW_PAD, right_window_pad=ITR_RIGHT_WINDOW_PAD, cache_size=ITR_CACHE_SIZE, kmer_prescreen=True):
+    """
+    Set the ITR search windows, call cache size and k-mer pre-screen (--left_window_pad, --right_window_pad,
+    --cache_size, --no_kmer_prescreen) used by all later calls in this process
+    """
+    global ITR_LEFT_WINDOW_PAD, ITR_RIGHT_WINDOW_PAD, ITR_CALL_CACHE, KMER_PRESCREEN
+    ITR_LEFT_WINDOW_PAD, ITR_RIGHT_WINDOW_PAD = left_window_pad, right_window_pad
+    ITR_CALL_CACHE = ITRCallCache(cache_size)
+    KMER_PRESCREEN = kmer_prescreen
+
+def get_call_options():
+    """
+    :return: arguments of set_call_options() for the current settings
+    """
+    return ITR_LEFT_WINDOW_PAD, ITR_RIGHT_WINDOW_PAD, ITR_CALL_CACHE.max_size, KMER_PRESCREEN
+
+def init_worker(seqs, call_options):
+    """
+    Pool initializer: use the same ITR sequences, windows, cache size and pre-screen setting as the main process
+    """
+    global SEQ_LEFT_FLIP, SEQ_LEFT_FLOP, SEQ_RIGHT_FLIP, SEQ_RIGHT_FLOP
+    SEQ_LEFT_FLIP, SEQ_LEFT_FLOP, SEQ_RIGHT_FLIP, SEQ_RIGHT_FLOP = seqs
+    set_call_options(*call_options)
+
+def identify_flip_flop_batch(batch):
+    """
+    :param batch: list of (query, subtype)
+    :return: list of (config_left, config_right), dict of how many read-end calls of this batch were
+             made from the cache, by the k-mer pre-screen and by alignment
+    """
+    before = dict(ITR_CALL_COUNTS)
+    calls = [identify_flip_flop_query(query, subtype) for query, subtype in batch]
+    return calls, {k: ITR_CALL_COUNTS[k] - before[k] for k in ITR_CALL_COUNTS}
+
+def read_assigned_types(per_read_csv):
+    """
+    :return: dict of read_id --> assigned_type, from the per_read table
+    """
+    if per_read_csv is None:
+        print("Tagged BAM records have no read-level AG tag (older summarize_AAV_alignment.py output), the per_read CSV must be given. Abort!")
+        sys.exit(-1)
     read_info = {}
-    for r in DictReader(open(per_read_csv), delimiter='\t'):
-        read_info[r['read_id']] = r
-
-    fout = open(output_prefix + '.flipflop_assignments.txt', 'w')
-    fout.write("name\ttype\tsubtype\tstart\tend\tleftITR\trightITR\n")
-    reader = pysam.AlignmentFile(open(tagged_bam), 'rb', check_sq=False)
-    writer1 = pysam.AlignmentFile(open(output_prefix+'.vector-full-flipflop.bam', 'w'), 'wb',
-                                  header=reader.header)
-    writer2 = pysam.AlignmentFile(open(output_prefix+'.vector-leftpartial-flipflop.bam', 'w'), 'wb',
-                                  header=reader.header)
-    writer3 = pysam.AlignmentFile(open(output_prefix+'.vector-rightpartial-flipflop.bam', 'w'), 'wb',
-                                  header=reader.header)
+    for r in iter_table_rows(per_read_csv, columns=['read_id', 'assigned_type']):
+        read_info[r['read_id']] = r['assigned_type']
+    return read_info
+
+def iter_flipflop_batches(reader, per_read_csv=None, batch_size=BATCH_SIZE):
+    """
+    Yield batches of (record, assigned_type, subtype) for the vector full/left-partial/right-partial
+    records of scAAV/ssAAV reads, in BAM order.
+    The assigned type is the AG tag set by summarize_AAV_alignment.py, the per_read table is only read
+    if some record does not have it.
+    """
+    read_info = None
+    batch = []
     for r in reader:
         t = dict(r.tags)
-        # if r.qname=='m54278_220522_043945/5964021/ccs/rev': break
-        if t['AT'] == 'vector' and t['AX'] in ('vector-full', 'vector-left-partial', 'vector-right-partial'):
-            c_l, c_r = identify_flip_flop(r)
-            d = r.to_dict()
-            a_type = read_info[r.qname]['assigned_type']
+        if t['AT'] == 'vector' and t['AX'] in FLIPFLOP_SUBTYPES:
+            if 'AG' in t:
+                a_type = t['AG']
+            else:
+                if read_info is None:
+                    read_info = read_assigned_types(per_read_csv)
+                a_type = read_info[r.qname]
             if a_type not in ('scAAV', 'ssAAV'): continue
-            d['tags'].append('AF:Z:' + c_l + '-' + c_r)
-            d['tags'].append('AG:Z:' + a_type)
-            if t['AX'] == 'vector-full':
-                writer = writer1
-            elif t['AX'] == 'vector-right-partial':
-                writer = writer2
-            elif t['AX'] == 'vector-left-partial':
-                writer = writer3
-            writer.write(pysam.AlignedSegment.from_dict(d, r.header))
-            fout.write(r.qname + '\t' + a_type + '\t' + t['AX'] + '\t' +
-                       str(r.reference_start) + '\t' +
-                       str(r.reference_end) + '\t' +
-                       c_l + '\t' + c_r + '\n')
-
-    writer1.close()
-    writer2.close()
-    writer3.close()
-    fout.close()
-
-    print("Output summmary: {0}".format(fout.name))
+            batch.append((r, a_type, t['AX']))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if len(batch) > 0:
+        yield batch
+
+def print_itr_call_counts(call_counts, label=None):
+    total = sum(call_counts.values())
+    if total > 0:
+        print("ITR calls for {0} read ends{1}: {2} ({3:.1f}%) from cache, {4} ({5:.1f}%) by k-mer pre-screen, {6} ({7:.1f}%) by alignment".format(
+            total, '' if label is None else ' of ' + label, call_counts['cache'], 100. * call_counts['cache'] / total,
+            call_counts['kmer'], 100. * call_counts['kmer'] / total, call_counts['align'], 100. * call_counts['align'] / total), flush=True)
+
+def main(per_read_csv, tagged_bam, output_prefix, io_threads=IO_THREADS, cpus=1, profile=False, random_frac=1., max_reads=None):
+    """
+    :param profile: if True, write the per-stage profile to <output_prefix>.flipflop.profile.json (see aav_profiling)
+    :param random_frac: if < 1, only call the reads kept by summarize_AAV_alignment.is_read_sampled
+    :param max_reads: if given, stop after this many (subsampled) reads of the tagged BAM
+    """
+    profiler = StageProfiler('flipflop') if profile else NullProfiler()
+    reader = pysam.AlignmentFile(open(tagged_bam), 'rb', check_sq=False, threads=io_threads)
+    writer = FlipFlopWriter(output_prefix, reader.header)
+
+    call_counts = {'cache': 0, 'kmer': 0, 'align': 0}
+    def write_batch(batch, result):
+        calls, counts = result
+        for k in counts:
+            call_counts[k] += counts[k]
+        profiler.start('write')
+        for (r, a_type, subtype), (c_l, c_r) in zip(batch, calls):
+            writer.write(r, a_type, subtype, c_l, c_r)
+        profiler.stop(count=len(batch))
+        profiler.progress(len(batch))
+
+    records = profiler.iter('bam_decode', reader)
+    if random_frac < 1 or max_reads is not None:
+        records = iter_sampled_records(records, random_frac, max_reads)
+    batches = iter_flipflop_batches(records, per_read_csv, BATCH_SIZE)
+    if cpus == 1:
+        for batch in batches:
+            with profiler.stage('align', count=len(batch)):
+                result = identify_flip_flop_batch([(r.query, subtype) for r, a_type, subtype in batch])
+            write_batch(batch, result)
+    else:
+        # batches are aligned by the pool and written in submission order, keeping at most 2 batches per worker in flight
+        seqs = (SEQ_LEFT_FLIP, SEQ_LEFT_FLOP, SEQ_RIGHT_FLIP, SEQ_RIGHT_FLOP)
+        with Pool(cpus, initializer=init_worker,
+                  initargs=(seqs, get_call_options())) as pool:
+            pending = deque()
+            for batch in batches:
+                pending.append((batch, pool.apply_async(identify_flip_flop_batch,
+                                                        ([(r.query, subtype) for r, a_type, subtype in batch],))))
+                if len(pending) >= 2 * cpus:
+                    batch, result = pending.popleft()
+                    with profiler.stage('wait_align', count=len(batch)):
+                        result = result.get()
+                    write_batch(batch, result)
+            while len(pending) > 0:
+                batch, result = pending.popleft()
+                with profiler.stage('wait_align', count=len(batch)):
+                    result = result.get()
+                write_batch(batch, result)
+
+    with profiler.stage('write', count=0):
+        writer.close()
+
+    print_itr_call_counts(call_counts)
+    if profile:
+        profiler.write(output_prefix + '.flipflop.profile.json', cpus=cpus, itr_calls=call_counts)
+        print("Profile written to {0}".format(output_prefix + '.flipflop.profile.json'))
+    print("Output summmary: {0}".format(output_prefix + '.flipflop_assignments.txt'))
     print(f"Indidual BAM files written: {output_prefix}.vector- full,leftpartial,rightpartial -flipflop.bam")
 
 if __name__ == "__main__":
     from argparse import ArgumentParser
     parser = ArgumentParser()
     parser.add_argument("sorted_tagged_bam", help="Sorted tagged BAM file")
-    parser.add_argument("per_read_csv", help="Per read CSV file")
+    parser.add_argument("per_read_csv", nargs='?', default=None, help="(optional) Per read CSV (or .parquet) file, only needed for tagged BAM files without the read-level AG tag")
     parser.add_argument("-o", "--output_prefix", help="Output prefix", required=True)
     parser.add_argument("--flipflop_fasta", default=None, help="(optional) flip flop fasta file (if not given, uses AAV2 default)")
+    parser.add_argument("--left_window_pad", type=int, default=ITR_LEFT_WINDOW_PAD, help="Search the left ITR within the first len(ITR)+N bases of each read, negative to search the whole read (default: {0})".format(ITR_LEFT_WINDOW_PAD))
+    parser.add_argument("--right_window_pad", type=int, default=ITR_RIGHT_WINDOW_PAD, help="Search the right ITR within the last len(ITR)+N bases of each read, negative to search the whole read (default: {0})".format(ITR_RIGHT_WINDOW_PAD))
+    parser.add_argument("--no_kmer_prescreen", action="store_true", default=False, help="Always align the ITRs, instead of calling read ends with k-mers unique to only one of flip/flop directly")
+    parser.add_argument("--cache_size", type=int, default=ITR_CACHE_SIZE, help="Max number of read-end ITR calls to cache (per CPU), 0 to disable (default: {0})".format(ITR_CACHE_SIZE))
+    parser.add_argument("--cpus", type=int, default=1, help="Number of CPUs for ITR alignment (default: 1)")
+    parser.add_argument("--io_threads", "--io-threads", dest="io_threads", type=int, default=IO_THREADS, help="BGZF decompression threads for reading the tagged BAM (default: {0})".format(IO_THREADS))
+    parser.add_argument("--profile", action="store_true", default=False, help="Record wall/CPU time and item counts per stage to <output_prefix>.flipflop.profile.json, and log records/sec progress")
+    parser.add_argument("-f", "--random_frac", default=1., type=float, help="default: off. Fraction of reads to subsample, by read name hash (same reads as summarize_AAV_alignment.py --random_frac)")
+    parser.add_argument("-m", "--max_reads", type=int, default=None, help="default: off. Stop after this many (subsampled) reads of the tagged BAM")
 
     args = parser.parse_args()
 
+    set_call_options(args.left_window_pad, args.right_window_pad, args.cache_size, not args.no_kmer_prescreen)
+
     if args.flipflop_fasta is not None:
         read_flip_flop_fasta(args.flipflop_fasta)
 
-    main(args.per_read_csv, args.sorted_tagged_bam, args.output_prefix)
+    if not 0 < args.random_frac <= 1:
+        print("--random_frac must be in (0, 1]. Abort!")
+        sys.exit(-1)
+
+    main(args.per_read_csv, args.sorted_tagged_bam, args.output_prefix, split_io_threads(args.io_threads, 1), args.cpus, args.profile,
+         args.random_frac, args.max_reads)
 
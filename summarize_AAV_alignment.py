@@ -1,11 +1,21 @@
 #!/usr/bin/env python3
-import os, sys, re, pdb, shutil, subprocess
+import os, sys, re, pdb, shutil, json
+import queue
 import gzip
 import random
+import struct
+import zlib
 from csv import DictReader, DictWriter
-from collections import defaultdict
+import heapq
+import math
+from collections import defaultdict, Counter
+import numpy as np
 import pysam
-from multiprocessing import Process
+from multiprocessing import Process, Pool, Queue
+from multiprocessing.connection import wait
+from aav_profiling import NullProfiler, StageProfiler
+
+__version__ = '2.1.0'
 
 CIGAR_DICT = {0: 'M',
               1: 'I',
@@ -43,6 +53,15 @@ NONMATCH_FIELDS = ['read_id',
                    'type',
                    'type_len']
 
+NONMATCH_HIST_FIELDS = ['map_name',
+                        'type',
+                        'pos0_div',
+                        'type_len_cat',
+                        'count']
+
+NONMATCH_BIN_SIZE = 10 # bin size (bp) for the reference position of nonmatch events
+NONMATCH_LEN_CATEGORIES = ['1-10', '11-100', '100-500', '>500'] # same categories as used in plotAAVreport.R
+
 name_map_scAAV = {'full': 'full',
                   'left-partial': 'left-partial', #'wtITR-partial',
                   'right-partial': 'right-partial', #'mITR-partial',
@@ -54,29 +73,334 @@ annot_rex = re.compile('NAME=(\S+);TYPE=([a-zA-Z]+);(REGION=\d+\-\d+){0,1}')
 ccs_rex = re.compile('\S+\/\d+\/ccs(\/fwd|\/rev)?')
 ANNOT_TYPE_PRIORITIES = {'vector': 1, 'repcap': 2, 'helper': 3, 'lambda':4, 'host': 5}
 
+TABLE_FORMATS = ['tsv', 'parquet']
+TABLE_BATCH_SIZE = 65536 # number of rows per batch (Parquet row group)
+
+# column types for the columnar (Parquet) tables; 'cat' columns are dictionary-encoded strings
+# 'NA' values in int/float/cat columns are stored as nulls (read back as 'NA' by iter_table_rows)
+TABLE_COLUMN_TYPES = {'read_id': 'str',
+                      'read_len': 'int',
+                      'is_mapped': 'cat',
+                      'is_supp': 'cat',
+                      'map_name': 'cat',
+                      'map_start0': 'int',
+                      'map_end1': 'int',
+                      'map_len': 'int',
+                      'map_iden': 'float',
+                      'map_type': 'cat',
+                      'map_subtype': 'cat',
+                      'has_primary': 'cat',
+                      'has_supp': 'cat',
+                      'assigned_type': 'cat',
+                      'assigned_subtype': 'cat',
+                      'effective_count': 'int',
+                      'pos0': 'int',
+                      'type': 'cat',
+                      'type_len': 'int'}
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception("pyarrow is required for the parquet table format (conda install -c conda-forge pyarrow). Abort!")
+    return pyarrow, pyarrow.parquet
+
+def get_table_filename(filename_prefix, table_format, gzipped=False):
+    """
+    :param filename_prefix: ex: <output_prefix>.per_read
+    :return: ex: <output_prefix>.per_read.csv or <output_prefix>.per_read.parquet
+    """
+    if table_format == 'parquet':
+        return filename_prefix + '.parquet'
+    return filename_prefix + ('.csv.gz' if gzipped else '.csv')
+
+class TsvTableWriter(DictWriter):
+    """
+    csv.DictWriter (tab-delimited) that owns its file, header is written on opening.
+    If gzip_members is True the file is gzipped, with the header as its own gzip member
+    so it can be skipped when concatenating chunks (see copy_gzip_table).
+    """
+    def __init__(self, filename, fields, gzip_members=False):
+        self.raw = None
+        if gzip_members:
+            self.raw = open(filename, 'wb')
+            with gzip.open(self.raw, 'wt') as h:
+                DictWriter(h, fields, delimiter='\t').writeheader()
+            self.f = gzip.open(self.raw, 'wt')
+        else:
+            self.f = open(filename, 'w')
+        super().__init__(self.f, fields, delimiter='\t')
+        if not gzip_members:
+            self.writeheader()
+
+    def close(self):
+        self.f.close()
+        if self.raw is not None:
+            self.raw.close()
+
+class ParquetTableWriter:
+    """
+    Same writerow() interface as TsvTableWriter, but writes a Parquet file in batches of TABLE_BATCH_SIZE rows,
+    with typed columns and dictionary-encoded categorical columns (see TABLE_COLUMN_TYPES)
+    """
+    def __init__(self, filename, fields):
+        self.pa, pq = import_pyarrow()
+        self.fields = fields
+        self.schema = get_arrow_schema(self.pa, fields)
+        self.writer = pq.ParquetWriter(filename, self.schema)
+        self.columns = {x: [] for x in fields}
+        self.num_rows = 0
+
+    def writerow(self, row):
+        for x in self.fields:
+            v = row[x]
+            if v == 'NA' and TABLE_COLUMN_TYPES[x] != 'str':
+                v = None
+            self.columns[x].append(v)
+        self.num_rows += 1
+        if self.num_rows >= TABLE_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.num_rows == 0:
+            return
+        arrays = []
+        for x, field in zip(self.fields, self.schema):
+            if TABLE_COLUMN_TYPES[x] == 'cat':
+                arrays.append(self.pa.array(self.columns[x], type=self.pa.string()).dictionary_encode().cast(field.type))
+            else:
+                arrays.append(self.pa.array(self.columns[x], type=field.type))
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+        self.columns = {x: [] for x in self.fields}
+        self.num_rows = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+def get_arrow_schema(pa, fields):
+    types = {'str': pa.string(),
+             'cat': pa.dictionary(pa.int32(), pa.string()),
+             'int': pa.int64(),
+             'float': pa.float64()}
+    return pa.schema([(x, types[TABLE_COLUMN_TYPES[x]]) for x in fields])
+
+def open_table_writer(filename_prefix, fields, table_format='tsv', gzip_members=False):
+    """
+    :return: TsvTableWriter or ParquetTableWriter for get_table_filename(filename_prefix, ...)
+    """
+    if table_format == 'parquet':
+        return ParquetTableWriter(get_table_filename(filename_prefix, table_format), fields)
+    elif table_format == 'tsv':
+        return TsvTableWriter(get_table_filename(filename_prefix, table_format, gzip_members), fields, gzip_members)
+    else:
+        raise Exception("Unknown table format {0}, must be one of {1}. Abort!".format(table_format, TABLE_FORMATS))
+
+def iter_table_rows(filename, columns=None):
+    """
+    Iterate over the rows (as dicts) of a table written by process_alignment_bam, TSV (optionally gzipped) or Parquet
+    (nulls are returned as 'NA', as in the TSV tables)
+    :param columns: for Parquet, only read these columns
+    """
+    if filename.endswith('.parquet'):
+        pa, pq = import_pyarrow()
+        for batch in pq.ParquetFile(filename).iter_batches(batch_size=TABLE_BATCH_SIZE, columns=columns):
+            for r in batch.to_pylist():
+                yield {k: ('NA' if v is None else v) for k, v in r.items()}
+    else:
+        h = gzip.open(filename, 'rt') if filename.endswith('.gz') else open(filename)
+        with h:
+            yield from DictReader(h, delimiter='\t')
+
+def concat_parquet_files(in_filenames, out_filename):
+    """
+    Concatenate Parquet tables with the same schema, batch by batch
+    """
+    pa, pq = import_pyarrow()
+    writer = None
+    for in_filename in in_filenames:
+        f = pq.ParquetFile(in_filename)
+        if writer is None:
+            writer = pq.ParquetWriter(out_filename, f.schema_arrow)
+        for i in range(f.num_row_groups):
+            writer.write_table(f.read_row_group(i))
+    writer.close()
+
+
 MAX_DIFF_W_REF = 100
 TARGET_GAP_THRESHOLD = 200 # skipping through the on-target region for more than this is considered "full-gap"
 DEBUG_GLOBAL_FLAG = False
+PROFILER = NullProfiler() # set to a StageProfiler with --profile
 
-def subset_sam_by_readname_list(in_bam, out_bam, per_read_csv, wanted_types, wanted_subtypes, max_count=None, exclude_subtype=False, exclude_type=False):
+def subset_sam_by_readname_list(in_bam, out_bam, per_read_csv, wanted_types, wanted_subtypes, max_count=None, exclude_subtype=False, exclude_type=False, io_threads=1):
     qname_list = {} # qname --> (a_type, a_subtype)
-    for r in DictReader(open(per_read_csv), delimiter='\t'):
+    for r in iter_table_rows(per_read_csv, columns=['read_id', 'assigned_type', 'assigned_subtype']):
         #pdb.set_trace()
         if (wanted_types is None or (not exclude_type and r['assigned_type'] in wanted_types) or (exclude_type and r['assigned_type'] not in wanted_types)) and (wanted_subtypes is None or (not exclude_subtype and (r['assigned_subtype'] in wanted_subtypes)) or (exclude_subtype and (r['assigned_subtype'] not in wanted_subtypes))):
             qname_list[r['read_id']] = (r['assigned_type'], r['assigned_subtype'])
 
     cur_count = 0
-    reader = pysam.AlignmentFile(in_bam, 'rb', check_sq=False)
-    writer = pysam.AlignmentFile(out_bam, 'wb', header=reader.header)
+    reader = pysam.AlignmentFile(in_bam, 'rb', check_sq=False, threads=io_threads)
+    writer = pysam.AlignmentFile(out_bam, 'wb', header=reader.header, threads=io_threads)
     for r in reader:
         if r.qname in qname_list:
-            d = add_assigned_types_to_record(r, *qname_list[r.qname])
-            writer.write(pysam.AlignedSegment.from_dict(d, reader.header))
+            writer.write(add_assigned_types_to_record(r, *qname_list[r.qname]))
             cur_count += 1
             if max_count is not None and cur_count >= max_count: break
     reader.close()
     writer.close()
 
+SUBSET_CATEGORIES = ['scAAV-full',
+                     'scAAV-partials',
+                     'scAAV-other',
+                     'ssAAV-full',
+                     'ssAAV-partials',
+                     'ssAAV-other',
+                     'others']
+
+def get_subset_category(a_type, a_subtype):
+    """
+    Categories for subsetting the tagged BAM for ease of loading into IGV for viewing
+    (these used to be subset_sam_by_readname_list calls, one per category)
+    """
+    if a_type in ('scAAV', 'ssAAV'):
+        if a_subtype == 'full':
+            return a_type + '-full'
+        elif a_subtype in ('partial', 'left-partial', 'right-partial'):
+            return a_type + '-partials'
+        else:
+            return a_type + '-other'
+    return 'others'
+
+IO_THREADS = 1 # BGZF (de)compression threads for each open BAM file, 1 means no extra threads
+
+def split_io_threads(io_threads, num_workers):
+    """
+    :param io_threads: BGZF threads as given by --io_threads
+    :param num_workers: number of worker processes that each read their input and write their own .tagged.bam
+    :return: BGZF threads for the input and the .tagged.bam of each worker, so that workers x threads
+             stays within both <io_threads> and the number of available cores (the smaller category and
+             flip-flop BAM files are compressed without extra threads)
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+    return max(1, min(io_threads // num_workers, cores // num_workers))
+
+SORT_MEM = '768M' # max memory per sort (same as samtools sort -m), also bounds the in-memory category buffers
+
+def parse_mem(mem):
+    """
+    :param mem: memory size as used by samtools sort -m, ex: 768M, 2G
+    :return: number of bytes
+    """
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    mem = str(mem).upper()
+    if mem[-1] in units:
+        return int(float(mem[:-1]) * units[mem[-1]])
+    return int(mem)
+
+def coordinate_sort_key(r):
+    # same order as samtools sort: by reference (unmapped last), position, then strand
+    return (r.reference_id if r.reference_id >= 0 else sys.maxsize, r.reference_start, r.is_reverse)
+
+class CategoryBamWriter:
+    """
+    Writer for the records of one subset category.
+
+    Records are kept in memory and written straight to <output_prefix>.<category>.tagged.sorted.bam in
+    coordinate order at close(). If they grow beyond max_buffer_bytes, they are instead written as they come
+    to an unsorted <output_prefix>.<category>.tagged.bam, which is sorted afterwards by sort_and_index_category_bam.
+    Each category BAM is a fraction of the output and is compressed without extra BGZF threads.
+    """
+    def __init__(self, output_prefix, category, header, max_buffer_bytes):
+        self.prefix = output_prefix + '.' + category
+        self.header = header
+        self.max_buffer_bytes = max_buffer_bytes
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.writer = None # unsorted writer, only opened once the buffer is full
+
+    def write(self, r):
+        if self.writer is not None:
+            self.writer.write(r)
+            return
+        self.buffer.append(r)
+        self.buffer_bytes += 2 * r.query_length + len(r.qname) + 100 # rough size of the record in memory
+        if self.buffer_bytes > self.max_buffer_bytes:
+            self.writer = pysam.AlignmentFile(self.prefix+'.tagged.bam', 'wb', header=self.header)
+            for x in self.buffer:
+                self.writer.write(x)
+            self.buffer = []
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            return self.prefix+'.tagged.bam'
+        header = self.header.to_dict()
+        header['HD'] = dict(header.get('HD', {'VN': '1.6'}), SO='coordinate')
+        with pysam.AlignmentFile(self.prefix+'.tagged.sorted.bam', 'wb', header=header) as writer:
+            for r in sorted(self.buffer, key=coordinate_sort_key):
+                writer.write(r)
+        self.buffer = []
+        return self.prefix+'.tagged.sorted.bam'
+
+def open_category_writers(output_prefix, header, sort_mem=SORT_MEM):
+    """
+    :return: dict of subset category --> CategoryBamWriter, sharing a total in-memory budget of <sort_mem>
+    """
+    max_buffer_bytes = parse_mem(sort_mem) // len(SUBSET_CATEGORIES)
+    return {c: CategoryBamWriter(output_prefix, c, header, max_buffer_bytes) for c in SUBSET_CATEGORIES}
+
+def sort_and_index_category_bam(output_prefix, category, chunk_prefixes, threads=1, sort_mem=SORT_MEM):
+    """
+    Produce the coordinate-sorted and indexed <output_prefix>.<category>.tagged.sorted.bam from the
+    CategoryBamWriter outputs of one or more chunks, then delete the chunk outputs.
+     - chunks already sorted in memory are merged (or simply renamed if there is only one)
+     - otherwise all chunks are concatenated and sorted with samtools sort (bundled with pysam)
+    """
+    out = output_prefix + '.' + category
+    in_bams = []
+    for o in chunk_prefixes:
+        if os.path.exists(o+'.'+category+'.tagged.sorted.bam'):
+            in_bams.append(o+'.'+category+'.tagged.sorted.bam')
+        else:
+            in_bams.append(o+'.'+category+'.tagged.bam')
+
+    if all(f.endswith('.sorted.bam') for f in in_bams):
+        if len(in_bams) == 1:
+            if in_bams[0] != out+'.tagged.sorted.bam':
+                os.replace(in_bams[0], out+'.tagged.sorted.bam')
+        else:
+            pysam.merge('-f', '-@', str(threads), out+'.tagged.sorted.bam', *in_bams)
+            for f in in_bams: os.remove(f)
+    else:
+        if in_bams != [out+'.tagged.bam']:
+            concat_bam_files(in_bams, out+'.tagged.bam')
+            for f in in_bams: os.remove(f)
+        # samtools sort -m is per thread
+        pysam.sort('-@', str(threads), '-m', str(max(parse_mem(sort_mem) // threads, 1 << 20)),
+                   '-o', out+'.tagged.sorted.bam', out+'.tagged.bam')
+        os.remove(out+'.tagged.bam')
+    pysam.index(out+'.tagged.sorted.bam')
+    return out+'.tagged.sorted.bam'
+
+def sort_and_index_category_bams(output_prefix, chunk_prefixes, cpus=1, sort_mem=SORT_MEM):
+    """
+    Run sort_and_index_category_bam for all subset categories, <cpus> categories at a time
+    """
+    num_workers = max(1, min(cpus, len(SUBSET_CATEGORIES)))
+    threads = max(1, cpus // num_workers)
+    tasks = [(output_prefix, c, chunk_prefixes, threads, sort_mem) for c in SUBSET_CATEGORIES]
+    if num_workers == 1:
+        for task in tasks:
+            sort_and_index_category_bam(*task)
+    else:
+        with Pool(num_workers) as pool:
+            pool.starmap(sort_and_index_category_bam, tasks)
+
 
 def iter_cigar(rec):
     # first we exclude cigar front/end that is hard-clipped (due to supp alignment)
@@ -92,30 +416,322 @@ def iter_cigar(rec):
         else:
             raise Exception("Unexpected cigar {0}{1} seen! Abort!".format(_count, x))
 
-def iter_cigar_w_aligned_pair(rec, writer):
-    ii = iter_cigar(rec)
+def iter_cigar_runs(rec):
+    """
+    Same as iter_cigar, but yields one (cigar_type, cigar_count) per CIGAR operation instead of one per base
+    """
+    cigar_list = rec.cigartuples
+    if CIGAR_DICT[cigar_list[0][0]] == 'H': cigar_list = cigar_list[1:]
+    if CIGAR_DICT[cigar_list[-1][0]] == 'H': cigar_list = cigar_list[:-1]
+
+    for _type, _count in cigar_list:
+        x = CIGAR_DICT[_type]
+        if x in ('M', '=', 'X', 'I', 'D', 'S', 'N'):
+            yield x, _count
+        else:
+            raise Exception("Unexpected cigar {0}{1} seen! Abort!".format(_count, x))
+
+def iter_cigar_w_aligned_pair(rec, writer, nonmatch_hist=None, events=None):
+    """
+    Walk the CIGAR of an alignment one operation at a time, writing one nonmatch row per I/D/X/N event
+    (writer can be None to skip the per-event table), counting the event in nonmatch_hist, if given,
+    and adding (pos0, type, type_len) of the event to the list <events>, if given
+
+    The reference position is tracked arithmetically, so the cost is per CIGAR operation, not per base.
+    NOTE: total_len adds the operation length once for every base in the operation (i.e. L*L per op),
+          and consecutive operations of the same type only count once towards total_err. This is kept
+          as-is so that map_iden stays identical to the per-base walk over rec.get_aligned_pairs().
+
+    :return: total_err, total_len
+    """
     prev_cigar_type = None
+    r_pos = rec.reference_start
     prev_r_pos = 0
     total_err = 0
     total_len = 0
-    for q_pos, r_pos in rec.get_aligned_pairs():
-        cigar_type, cigar_count = next(ii)
-        if cigar_type == 'S': # nothing to do if soft-clipped, r_pos must be None
-            assert r_pos is None
+    for cigar_type, cigar_count in iter_cigar_runs(rec):
+        if cigar_type == 'S': # nothing to do if soft-clipped
             continue
-        total_len += cigar_count
+        total_len += cigar_count * cigar_count
         if cigar_type != prev_cigar_type:
             if cigar_type in ('I', 'D', 'X', 'N'):
                 total_err += cigar_count
-                info = {'read_id': rec.qname,
-                        'pos0': r_pos if cigar_type!='I' else prev_r_pos,
-                        'type': cigar_type,
-                        'type_len': cigar_count}
-                writer.writerow(info)
+                pos0 = r_pos if cigar_type!='I' else prev_r_pos
+                if writer is not None:
+                    info = {'read_id': rec.qname,
+                            'pos0': pos0,
+                            'type': cigar_type,
+                            'type_len': cigar_count}
+                    writer.writerow(info)
+                if nonmatch_hist is not None:
+                    nonmatch_hist.add(rec.reference_name, cigar_type, pos0, cigar_count)
+                if events is not None:
+                    events.append((pos0, cigar_type, cigar_count))
             prev_cigar_type = cigar_type
-        if r_pos is not None: prev_r_pos = r_pos
+        if cigar_type != 'I': # M, =, X, D, N all consume the reference
+            r_pos += cigar_count
+            prev_r_pos = r_pos - 1
     return total_err, total_len
 
+
+def get_nonmatch_pos_bin(pos0):
+    """
+    :return: index of the NONMATCH_BIN_SIZE bin of reference position <pos0> (the bin starts at index * NONMATCH_BIN_SIZE)
+    """
+    return pos0 // NONMATCH_BIN_SIZE
+
+
+def get_nonmatch_len_category(type_len):
+    """
+    :return: index of the NONMATCH_LEN_CATEGORIES category of a nonmatch of length <type_len>
+    """
+    if type_len <= 10: return 0
+    elif type_len <= 100: return 1
+    elif type_len <= 500: return 2
+    else: return 3
+
+
+class NonmatchHistogram:
+    """
+    Pre-aggregated version of the nonmatch_stat table.
+
+    For every (reference, nonmatch type) there is one NumPy count array of
+    (# of NONMATCH_BIN_SIZE position bins) x (# of NONMATCH_LEN_CATEGORIES).
+    Events are buffered as flat array indices and added in bulk with np.bincount.
+    """
+    FLUSH_SIZE = 100000
+
+    def __init__(self, ref_lengths):
+        """
+        :param ref_lengths: dict of reference name --> reference length, only these references are counted
+        """
+        self.ref_lengths = dict(ref_lengths)
+        self.counts = {} # (ref name, type) --> np.array of shape (num_bins, num_len_categories)
+        self.pending = defaultdict(list) # (ref name, type) --> list of flat indices not yet added to counts
+        self.num_pending = 0
+
+    def get_counts(self, map_name, _type):
+        key = (map_name, _type)
+        if key not in self.counts:
+            num_bins = get_nonmatch_pos_bin(self.ref_lengths[map_name]) + 1
+            self.counts[key] = np.zeros((num_bins, len(NONMATCH_LEN_CATEGORIES)), dtype=np.int64)
+        return self.counts[key]
+
+    def add(self, map_name, _type, pos0, type_len):
+        if map_name not in self.ref_lengths:
+            return
+        len_cat = get_nonmatch_len_category(type_len)
+        pos_bin = get_nonmatch_pos_bin(min(pos0, self.ref_lengths[map_name]))
+        self.pending[(map_name, _type)].append(pos_bin * len(NONMATCH_LEN_CATEGORIES) + len_cat)
+        self.num_pending += 1
+        if self.num_pending >= self.FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        for (map_name, _type), indices in self.pending.items():
+            counts = self.get_counts(map_name, _type)
+            counts += np.bincount(indices, minlength=counts.size).reshape(counts.shape)
+        self.pending.clear()
+        self.num_pending = 0
+
+    def update(self, other):
+        """
+        Add the counts of another NonmatchHistogram (ex: from a different chunk) to this one
+        """
+        self.flush()
+        other.flush()
+        self.ref_lengths.update(other.ref_lengths)
+        for (map_name, _type), counts in other.counts.items():
+            self.get_counts(map_name, _type)[:] += counts
+
+    def write(self, filename):
+        self.flush()
+        with open(filename, 'w') as f:
+            writer = DictWriter(f, NONMATCH_HIST_FIELDS, delimiter='\t')
+            writer.writeheader()
+            for (map_name, _type) in sorted(self.counts):
+                counts = self.counts[(map_name, _type)]
+                for pos_bin, len_cat in zip(*np.nonzero(counts)):
+                    writer.writerow({'map_name': map_name,
+                                     'type': _type,
+                                     'pos0_div': pos_bin * NONMATCH_BIN_SIZE,
+                                     'type_len_cat': NONMATCH_LEN_CATEGORIES[len_cat],
+                                     'count': counts[pos_bin, len_cat]})
+
+    @classmethod
+    def read(cls, filename, ref_lengths):
+        hist = cls(ref_lengths)
+        for r in DictReader(open(filename), delimiter='\t'):
+            counts = hist.get_counts(r['map_name'], r['type'])
+            counts[get_nonmatch_pos_bin(int(r['pos0_div'])), NONMATCH_LEN_CATEGORIES.index(r['type_len_cat'])] += int(r['count'])
+        return hist
+
+
+REPORT_BIN_SIZE = 10 # bin size (bp) of the read length, mapped start/end/length and max gap histograms
+REPORT_IDEN_DIGITS = 4 # map_iden is rounded to this many digits (the report histogram bins are 0.01%)
+REPORT_SAMPLE_SIZE = 50000 # number of nonmatch events sampled for the report dot plots (ERR_SAMPLE_SIZE in plotAAVreport.R)
+REPORT_VECTOR_TYPES = ('scAAV', 'ssAAV')
+REPORT_ALIGNMENT_GROUPS = {'scAAV': 'vector', 'ssAAV': 'vector', 'repcap': 'repcap'}
+
+class ReportAggregates:
+    """
+    Streaming version of the group_by/summarise steps plotAAVreport.R runs on the summary, per_read and
+    nonmatch_stat tables, written as the small <output_prefix>.report_aggregates.json that the report
+    reads instead of the tables:
+     - read_types: reads and effective_count per assigned type and subtype
+     - read_len: read length histogram per assigned type and subtype (scAAV/ssAAV reads)
+     - alignments: map_iden, map_len, map_start0, map_end1 histograms per map_subtype of the alignments
+                   of scAAV/ssAAV (group "vector") and repcap reads
+     - nonmatch_pos, nonmatch_len: nonmatch events of scAAV/ssAAV reads by type and 10bp position bin / length category
+     - max_gap: histogram of the largest N (gap) per scAAV/ssAAV read, for reads with gaps
+     - nonmatch_sample: uniform random sample of the nonmatch events of scAAV/ssAAV reads, for the dot plots
+    Each table is stored by column.
+    """
+    def __init__(self, seed=None):
+        self.read_types = defaultdict(int) # (assigned_type, assigned_subtype, is effective count) --> count
+        self.read_len = defaultdict(int) # (assigned_type, assigned_subtype, length bin, is effective count) --> count
+        self.alignments = defaultdict(int) # (group, metric, map_subtype, value) --> count
+        self.nonmatch_pos = Counter() # (type, pos0 bin) --> count
+        self.nonmatch_len = Counter() # (type, length category) --> count
+        self.max_gap = defaultdict(int) # max gap bin --> count
+        # sample: events with the smallest random keys, as a heap of (-key, pos0, type, type_len)
+        # (keeping the smallest keys, rather than reservoir sampling, makes samples of different chunks easy to merge)
+        self.sample = []
+        self.skip = 0 # number of events to skip before the next one that goes into the (full) sample
+        self.rnd = random.Random(seed)
+
+    def add_read(self, sum_info, rows, events):
+        """
+        :param sum_info: per_read row of the read
+        :param rows: summary rows written for the read
+        :param events: (pos0, type, type_len) of the nonmatch events of all the alignments of the read
+        """
+        a_type, a_subtype = sum_info['assigned_type'], sum_info['assigned_subtype']
+        self.read_types[(a_type, a_subtype, False)] += 1
+        self.read_types[(a_type, a_subtype, True)] += sum_info['effective_count']
+        if a_type in REPORT_ALIGNMENT_GROUPS:
+            group = REPORT_ALIGNMENT_GROUPS[a_type]
+            for row in rows:
+                self.alignments[(group, 'map_iden', row['map_subtype'], round(row['map_iden'], REPORT_IDEN_DIGITS))] += 1
+                self.alignments[(group, 'map_len', row['map_subtype'], row['map_len'] // REPORT_BIN_SIZE * REPORT_BIN_SIZE)] += 1
+                self.alignments[(group, 'map_start0', row['map_subtype'], row['map_start0'] // REPORT_BIN_SIZE * REPORT_BIN_SIZE)] += 1
+                self.alignments[(group, 'map_end1', row['map_subtype'], row['map_end1'] // REPORT_BIN_SIZE * REPORT_BIN_SIZE)] += 1
+        if a_type not in REPORT_VECTOR_TYPES:
+            return
+        len_bin = sum_info['read_len'] // REPORT_BIN_SIZE * REPORT_BIN_SIZE
+        self.read_len[(a_type, a_subtype, len_bin, False)] += 1
+        self.read_len[(a_type, a_subtype, len_bin, True)] += sum_info['effective_count']
+        # same bins and length categories as NonmatchHistogram, but over all references (the report pools the events
+        # of scAAV/ssAAV reads, host alignments included, which NonmatchHistogram does not count)
+        self.nonmatch_pos.update([(_type, get_nonmatch_pos_bin(pos0) * NONMATCH_BIN_SIZE) for pos0, _type, type_len in events])
+        self.nonmatch_len.update([(_type, get_nonmatch_len_category(type_len)) for pos0, _type, type_len in events])
+        max_gap = max((type_len for pos0, _type, type_len in events if _type == 'N'), default=None)
+        if max_gap is not None:
+            self.max_gap[max_gap // REPORT_BIN_SIZE * REPORT_BIN_SIZE] += 1
+        self.add_to_sample(events)
+
+    def add_to_sample(self, events):
+        """
+        Every event gets a uniform random key, the REPORT_SAMPLE_SIZE events with the smallest keys are kept.
+        Once the sample is full, an event only gets in if its key is below the largest key t of the sample,
+        so instead of drawing a key for every event, the number of events until the next one with a key
+        below t is drawn (geometric, p=t), and that event gets a key uniform in [0, t).
+        """
+        sample, rnd = self.sample, self.rnd
+        i = 0
+        while len(sample) < REPORT_SAMPLE_SIZE and i < len(events):
+            heapq.heappush(sample, (-rnd.random(),) + events[i])
+            i += 1
+            if len(sample) == REPORT_SAMPLE_SIZE:
+                self.skip = self.draw_skip()
+        while i + self.skip < len(events):
+            i += self.skip
+            heapq.heapreplace(sample, (-rnd.random() * -sample[0][0],) + events[i])
+            i += 1
+            self.skip = self.draw_skip()
+        self.skip -= len(events) - i
+
+    def draw_skip(self):
+        t = -self.sample[0][0]
+        if t <= 0.:
+            return math.inf
+        return int(math.log(1. - self.rnd.random()) / math.log1p(-t)) if t < 1. else 0
+
+    def update(self, other):
+        """
+        Add the aggregates of another ReportAggregates (ex: from a different chunk) to this one
+        """
+        for name in ('read_types', 'read_len', 'alignments', 'nonmatch_pos', 'nonmatch_len', 'max_gap'):
+            counts = getattr(self, name)
+            for k, v in getattr(other, name).items():
+                counts[k] += v
+        self.sample = heapq.nsmallest(REPORT_SAMPLE_SIZE, self.sample + other.sample, key=lambda x: -x[0])
+        heapq.heapify(self.sample)
+
+    def to_dict(self):
+        def by_column(columns, rows):
+            return {c: [row[i] for row in rows] for i, c in enumerate(columns)}
+        def with_effective_count(counts):
+            # (..., False) --> count, (..., True) --> effective_count, in one row
+            rows = []
+            for k in sorted(x for x in counts if not x[-1]):
+                rows.append(k[:-1] + (counts[k], counts[k[:-1] + (True,)]))
+            return rows
+        sample = sorted((-key, pos0, _type, type_len) for key, pos0, _type, type_len in self.sample)
+        return {'bin_size': REPORT_BIN_SIZE,
+                'read_types': by_column(['assigned_type', 'assigned_subtype', 'count', 'effective_count'],
+                                        with_effective_count(self.read_types)),
+                'read_len': by_column(['assigned_type', 'assigned_subtype', 'read_len', 'count', 'effective_count'],
+                                      with_effective_count(self.read_len)),
+                'alignments': by_column(['group', 'metric', 'map_subtype', 'value', 'count'],
+                                        [k + (v,) for k, v in sorted(self.alignments.items())]),
+                'nonmatch_pos': by_column(['type', 'pos0_div', 'count'],
+                                          [k + (v,) for k, v in sorted(self.nonmatch_pos.items())]),
+                'nonmatch_len': by_column(['type', 'type_len_cat', 'count'],
+                                          [(t, NONMATCH_LEN_CATEGORIES[c], v) for (t, c), v in sorted(self.nonmatch_len.items())]),
+                'max_gap': by_column(['max_del_size', 'count'], sorted(self.max_gap.items())),
+                'nonmatch_sample': by_column(['key', 'pos0', 'type', 'type_len'], sample)}
+
+    def write(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def read(cls, filename):
+        with open(filename) as f:
+            d = json.load(f)
+        agg = cls()
+        def rows(name):
+            columns = list(d[name])
+            return zip(*[d[name][c] for c in columns])
+        for a_type, a_subtype, count, e_count in rows('read_types'):
+            agg.read_types[(a_type, a_subtype, False)] += count
+            agg.read_types[(a_type, a_subtype, True)] += e_count
+        for a_type, a_subtype, len_bin, count, e_count in rows('read_len'):
+            agg.read_len[(a_type, a_subtype, len_bin, False)] += count
+            agg.read_len[(a_type, a_subtype, len_bin, True)] += e_count
+        for group, metric, map_subtype, value, count in rows('alignments'):
+            agg.alignments[(group, metric, map_subtype, value)] += count
+        for _type, pos0_div, count in rows('nonmatch_pos'):
+            agg.nonmatch_pos[(_type, pos0_div)] += count
+        for _type, len_cat, count in rows('nonmatch_len'):
+            agg.nonmatch_len[(_type, NONMATCH_LEN_CATEGORIES.index(len_cat))] += count
+        for max_gap, count in rows('max_gap'):
+            agg.max_gap[max_gap] += count
+        agg.sample = [(-key, pos0, _type, type_len) for key, pos0, _type, type_len in rows('nonmatch_sample')]
+        heapq.heapify(agg.sample)
+        return agg
+
+
+def get_nonmatch_hist_ref_lengths(header, annotation):
+    """
+    Only keep nonmatch histograms for non-host references (host genomes are large and not used in the report)
+    :return: dict of reference name --> reference length
+    """
+    return {name: length for name, length in zip(header.references, header.lengths)
+            if name in annotation and annotation[name]['type'] != 'host'}
+
+
 def read_annotation_file(annot_filename):
     """
     example
@@ -173,7 +789,7 @@ def is_on_target(r, valid_start, valid_end):
 
     if abs(diff_start) <= MAX_DIFF_W_REF: # complete 5' start/left
         if abs(diff_end) <= MAX_DIFF_W_REF: # complete 3' end/right
-            for cigar_type, num in iter_cigar(r):
+            for cigar_type, num in iter_cigar_runs(r):
                 if cigar_type == 'N' and num >= TARGET_GAP_THRESHOLD:
                     #pdb.set_trace()
                     return 'full-gap'
@@ -211,60 +827,499 @@ def assign_read_type(r, annotation):
         return _type, 'NA'
 
 
-def process_alignment_bam(sorted_sam_filename, annotation, output_prefix, starting_readname=None, ending_readname=None):
+ON_TARGET_LABELS = ['NA', 'backbone', 'full', 'full-gap', 'left-partial', 'right-partial', 'partial', 'vector+backbone']
+CLASSIFY_BLOCK_SIZE = 1000 # number of reads classified together by process_alignment_bam
+
+class AnnotationRegions:
     """
-    :param sorted_sam_filename: Sorted (by read name) SAM filename
-    :param annotation:
-    :param output_prefix:
+    The annotation (see read_annotation_file) resolved to the reference IDs of a BAM header,
+    as arrays indexed by reference_id, for classify_alignments
     """
-    f1 = open(output_prefix+'.summary.csv', 'w')
-    f2 = open(output_prefix+'.nonmatch_stat.csv', 'w')
-    f3 = open(output_prefix+'.per_read.csv', 'w')
+    def __init__(self, annotation, references):
+        """
+        :param references: reference names of the BAM header, in reference_id order
+        """
+        self.references = list(references)
+        self.types = [annotation[name]['type'] if name in annotation else None for name in self.references]
+        regions = [annotation[name]['region'] if name in annotation else None for name in self.references]
+        self.has_region = np.array([x is not None for x in regions], dtype=bool)
+        self.region_start = np.array([0 if x is None else x[0] for x in regions], dtype=np.int64)
+        self.region_end = np.array([0 if x is None else x[1] for x in regions], dtype=np.int64)
+
+
+def get_max_skip(r):
+    """
+    :return: length of the longest N (skipped reference) CIGAR operation of <r>, 0 if there is none
+    """
+    if r.get_cigar_stats()[1][3] == 0: # number of N operations
+        return 0
+    return max(num for cigar_type, num in r.cigartuples if cigar_type == 3)
 
-    writer1 = DictWriter(f1, SUMMARY_FIELDS, delimiter='\t')
-    writer2 = DictWriter(f2, NONMATCH_FIELDS, delimiter='\t')
-    writer3 = DictWriter(f3, PER_READ_FIELDS, delimiter='\t')
-    writer1.writeheader()
-    writer2.writeheader()
-    writer3.writeheader()
 
-    debug_count = 0
+def classify_alignments(regions, ref_ids, starts, ends, max_skips):
+    """
+    Vectorized is_on_target for a block of alignment records
+
+    :param regions: AnnotationRegions
+    :param ref_ids, starts, ends: NumPy arrays of reference_id, reference_start, reference_end of the records
+    :param max_skips: NumPy array of the longest N operation of the records (see get_max_skip)
+    :return: NumPy array of indices into ON_TARGET_LABELS, 'NA' for references without a region
+    """
+    valid_start = regions.region_start[ref_ids]
+    valid_end = regions.region_end[ref_ids]
+    diff_start = starts - valid_start
+    diff_end = valid_end - ends
+    start_ok = np.abs(diff_start) <= MAX_DIFF_W_REF
+    start_in = diff_start > MAX_DIFF_W_REF
+    end_ok = np.abs(diff_end) <= MAX_DIFF_W_REF
+    end_in = diff_end > MAX_DIFF_W_REF
+    # same order of checks as is_on_target, anything left is vector+backbone
+    conditions = [~regions.has_region[ref_ids],
+                  (ends < valid_start) | (starts > valid_end),
+                  start_ok & end_ok & (max_skips >= TARGET_GAP_THRESHOLD),
+                  start_ok & end_ok,
+                  start_ok & end_in,
+                  start_in & end_ok,
+                  start_in & end_in]
+    choices = [ON_TARGET_LABELS.index(x) for x in ('NA', 'backbone', 'full-gap', 'full', 'left-partial', 'right-partial', 'partial')]
+    return np.select(conditions, choices, default=ON_TARGET_LABELS.index('vector+backbone'))
+
+
+def assign_read_types(records, regions):
+    """
+    Same as assign_read_type for every mapped record of <records>, classified together with classify_alignments
+
+    :param records: list of alignment records
+    :param regions: AnnotationRegions of the BAM header of <records>
+    :return: list of (type, subtype) for each record, None for unmapped records
+    """
+    mapped = [r for r in records if not r.is_unmapped]
+    if len(mapped) == 0:
+        return [None] * len(records)
+    ref_ids = np.fromiter((r.reference_id for r in mapped), dtype=np.int64, count=len(mapped))
+    for i in np.unique(ref_ids):
+        if regions.types[i] is None:
+            raise Exception("{0} is not in the annotation file. Abort!".format(regions.references[i]))
+    starts = np.fromiter((r.reference_start for r in mapped), dtype=np.int64, count=len(mapped))
+    ends = np.fromiter((r.reference_end for r in mapped), dtype=np.int64, count=len(mapped))
+    max_skips = np.fromiter((get_max_skip(r) for r in mapped), dtype=np.int64, count=len(mapped))
+    labels = classify_alignments(regions, ref_ids, starts, ends, max_skips)
+    mapped_types = iter(zip([regions.types[i] for i in ref_ids.tolist()], [ON_TARGET_LABELS[i] for i in labels.tolist()]))
+    return [None if r.is_unmapped else next(mapped_types) for r in records]
+
+
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+BGZF_SEARCH_SIZE = 1 << 18 # bytes to scan for the next BGZF block header
+BGZF_MAX_BLOCKS = 8 # max number of BGZF blocks to decompress when looking for the first record in a shard
+BAM_RECORD_CHECK_COUNT = 3 # number of consecutive BAM records that must parse to accept a record start
+
+def is_plain_sam(reader):
+    return reader.format == 'SAM' and reader.compression == 'NONE'
+
+def get_first_record_offset(filename, reader):
+    """
+    :return: offset of the first alignment record, BGZF virtual offset for BAM or byte offset for uncompressed SAM
+    """
+    if is_plain_sam(reader):
+        offset = 0
+        with open(filename, 'rb') as f:
+            for line in f:
+                if not line.startswith(b'@'): break
+                offset += len(line)
+        return offset
+    else:
+        # nothing has been read from a freshly opened reader except the header
+        return reader.tell()
 
-    reader = pysam.AlignmentFile(sorted_sam_filename, check_sq=False)
-    bam_writer = pysam.AlignmentFile(output_prefix+'.tagged.bam', 'wb', header=reader.header)
+def read_bgzf_blocks(f, block_offset, max_blocks):
+    """
+    Decompress up to <max_blocks> consecutive BGZF blocks starting at the file (compressed) offset <block_offset>
+    :return: list of (block_offset, uncompressed data), stops early at EOF or at a malformed block
+    """
+    blocks = []
+    f.seek(block_offset)
+    while len(blocks) < max_blocks:
+        header = f.read(18)
+        if len(header) < 18 or header[:4] != BGZF_MAGIC or header[10:12] != b'\x06\x00' or header[12:16] != b'BC\x02\x00':
+            break
+        block_size = struct.unpack('<H', header[16:18])[0] + 1
+        rest = f.read(block_size - 18)
+        if len(rest) < block_size - 18:
+            break
+        try:
+            data = zlib.decompress(rest[:-8], -15)
+        except zlib.error:
+            break
+        crc, isize = struct.unpack('<II', rest[-8:])
+        if isize != len(data) or zlib.crc32(data) != crc:
+            break
+        blocks.append((block_offset, data))
+        block_offset += block_size
+        if len(data) == 0: # BGZF EOF marker
+            break
+    return blocks
+
+def find_next_bgzf_block(f, offset):
+    """
+    :return: file offset of the first valid BGZF block at or after <offset>, or None if there is none
+    """
+    f.seek(offset)
+    while True:
+        buf = f.read(BGZF_SEARCH_SIZE + 18)
+        if len(buf) < 18:
+            return None
+        i = buf.find(BGZF_MAGIC)
+        while i >= 0:
+            if len(read_bgzf_blocks(f, offset + i, 1)) > 0:
+                return offset + i
+            i = buf.find(BGZF_MAGIC, i + 1)
+        offset += BGZF_SEARCH_SIZE
+        f.seek(offset)
+
+def is_valid_bam_record_chain(data, p, num_refs):
+    """
+    Check that parsing BAM records from <data> at position <p> gives BAM_RECORD_CHECK_COUNT sane records
+    (or sane records up to the end of the data, if at least one is complete)
+    """
+    num_ok = 0
+    while num_ok < BAM_RECORD_CHECK_COUNT:
+        if p + 36 > len(data):
+            return num_ok > 0
+        block_size, ref_id, pos, l_read_name, mapq, _bin, n_cigar_op, flag, l_seq, next_ref_id, next_pos, tlen = \
+            struct.unpack('<iiiBBHHHiiii', data[p:p+36])
+        if not (-1 <= ref_id < num_refs and -1 <= next_ref_id < num_refs and pos >= -1 and next_pos >= -1):
+            return False
+        if l_read_name < 2 or l_seq < 0 or \
+                block_size < 32 + l_read_name + 4*n_cigar_op + (l_seq+1)//2 + l_seq:
+            return False
+        if p + 36 + l_read_name <= len(data):
+            read_name = data[p+36:p+36+l_read_name]
+            if read_name[-1] != 0 or any(c < 33 or c > 126 for c in read_name[:-1]):
+                return False
+        else:
+            return num_ok > 0
+        p += 4 + block_size
+        num_ok += 1
+    return True
 
-    if starting_readname is not None:
-        # progress forward until we get to the read
+def guess_bam_record_start(filename, offset, num_refs):
+    """
+    Find a BAM record start at or after the file (compressed) offset <offset>
+    :return: BGZF virtual offset of the record, or None if there is no record after <offset>
+    """
+    with open(filename, 'rb') as f:
+        block_offset = find_next_bgzf_block(f, offset)
+        if block_offset is None:
+            return None
+        blocks = read_bgzf_blocks(f, block_offset, BGZF_MAX_BLOCKS)
+    data = b''.join(block for _, block in blocks)
+    block_start = 0
+    for block_offset, block in blocks:
+        for u in range(len(block)):
+            if is_valid_bam_record_chain(data, block_start + u, num_refs):
+                return (block_offset << 16) | u
+        block_start += len(block)
+    return None
+
+def find_next_read_start(reader, filename, offset):
+    """
+    Starting at the record at <offset>, find the first record that belongs to a different read.
+    :return: offset of that record or None if there is none
+    """
+    if is_plain_sam(reader):
+        with open(filename, 'rb') as f:
+            f.seek(offset)
+            if offset > 0: # we may have landed in the middle of a line
+                f.seek(offset - 1)
+                offset += len(f.readline()) - 1
+            first_qname = None
+            for line in f:
+                qname = line.split(b'\t', 1)[0]
+                if first_qname is None:
+                    first_qname = qname
+                elif qname != first_qname:
+                    return offset
+                offset += len(line)
+        return None
+    else:
+        reader.seek(offset)
+        first_qname = None
         while True:
+            offset = reader.tell()
             try:
-                cur_r = next(reader)
-                if cur_r.qname == starting_readname:
-                    records = [cur_r]
-                    break
+                r = next(reader)
+            except StopIteration:
+                return None
+            if first_qname is None:
+                first_qname = r.qname
+            elif r.qname != first_qname:
+                return offset
+
+def get_shard_offsets(filename, num_chunks):
+    """
+    Divide a read name-sorted SAM/BAM file into (up to) <num_chunks> shards without splitting any read.
+
+    BAM: seek to byte fractions of the file, find the next BAM record and align it to the next read name change.
+    Uncompressed SAM: same, using byte offsets of lines.
+    Other formats: one pass over the records, recording the offset of every read name change.
+
+    :return: list of (start_offset, end_offset) where end_offset is None for the last shard
+    """
+    reader = pysam.AlignmentFile(filename, check_sq=False)
+    first_offset = get_first_record_offset(filename, reader)
+    boundaries = [first_offset]
+    if reader.format == 'BAM' or is_plain_sam(reader):
+        file_size = os.path.getsize(filename)
+        for i in range(1, num_chunks):
+            offset = file_size * i // num_chunks
+            if is_plain_sam(reader):
+                offset = max(offset, first_offset)
+            else:
+                offset = guess_bam_record_start(filename, max(offset, first_offset >> 16), len(reader.references))
+                if offset is None: break
+            offset = find_next_read_start(reader, filename, max(offset, boundaries[-1]))
+            if offset is None: break
+            if offset > boundaries[-1]:
+                boundaries.append(offset)
+    else:
+        read_offsets = []
+        prev_qname = None
+        while True:
+            offset = reader.tell()
+            try:
+                r = next(reader)
             except StopIteration:
                 break
+            if r.qname != prev_qname:
+                read_offsets.append(offset)
+                prev_qname = r.qname
+        chunk_size = (len(read_offsets) // num_chunks) + 1
+        boundaries = read_offsets[::chunk_size] if len(read_offsets) > 0 else boundaries
+    reader.close()
+    return list(zip(boundaries, boundaries[1:] + [None]))
+
+def iter_alignment_records(reader, filename, start_offset=None, end_offset=None):
+    """
+    Iterate over the alignment records in [start_offset, end_offset) as given by get_shard_offsets
+    None means the start/end of the file.
+    """
+    if start_offset is None and end_offset is None:
+        yield from reader
+    elif is_plain_sam(reader):
+        if start_offset is None:
+            start_offset = get_first_record_offset(filename, reader)
+        with open(filename, 'rb') as f:
+            f.seek(start_offset)
+            offset = start_offset
+            for line in f:
+                if end_offset is not None and offset >= end_offset: break
+                offset += len(line)
+                yield pysam.AlignedSegment.fromstring(line.decode().rstrip('\r\n'), reader.header)
     else:
-        records = [next(reader)] # records will hold all the multiple alignment records of the same read
+        if start_offset is not None:
+            reader.seek(start_offset)
+        while end_offset is None or reader.tell() < end_offset:
+            try:
+                yield next(reader)
+            except StopIteration:
+                break
+
+def get_sort_order(header):
+    """
+    :return: SO of the @HD header line (queryname, coordinate, unsorted or unknown)
+    """
+    return header.to_dict().get('HD', {}).get('SO', 'unknown')
 
+def get_file_sort_order(filename):
+    """
+    :return: SO of the @HD header line of SAM/BAM file <filename>, see get_sort_order
+    """
+    with pysam.AlignmentFile(filename, check_sq=False) as f:
+        return get_sort_order(f.header)
+
+def iter_queued_records(record_queue, header):
+    """
+    Iterate over the alignment records of the batches (lists of SAM lines) sent by run_processing_stream, until None
+    """
     while True:
-        try:
-            cur_r = next(reader)
-            if ending_readname is not None and cur_r.qname == ending_readname:
-                break
-            if cur_r.qname != records[-1].qname:
-                process_alignment_records_for_a_read(records, annotation, writer1, writer2, writer3, bam_writer)
-                records = [cur_r]
-            else:
-                records.append(cur_r)
-        except StopIteration: # finished reading the SAM file
-            break
+        batch = record_queue.get()
+        if batch is None:
+            return
+        for line in batch:
+            yield pysam.AlignedSegment.fromstring(line, header)
+
+def is_read_sampled(qname, random_frac):
+    """
+    Deterministic subsample by read name hash: the same reads are kept by every run, mode (--cpus, stream, ...)
+    and script, and all the records of a read are kept or dropped together
+    """
+    return zlib.crc32(qname.encode()) < random_frac * 0x100000000
+
+def iter_sampled_records(records, random_frac=1., max_reads=None):
+    """
+    Yield the records of the reads kept by is_read_sampled (the records of each read must be together),
+    stopping once <max_reads> reads were yielded
+    """
+    num_reads = 0
+    qname = None
+    keep = False
+    for r in records:
+        if r.qname != qname:
+            qname = r.qname
+            keep = random_frac >= 1 or is_read_sampled(qname, random_frac)
+            if keep:
+                if max_reads is not None and num_reads >= max_reads:
+                    return
+                num_reads += 1
+        if keep:
+            yield r
+
+def split_max_reads(max_reads, num_chunks):
+    """
+    :return: --max_reads of each of <num_chunks> chunks (None if <max_reads> is None)
+    """
+    if max_reads is None:
+        return [None] * num_chunks
+    return [max_reads // num_chunks + (i < max_reads % num_chunks) for i in range(num_chunks)]
+
+
+def process_alignment_bam(sorted_sam_filename, annotation, output_prefix, start_offset=None, end_offset=None, nonmatch_hist=False, event_table=True, gzip_nonmatch=False, split_categories=False, sort_mem=SORT_MEM, table_format='tsv', io_threads=IO_THREADS, flipflop=False, profile=False, cprofile=False, report_aggregates=False, header=None, record_queue=None, partitions=None, random_frac=1., max_reads=None):
+    """
+    :param sorted_sam_filename: Sorted (by read name) SAM filename, - for stdin (ignored if <record_queue> is given)
+    :param annotation:
+    :param output_prefix:
+    :param start_offset: if given, start from this offset (see get_shard_offsets), otherwise the start of the file
+    :param end_offset: if given, stop before this offset (see get_shard_offsets), otherwise the end of the file
+    :param nonmatch_hist: if True, also write the pre-aggregated <output_prefix>.nonmatch_hist.csv
+    :param event_table: if False, do not write the per-event <output_prefix>.nonmatch_stat.csv
+    :param gzip_nonmatch: if True, write <output_prefix>.nonmatch_stat.csv.gz instead, with the header as its own gzip member
+    :param split_categories: if True, also write the records of each subset category (see CategoryBamWriter)
+    :param sort_mem: in-memory budget for keeping the subset category records to write them coordinate-sorted
+    :param table_format: tsv (<output_prefix>.summary.csv, ...) or parquet (<output_prefix>.summary.parquet, ...)
+    :param io_threads: BGZF (de)compression threads for the input and <output_prefix>.tagged.bam (the category and flip-flop BAM files get none)
+    :param flipflop: if True, also call ITR flip/flop configurations, same outputs as get_flipflop_config.py <output_prefix>.tagged.bam
+    :param profile: if True, write the per-stage profile of this call to <output_prefix>.worker_profile.json (see aav_profiling)
+    :param cprofile: if True, write cProfile stats of this call to <output_prefix>.pstats
+    :param report_aggregates: if True, also write <output_prefix>.report_aggregates.json (see ReportAggregates)
+    :param header: header (as a dict) of the records from <record_queue>
+    :param record_queue: if given, process the batches of reads sent by run_processing_stream instead of reading a file
+    :param partitions: if given, process these read name hash partitions (see partition_by_read_name) instead of reading a file
+    :param random_frac: if < 1, only process the reads kept by is_read_sampled
+    :param max_reads: if given, stop after this many (sampled) reads
+    :return: per_read table filename, tagged BAM filename
+    """
+    global PROFILER
+    if profile:
+        caller_profiler = PROFILER
+        PROFILER = StageProfiler(os.path.basename(output_prefix))
+    if cprofile:
+        import cProfile
+        cprofiler = cProfile.Profile()
+        cprofiler.enable()
+
+    writer1 = open_table_writer(output_prefix+'.summary', SUMMARY_FIELDS, table_format)
+    writer3 = open_table_writer(output_prefix+'.per_read', PER_READ_FIELDS, table_format)
+    if event_table:
+        writer2 = PROFILER.wrap(open_table_writer(output_prefix+'.nonmatch_stat', NONMATCH_FIELDS, table_format, gzip_members=gzip_nonmatch), 'table_write')
+    else:
+        writer2 = None
+    writer1 = PROFILER.wrap(writer1, 'table_write')
+    writer3 = PROFILER.wrap(writer3, 'table_write')
+
+    debug_count = 0
+
+    if record_queue is not None:
+        header = pysam.AlignmentHeader.from_dict(header)
+        input_records = iter_queued_records(record_queue, header)
+    elif partitions is not None:
+        with pysam.AlignmentFile(partitions[0], check_sq=False) as reader:
+            header = reader.header
+        input_records = iter_partition_records(partitions, io_threads)
+    else:
+        reader = pysam.AlignmentFile(sorted_sam_filename, check_sq=False, threads=io_threads)
+        header = reader.header
+        if get_sort_order(header) == 'coordinate':
+            # the records of a read are not together, see run_processing_partitioned
+            raise Exception("{0} is coordinate-sorted, the records of each read must be together (sort by read name). Abort!".format(sorted_sam_filename))
+        input_records = iter_alignment_records(reader, sorted_sam_filename, start_offset, end_offset)
+    if random_frac < 1 or max_reads is not None:
+        input_records = iter_sampled_records(input_records, random_frac, max_reads)
+    bam_writer = PROFILER.wrap(pysam.AlignmentFile(output_prefix+'.tagged.bam', 'wb', header=header, threads=io_threads), 'bam_encode')
+    hist = NonmatchHistogram(get_nonmatch_hist_ref_lengths(header, annotation)) if nonmatch_hist else None
+    if split_categories:
+        category_writers = {c: PROFILER.wrap(w, 'category_bam')
+                            for c, w in open_category_writers(output_prefix, header, sort_mem).items()}
+    else:
+        category_writers = None
+    if flipflop:
+        from get_flipflop_config import FlipFlopWriter # imported here, get_flipflop_config imports this module
+        flipflop_writer = FlipFlopWriter(output_prefix, header)
+    else:
+        flipflop_writer = None
+    report = ReportAggregates(seed=os.path.basename(output_prefix)) if report_aggregates else None
+
+    regions = AnnotationRegions(annotation, header.references)
+    def process_block(block):
+        # classify the alignments of a block of reads together, then summarize each read
+        with PROFILER.stage('classify_alignment', count=sum(len(records) for records in block)):
+            read_types = assign_read_types([r for records in block for r in records], regions)
+        i = 0
+        for records in block:
+            process_alignment_records_for_a_read(records, annotation, writer1, writer2, writer3, bam_writer, hist, category_writers, flipflop_writer,
+                                                 read_types[i:i+len(records)], report)
+            i += len(records)
+            PROFILER.progress()
+
+    block = [] # block of reads, each a list of records
+    records = [] # records will hold all the multiple alignment records of the same read
+    for cur_r in PROFILER.iter('bam_decode', input_records):
+        if len(records) > 0 and cur_r.qname != records[-1].qname:
+            block.append(records)
+            if len(block) >= CLASSIFY_BLOCK_SIZE:
+                process_block(block)
+                block = []
+            records = [cur_r]
+        else:
+            records.append(cur_r)
 
-    process_alignment_records_for_a_read(records, annotation, writer1, writer2, writer3, bam_writer)
+    if len(records) > 0:
+        block.append(records)
+    if len(block) > 0:
+        process_block(block)
     bam_writer.close()
-    f1.close()
-    f2.close()
-    f3.close()
-    return f3.name, output_prefix+'.tagged.bam'
+    if flipflop_writer is not None:
+        flipflop_writer.close()
+        from get_flipflop_config import print_itr_call_counts
+        print_itr_call_counts(flipflop_writer.get_call_counts(), output_prefix)
+    if category_writers is not None:
+        for writer in category_writers.values():
+            writer.close()
+    writer1.close()
+    writer3.close()
+    if writer2 is not None:
+        writer2.close()
+    if hist is not None:
+        hist.write(output_prefix+'.nonmatch_hist.csv')
+    if report is not None:
+        report.write(output_prefix+'.report_aggregates.json')
+    if cprofile:
+        cprofiler.disable()
+        cprofiler.dump_stats(output_prefix+'.pstats')
+    if profile:
+        PROFILER.write(output_prefix+'.worker_profile.json')
+        PROFILER = caller_profiler
+    return get_table_filename(output_prefix+'.per_read', table_format), output_prefix+'.tagged.bam'
+
+def collect_worker_profiles(prefixes):
+    """
+    :return: list of the profiles written by process_alignment_bam(<prefix>, ..., profile=True), which are then deleted
+    """
+    profiles = []
+    for o in prefixes:
+        with open(o+'.worker_profile.json') as f:
+            profiles.append(json.load(f))
+        os.remove(o+'.worker_profile.json')
+    return profiles
 
 MIN_PRIM_SUPP_COV = 0.8 # at minimum the total of prim + main supp should cover this much of the original sequence
 def find_companion_supp_to_primary(prim, supps):
@@ -312,26 +1367,46 @@ def find_companion_supp_to_primary(prim, supps):
 
 def add_assigned_types_to_record(r, a_type, a_subtype):
     """
-    Add BAM tags
+    Add BAM tags, in place (existing tags of the same name are replaced)
     AT tag <type:scAAV|ssAAV|unknown>
-    AS tag <type:>
-    AX tag which is "AT-AX"
+    AY tag <subtype:full|left-partial|...> (not AS, which is the alignment score of the aligner)
+    AX tag which is "AT-AY"
+
+    :return: the same record
     """
-    d = r.to_dict()
-    d['tags'].append('AT:Z:'+a_type)
-    d['tags'].append('AS:Z:'+a_subtype)
-    d['tags'].append('AX:Z:'+a_type+'-'+a_subtype)
-    return d
+    r.set_tag('AT', a_type, 'Z')
+    r.set_tag('AY', a_subtype, 'Z')
+    r.set_tag('AX', a_type+'-'+a_subtype, 'Z')
+    return r
+
+def add_read_types_to_record(r, assigned_type, assigned_subtype):
+    """
+    Add BAM tags for the read-level assignment (same as assigned_type/assigned_subtype in the per_read table), in place
+    AG tag <assigned_type>
+    AH tag <assigned_subtype>
+
+    :return: the same record
+    """
+    r.set_tag('AG', assigned_type, 'Z')
+    r.set_tag('AH', assigned_subtype, 'Z')
+    return r
 
-def process_alignment_records_for_a_read(records, annotation, writer1, writer2, writer3, bam_writer):
+def process_alignment_records_for_a_read(records, annotation, writer1, writer2, writer3, bam_writer, nonmatch_hist=None, category_writers=None, flipflop_writer=None, read_types=None, report=None):
     """
     For each, find the most probable assignment, prioritizing vector > rep/cap > helper > host
 
     :param records: list of alignment records for the same read
+    :param writer2: writer for the nonmatch_stat table, can be None
+    :param nonmatch_hist: NonmatchHistogram to count the nonmatch events in, can be None
+    :param category_writers: dict of subset category (see get_subset_category) --> BAM writer, can be None
+    :param flipflop_writer: get_flipflop_config.FlipFlopWriter to call ITR flip/flop on the scAAV/ssAAV records, can be None
+    :param read_types: (type, subtype) of each record as given by assign_read_types, if None assign_read_type is called for each record
+    :param report: ReportAggregates to add the read to, can be None
     :return:
     """
     read_tally = {'primary': None, 'supp': []}
-    for r in records:
+    events = [] if report is not None else None
+    for i, r in enumerate(records):
         # check ccs id format is <movie>/<zmw>/ccs[/rev or /fwd]
         if ccs_rex.fullmatch(r.qname) is None:
             print("WARNING: sequence ID does not follow format movie/zmw/ccs[/rev or /fwd]. Might undercount ssAAV!")
@@ -363,10 +1438,15 @@ def process_alignment_records_for_a_read(records, annotation, writer1, writer2,
             info['map_start0'] = r.reference_start
             info['map_end1'] = r.reference_end
             info['map_len'] = r.reference_end - r.reference_start
-            total_err, total_len = iter_cigar_w_aligned_pair(r, writer2)
+            with PROFILER.stage('cigar_walk'):
+                total_err, total_len = iter_cigar_w_aligned_pair(r, writer2, nonmatch_hist, events)
             info['map_iden'] = 1 - total_err*1./total_len
 
-            a_type, a_subtype = assign_read_type(r, annotation)
+            if read_types is not None:
+                a_type, a_subtype = read_types[i]
+            else:
+                with PROFILER.stage('classify_alignment'):
+                    a_type, a_subtype = assign_read_type(r, annotation)
             info['map_type'] = a_type
             info['map_subtype'] = a_subtype
             if DEBUG_GLOBAL_FLAG:
@@ -380,6 +1460,7 @@ def process_alignment_records_for_a_read(records, annotation, writer1, writer2,
         #writer1.writerow(info) # not writing here -- writing later when we rule out non-compatible subs
 
     # summarize it per read, now that all relevant alignments have been processed
+    PROFILER.start('classify_read')
     prim = read_tally['primary']
     supps = read_tally['supp']
 
@@ -390,16 +1471,16 @@ def process_alignment_records_for_a_read(records, annotation, writer1, writer2,
         # supp could be None, in which case there is best matching supp!
         # in the case supp is None we wanna see if this is a weird read (ex: mapped twice to + strand)
 
-    # write the assigned type / subtype to the new BAM output
-    bam_writer.write(pysam.AlignedSegment.from_dict(
-        add_assigned_types_to_record(prim['rec'], prim['map_type'], prim['map_subtype']), prim['rec'].header))
+    # add the assigned type / subtype to the records, they are written to the new BAM output once the read is summarized
+    tagged_records = [add_assigned_types_to_record(prim['rec'], prim['map_type'], prim['map_subtype'])]
     del prim['rec']
     writer1.writerow(prim)
+    summary_rows = [prim]
     if supp is not None:
-        bam_writer.write(pysam.AlignedSegment.from_dict(
-            add_assigned_types_to_record(supp['rec'], supp['map_type'], supp['map_subtype']), supp['rec'].header))
+        tagged_records.append(add_assigned_types_to_record(supp['rec'], supp['map_type'], supp['map_subtype']))
         del supp['rec']
         writer1.writerow(supp)
+        summary_rows.append(supp)
 
     sum_info = {'read_id': prim['read_id'],
                 'read_len': prim['read_len'],
@@ -468,150 +1549,841 @@ def process_alignment_records_for_a_read(records, annotation, writer1, writer2,
     writer3.writerow(sum_info)
     if DEBUG_GLOBAL_FLAG:
         print(sum_info)
+    PROFILER.stop()
+    if report is not None:
+        with PROFILER.stage('report_aggregates'):
+            report.add_read(sum_info, summary_rows, events)
+
+    for r in tagged_records:
+        add_read_types_to_record(r, sum_info['assigned_type'], sum_info['assigned_subtype'])
+        bam_writer.write(r)
+        if flipflop_writer is not None:
+            with PROFILER.stage('flipflop'):
+                flipflop_writer.add(r, sum_info['assigned_type'])
+
+    if category_writers is not None:
+        # same as subset_sam_by_readname_list: the per-read assigned type / subtype replace the per-alignment tags
+        # (the records were already written to bam_writer, so changing them in place is safe)
+        writer = category_writers[get_subset_category(sum_info['assigned_type'], sum_info['assigned_subtype'])]
+        for r in tagged_records:
+            writer.write(add_assigned_types_to_record(r, sum_info['assigned_type'], sum_info['assigned_subtype']))
     #pdb.set_trace()
 
 
-def run_processing_parallel(sorted_sam_filename, d, output_prefix, num_chunks=1):
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+COPY_BUFFER_SIZE = 1 << 20
+
+def copy_file_range(h, out, start, end):
+    """
+    Copy bytes [start, end) of the open binary file <h> to <out>
+    """
+    h.seek(start)
+    remaining = end - start
+    while remaining > 0:
+        buf = h.read(min(COPY_BUFFER_SIZE, remaining))
+        if len(buf) == 0: break
+        out.write(buf)
+        remaining -= len(buf)
+
+def concat_bam_files(in_bams, out_bam):
+    """
+    Concatenate BAM files that share the same header without decoding records (like `samtools cat`).
+    The header and records of the first file are copied as is, the BGZF blocks after the header of the
+    other files are appended, followed by a single BGZF EOF marker.
+    """
+    with open(out_bam, 'wb') as out:
+        for i, in_bam in enumerate(in_bams):
+            reader = pysam.AlignmentFile(in_bam, 'rb', check_sq=False)
+            first_record_offset = reader.tell()
+            reader.close()
+            if (first_record_offset & 0xffff) != 0:
+                # header does not end on a BGZF block boundary, cannot copy blocks; should not happen with htslib
+                raise Exception("Header of {0} does not end on a BGZF block boundary. Abort!".format(in_bam))
+            file_size = os.path.getsize(in_bam)
+            with open(in_bam, 'rb') as h:
+                h.seek(max(0, file_size - len(BGZF_EOF)))
+                if h.read() == BGZF_EOF:
+                    file_size -= len(BGZF_EOF)
+                copy_file_range(h, out, 0 if i == 0 else first_record_offset >> 16, file_size)
+        out.write(BGZF_EOF)
+
+def copy_text_table(in_filename, out, skip_header):
+    """
+    Byte-level copy of a text table to the binary file <out>, optionally skipping the header line
+    """
+    with open(in_filename, 'rb') as h:
+        if skip_header:
+            h.readline()
+        shutil.copyfileobj(h, out, COPY_BUFFER_SIZE)
+
+def copy_gzip_table(in_filename, out, skip_header):
+    """
+    Byte-level copy of a gzipped table written by process_alignment_bam(..., gzip_nonmatch=True),
+    optionally skipping the first gzip member (which holds only the header line)
+    """
+    with open(in_filename, 'rb') as h:
+        start = 0
+        if skip_header:
+            d = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            buf = h.read(COPY_BUFFER_SIZE)
+            d.decompress(buf)
+            start = len(buf) - len(d.unused_data)
+        copy_file_range(h, out, start, os.path.getsize(in_filename))
+
+FLIPFLOP_BAM_NAMES = ['.vector-full-flipflop.bam', '.vector-leftpartial-flipflop.bam', '.vector-rightpartial-flipflop.bam']
+
+def merge_chunk_outputs(output_prefix, num_chunks, d, nonmatch_hist=False, event_table=True, table_format='tsv', flipflop=False, report_aggregates=False):
+    """
+    Combine the chunk outputs <output_prefix>.<i> (i=1..num_chunks) of process_alignment_bam
+    into <output_prefix>.*, then delete the chunk outputs.
+    TSV tables and BAM files are combined by copying bytes, nothing is decoded or re-compressed.
+    Parquet tables are combined row group by row group.
+    """
+    chunk_prefixes = [output_prefix + '.' + str(i + 1) for i in range(num_chunks)]
+    table_names = ['.per_read', '.summary'] + (['.nonmatch_stat'] if event_table else [])
+
+    if DEBUG_GLOBAL_FLAG:
+        print("Combining chunk data...")
+    for name in table_names:
+        gzipped = (name == '.nonmatch_stat')
+        out_filename = get_table_filename(output_prefix + name, table_format, gzipped)
+        in_filenames = [get_table_filename(o + name, table_format, gzipped) for o in chunk_prefixes]
+        if table_format == 'parquet':
+            concat_parquet_files(in_filenames, out_filename)
+        else:
+            with open(out_filename, 'wb') as out:
+                for i, in_filename in enumerate(in_filenames):
+                    if gzipped:
+                        copy_gzip_table(in_filename, out, skip_header=(i > 0))
+                    else:
+                        copy_text_table(in_filename, out, skip_header=(i > 0))
+    concat_bam_files([o + '.tagged.bam' for o in chunk_prefixes], output_prefix + '.tagged.bam')
+    if flipflop:
+        with open(output_prefix + '.flipflop_assignments.txt', 'wb') as out:
+            for i, o in enumerate(chunk_prefixes):
+                copy_text_table(o + '.flipflop_assignments.txt', out, skip_header=(i > 0))
+        for name in FLIPFLOP_BAM_NAMES:
+            concat_bam_files([o + name for o in chunk_prefixes], output_prefix + name)
+    if nonmatch_hist:
+        reader = pysam.AlignmentFile(output_prefix + '.tagged.bam', 'rb', check_sq=False)
+        hist_ref_lengths = get_nonmatch_hist_ref_lengths(reader.header, d)
+        reader.close()
+        hist = NonmatchHistogram(hist_ref_lengths)
+        for o in chunk_prefixes:
+            hist.update(NonmatchHistogram.read(o + '.nonmatch_hist.csv', hist_ref_lengths))
+        hist.write(output_prefix + '.nonmatch_hist.csv')
+    if report_aggregates:
+        report = ReportAggregates()
+        for o in chunk_prefixes:
+            report.update(ReportAggregates.read(o + '.report_aggregates.json'))
+        report.write(output_prefix + '.report_aggregates.json')
+
+    # delete the chunk data
+    if DEBUG_GLOBAL_FLAG:
+        print("Data combining complete. Deleting chunk data.")
+    for o in chunk_prefixes:
+        for name in table_names:
+            os.remove(get_table_filename(o + name, table_format, gzipped=(name == '.nonmatch_stat')))
+        if nonmatch_hist:
+            os.remove(o + '.nonmatch_hist.csv')
+        if report_aggregates:
+            os.remove(o + '.report_aggregates.json')
+        if flipflop:
+            os.remove(o + '.flipflop_assignments.txt')
+            for name in FLIPFLOP_BAM_NAMES:
+                os.remove(o + name)
+        os.remove(o + '.tagged.bam')
 
-    reader = pysam.AlignmentFile(open(sorted_sam_filename), check_sq=False)
-    readname_list = [next(reader).qname]
-    for r in reader:
-        if r.qname!=readname_list[-1]:
-            readname_list.append(r.qname)
 
-    total_num_reads = len(readname_list)
-    chunk_size = (total_num_reads // num_chunks) + 1
-    print(f"Total {total_num_reads} reads, dividing into {num_chunks} chunks of size {chunk_size}...")
+def get_flipflop_settings():
+    """
+    :return: the ITR sequences (see read_flip_flop_fasta) and search windows the flip/flop calls depend on
+    """
+    import get_flipflop_config as ff # imported here, get_flipflop_config imports this module
+    return [ff.SEQ_LEFT_FLIP, ff.SEQ_LEFT_FLOP, ff.SEQ_RIGHT_FLIP, ff.SEQ_RIGHT_FLOP,
+            ff.ITR_LEFT_WINDOW_PAD, ff.ITR_RIGHT_WINDOW_PAD]
+
+CHECKPOINT_VERSION = 1 # bump when the chunk outputs change, so that older checkpoints are not resumed
+
+def get_file_checksum(filename):
+    """
+    :return: dict of size and CRC32 of <filename>
+    """
+    crc = 0
+    with open(filename, 'rb') as f:
+        while True:
+            data = f.read(COPY_BUFFER_SIZE)
+            if len(data) == 0: break
+            crc = zlib.crc32(data, crc)
+    return {'size': os.path.getsize(filename), 'crc32': crc}
+
+def get_chunk_output_files(chunk_prefix, params):
+    """
+    :param params: dict of the process_alignment_bam options of the chunk (see run_processing_parallel)
+    :return: the existing outputs of process_alignment_bam(..., <chunk_prefix>, gzip_nonmatch=True) that are merged
+             (same names as merge_chunk_outputs and sort_and_index_category_bam, profiles are not included)
+    """
+    table_names = ['.per_read', '.summary'] + (['.nonmatch_stat'] if params['event_table'] else [])
+    files = [get_table_filename(chunk_prefix + name, params['table_format'], gzipped=(name == '.nonmatch_stat')) for name in table_names]
+    files.append(chunk_prefix + '.tagged.bam')
+    if params['nonmatch_hist']:
+        files.append(chunk_prefix + '.nonmatch_hist.csv')
+    if params['report_aggregates']:
+        files.append(chunk_prefix + '.report_aggregates.json')
+    if params['flipflop']:
+        files.append(chunk_prefix + '.flipflop_assignments.txt')
+        files += [chunk_prefix + name for name in FLIPFLOP_BAM_NAMES]
+    if params['split_categories']:
+        for c in SUBSET_CATEGORIES:
+            files += [chunk_prefix + '.' + c + '.tagged.sorted.bam', chunk_prefix + '.' + c + '.tagged.bam']
+    return sorted(f for f in files if os.path.exists(f))
+
+def get_checkpoint_run_info(sorted_sam_filename, d, num_chunks, params):
+    """
+    :param params: dict of the process_alignment_bam options that change the chunk outputs
+    :return: what a checkpoint must match to be resumed: tool version, input file, annotation, classification and ITR settings, options
+    """
+    info = {'version': CHECKPOINT_VERSION,
+            'tool_version': __version__,
+            'input': {'filename': os.path.abspath(sorted_sam_filename),
+                      'size': os.path.getsize(sorted_sam_filename),
+                      'mtime': os.path.getmtime(sorted_sam_filename)},
+            'annotation': d,
+            'num_chunks': num_chunks,
+            'max_diff_w_ref': MAX_DIFF_W_REF,
+            'target_gap_threshold': TARGET_GAP_THRESHOLD,
+            'min_prim_supp_cov': MIN_PRIM_SUPP_COV,
+            'params': params}
+    if params.get('flipflop'):
+        info['itr'] = get_flipflop_settings()
+    return json.loads(json.dumps(info)) # same types as when read back from the manifest (ex: tuples become lists)
+
+class Checkpoint:
+    """
+    Manifest <output_prefix>.checkpoint.json of run_processing_parallel: the run info (see get_checkpoint_run_info),
+    the shard offsets and, for each completed shard, the size and CRC32 of its outputs.
+    It is rewritten (atomically) every time a shard completes, and deleted once the run is complete.
+    """
+    def __init__(self, output_prefix, run_info, shards):
+        self.filename = output_prefix + '.checkpoint.json'
+        self.run_info = run_info
+        self.shards = [tuple(x) for x in shards]
+        self.outputs = [None] * len(shards) # for each shard, None or dict of output file --> checksum
+
+    @classmethod
+    def load(cls, output_prefix, run_info):
+        """
+        :return: Checkpoint left by a previous run with the same run info, or None
+        """
+        filename = output_prefix + '.checkpoint.json'
+        if not os.path.exists(filename):
+            print("No checkpoint {0} to resume from, starting from the beginning.".format(filename))
+            return None
+        with open(filename) as f:
+            data = json.load(f)
+        if data['run_info'] != run_info:
+            print("WARNING: checkpoint {0} is for a different input or different parameters, starting from the beginning.".format(filename))
+            return None
+        checkpoint = cls(output_prefix, run_info, [(x['start_offset'], x['end_offset']) for x in data['shards']])
+        checkpoint.outputs = [x['outputs'] for x in data['shards']]
+        return checkpoint
+
+    def write(self):
+        data = {'run_info': self.run_info,
+                'shards': [{'start_offset': start_offset, 'end_offset': end_offset, 'outputs': outputs}
+                           for (start_offset, end_offset), outputs in zip(self.shards, self.outputs)]}
+        with open(self.filename + '.tmp', 'w') as f:
+            json.dump(data, f, indent=2)
+        os.replace(self.filename + '.tmp', self.filename)
+
+    def set_done(self, i, chunk_prefix):
+        self.outputs[i] = {os.path.basename(f): get_file_checksum(f) for f in get_chunk_output_files(chunk_prefix, self.run_info['params'])}
+        self.write()
+
+    def is_done(self, i, chunk_prefix):
+        """
+        :return: True if shard <i> was completed and its outputs are all still there, unchanged
+        """
+        if self.outputs[i] is None:
+            return False
+        files = get_chunk_output_files(chunk_prefix, self.run_info['params'])
+        if sorted(os.path.basename(f) for f in files) != sorted(self.outputs[i]):
+            return False
+        return all(get_file_checksum(f) == self.outputs[i][os.path.basename(f)] for f in files)
+
+    def remove(self):
+        os.remove(self.filename)
+
+
+def run_processing_parallel(sorted_sam_filename, d, output_prefix, num_chunks=1, nonmatch_hist=False, event_table=True, split_categories=False, sort_mem=SORT_MEM, table_format='tsv', io_threads=IO_THREADS, flipflop=False, cprofile=False, resume=False, report_aggregates=False, random_frac=1., max_reads=None):
+    """
+    Run process_alignment_bam on <num_chunks> shards of the input in parallel, then merge the chunk outputs.
+    With --profile (PROFILER enabled), each chunk is profiled too, see collect_worker_profiles.
+
+    Completed shards are recorded in <output_prefix>.checkpoint.json (see Checkpoint). With <resume>, the shards of an
+    interrupted run with the same run info are reused if their outputs are unchanged, and only the others are processed.
 
-    pool = []
-    for i in range(num_chunks):
+    With <max_reads>, each chunk stops after its share of <max_reads> reads (see split_max_reads).
+    """
+    params = {'nonmatch_hist': nonmatch_hist, 'event_table': event_table,
+              'split_categories': split_categories, 'table_format': table_format,
+              'flipflop': flipflop, 'report_aggregates': report_aggregates,
+              'random_frac': random_frac, 'max_reads': max_reads}
+    run_info = get_checkpoint_run_info(sorted_sam_filename, d, num_chunks, params)
+    checkpoint = Checkpoint.load(output_prefix, run_info) if resume else None
+    if checkpoint is None:
+        PROFILER.start('shard')
+        shards = get_shard_offsets(sorted_sam_filename, num_chunks)
+        PROFILER.stop()
+        checkpoint = Checkpoint(output_prefix, run_info, shards)
+        checkpoint.write()
+    else:
+        shards = checkpoint.shards
+    num_chunks = len(shards)
+    print(f"Dividing into {num_chunks} chunks...")
+    chunk_prefixes = [output_prefix+'.'+str(i+1) for i in range(num_chunks)]
+    chunk_max_reads = split_max_reads(max_reads, num_chunks)
+    todo = []
+    for i, o in enumerate(chunk_prefixes):
+        if resume and checkpoint.is_done(i, o):
+            print("Reusing chunk {0} from checkpoint {1}".format(i+1, checkpoint.filename))
+        else:
+            # outputs left by an interrupted run, some of which (ex: unsorted category BAMs) may not be overwritten
+            for f in get_chunk_output_files(o, params):
+                os.remove(f)
+            todo.append(i)
+    # the chunks run side by side, so they share the BGZF thread budget
+    chunk_io_threads = split_io_threads(io_threads, max(1, len(todo)))
+
+    pool = {}
+    for i in todo:
+        start_offset, end_offset = shards[i]
         p = Process(target=process_alignment_bam,
                     args=(sorted_sam_filename,
                           d,
                           output_prefix+'.'+str(i+1),
-                          readname_list[i*chunk_size],
-                          None if (i+1)*chunk_size>total_num_reads else readname_list[(i+1)*chunk_size],))
+                          start_offset,
+                          end_offset,),
+                    kwargs={'nonmatch_hist': nonmatch_hist,
+                            'event_table': event_table,
+                            'gzip_nonmatch': True,
+                            'split_categories': split_categories,
+                            'sort_mem': sort_mem,
+                            'table_format': table_format,
+                            'io_threads': chunk_io_threads,
+                            'flipflop': flipflop,
+                            'report_aggregates': report_aggregates,
+                            'profile': PROFILER.enabled,
+                            'cprofile': cprofile,
+                            'random_frac': random_frac,
+                            'max_reads': chunk_max_reads[i]})
         p.start()
-        pool.append(p)
-        print("Going from {0} to {1}".format(i*chunk_size, (i+1)*chunk_size))
-    for i,p in enumerate(pool):
-        if DEBUG_GLOBAL_FLAG:
-            print(f"DEBUG: Waiting for {i}th pool to finish.")
+        pool[p.sentinel] = (i, p)
+        print("Going from offset {0} to {1}".format(start_offset, 'end' if end_offset is None else end_offset))
+    PROFILER.start('workers')
+    # record each chunk in the checkpoint as soon as it completes, so that an interrupted run loses as little as possible
+    failed = []
+    while len(pool) > 0:
+        for sentinel in wait(list(pool)):
+            i, p = pool.pop(sentinel)
+            p.join()
+            if DEBUG_GLOBAL_FLAG:
+                print(f"DEBUG: chunk {i+1} finished with exit code {p.exitcode}.")
+            if p.exitcode == 0:
+                checkpoint.set_done(i, chunk_prefixes[i])
+            else:
+                failed.append((i, p.exitcode))
+    if len(failed) > 0:
+        i, exitcode = min(failed)
+        raise Exception("Chunk {0} failed with exit code {1}. Abort!".format(i+1, exitcode))
+    PROFILER.stop(count=len(todo))
+
+    with PROFILER.stage('merge'):
+        merge_chunk_outputs(output_prefix, num_chunks, d, nonmatch_hist, event_table, table_format, flipflop, report_aggregates)
+    if split_categories:
+        with PROFILER.stage('sort_index', count=len(SUBSET_CATEGORIES)):
+            sort_and_index_category_bams(output_prefix, chunk_prefixes, cpus=num_chunks, sort_mem=sort_mem)
+    checkpoint.remove()
+    return get_table_filename(output_prefix+'.per_read', table_format), output_prefix+'.tagged.bam'
+
+def is_stream_input(filename):
+    """
+    :return: True if <filename> is stdin (-) or a pipe, which can only be read once, from start to end
+    """
+    return filename == '-' or not os.path.isfile(filename)
+
+STREAM_BATCH_SIZE = 1000 # number of reads sent to a streaming worker at a time
+STREAM_QUEUE_SIZE = 4 # batches waiting for each streaming worker, bounds the memory used for records in flight
+
+def put_record_batch(record_queue, p, batch):
+    """
+    Send <batch> to worker <p>, waiting while its queue is full (unless it died)
+    """
+    while True:
+        try:
+            record_queue.put(batch, timeout=1)
+            return
+        except queue.Full:
+            if not p.is_alive():
+                raise Exception("Streaming worker {0} exited with exit code {1}. Abort!".format(p.name, p.exitcode))
+
+def run_processing_stream(sam_filename, d, output_prefix, num_workers=1, nonmatch_hist=False, event_table=True, split_categories=False, sort_mem=SORT_MEM, table_format='tsv', io_threads=IO_THREADS, flipflop=False, cprofile=False, report_aggregates=False, random_frac=1., max_reads=None):
+    """
+    Like run_processing_parallel, but reading the input once, as a stream (- for stdin, ex: piped from the aligner),
+    so it cannot be sharded by offset. The records are grouped by read name as they arrive (all the alignments of a read
+    must be consecutive, as output by minimap2) and batches of STREAM_BATCH_SIZE reads are sent to <num_workers> worker
+    processes in turn. Each worker writes the outputs of its batches as one chunk, so the merged outputs are
+    in batch order within each worker rather than in input order.
+    Reads are subsampled (<random_frac>, <max_reads>, see iter_sampled_records) before they are sent, and reading
+    stops once <max_reads> reads were sent.
+    """
+    # the main process (reading the input) and the workers share the BGZF thread budget
+    chunk_io_threads = split_io_threads(io_threads, num_workers + 1)
+    reader = pysam.AlignmentFile(sam_filename, check_sq=False, threads=chunk_io_threads)
+    if get_sort_order(reader.header) == 'coordinate':
+        raise Exception("Streamed input is coordinate-sorted, the records of each read must be together. Abort!")
+    header = reader.header.to_dict()
+    chunk_prefixes = [output_prefix+'.'+str(i+1) for i in range(num_workers)]
+    workers = []
+    for o in chunk_prefixes:
+        record_queue = Queue(STREAM_QUEUE_SIZE)
+        p = Process(target=process_alignment_bam,
+                    args=(None, d, o),
+                    kwargs={'nonmatch_hist': nonmatch_hist,
+                            'event_table': event_table,
+                            'gzip_nonmatch': True,
+                            'split_categories': split_categories,
+                            'sort_mem': sort_mem,
+                            'table_format': table_format,
+                            'io_threads': chunk_io_threads,
+                            'flipflop': flipflop,
+                            'report_aggregates': report_aggregates,
+                            'profile': PROFILER.enabled,
+                            'cprofile': cprofile,
+                            'header': header,
+                            'record_queue': record_queue})
+        p.start()
+        workers.append((record_queue, p))
+    print(f"Streaming reads to {num_workers} workers...")
+
+    PROFILER.start('stream')
+    num_reads = 0
+    try:
+        batch = [] # SAM lines of up to STREAM_BATCH_SIZE reads
+        prev_qname = None
+        for r in iter_sampled_records(reader, random_frac, max_reads):
+            if r.qname != prev_qname:
+                if num_reads > 0 and num_reads % STREAM_BATCH_SIZE == 0:
+                    put_record_batch(*workers[(num_reads // STREAM_BATCH_SIZE - 1) % num_workers], batch)
+                    batch = []
+                num_reads += 1
+                prev_qname = r.qname
+            batch.append(r.to_string())
+        if len(batch) > 0:
+            put_record_batch(*workers[((num_reads - 1) // STREAM_BATCH_SIZE) % num_workers], batch)
+        for record_queue, p in workers:
+            put_record_batch(record_queue, p, None)
+    except BaseException:
+        for record_queue, p in workers:
+            p.terminate()
+        raise
+    reader.close()
+    PROFILER.stop(count=num_reads)
+
+    PROFILER.start('workers')
+    failed = []
+    for i, (record_queue, p) in enumerate(workers):
         p.join()
+        if p.exitcode != 0:
+            failed.append((i, p.exitcode))
+    if len(failed) > 0:
+        i, exitcode = failed[0]
+        raise Exception("Chunk {0} failed with exit code {1}. Abort!".format(i+1, exitcode))
+    PROFILER.stop(count=num_workers)
+    print(f"{num_reads} reads streamed.")
+
+    with PROFILER.stage('merge'):
+        merge_chunk_outputs(output_prefix, num_workers, d, nonmatch_hist, event_table, table_format, flipflop, report_aggregates)
+    if split_categories:
+        with PROFILER.stage('sort_index', count=len(SUBSET_CATEGORIES)):
+            sort_and_index_category_bams(output_prefix, chunk_prefixes, cpus=num_workers, sort_mem=sort_mem)
+    return get_table_filename(output_prefix+'.per_read', table_format), output_prefix+'.tagged.bam'
+
+# estimated in-memory size of the decoded records of a partition, relative to the size of the input on disk
+# (measured 14-18x for BAM, about 1.2x for uncompressed SAM)
+GROUP_MEM_FACTOR = 18
+SAM_GROUP_MEM_FACTOR = 2
+
+def get_num_partitions(filename, partition_mem, num_chunks):
+    """
+    :param partition_mem: memory (in bytes) for grouping one partition
+    :return: number of read name hash partitions of <filename> so that each partition can be grouped within <partition_mem>
+    """
+    with pysam.AlignmentFile(filename, check_sq=False) as f:
+        factor = GROUP_MEM_FACTOR if f.is_bam or f.is_cram else SAM_GROUP_MEM_FACTOR
+    return max(num_chunks, math.ceil(os.path.getsize(filename) * factor / partition_mem))
 
-    # combine the data together for
-    # *.nonmatch_stat.csv, *.per_read.csv, *.summary.csv, *.tagged.bam
-
-    # copy the first chunk over
-    o = output_prefix + '.1'
-
-    #shutil.copy(o + '.nonmatch_stat.csv', output_prefix + '.nonmatch_stat.csv')
-    #shutil.copy(o + '.per_read.csv', output_prefix + '.per_read.csv')
-    #shutil.copy(o + '.summary.csv', output_prefix + '.summary.csv')
-    #shutil.copy(o + '.tagged.bam', output_prefix + '.tagged.bam')
-
-    f1 = gzip.open(output_prefix + '.nonmatch_stat.csv.gz', 'wb')
-    f2 = open(output_prefix + '.per_read.csv', 'w')
-    f3 = open(output_prefix + '.summary.csv', 'w')
-
-    with open(o + '.nonmatch_stat.csv') as h:
-        for line in h:
-            f1.write(line.encode())
-    with open(o + '.per_read.csv') as h:
-        for line in h:
-            f2.write(line)
-    with open(o + '.summary.csv') as h:
-        for line in h:
-            f3.write(line)
-    reader = pysam.AlignmentFile(o + '.tagged.bam', 'rb', check_sq=False)
-    f4 = pysam.AlignmentFile(output_prefix + '.tagged.bam', "wb", template=reader)
-    for r in reader:
-        f4.write(r)
+def get_partition_filenames(output_prefix, num_partitions):
+    return [output_prefix+'.partition.'+str(i+1)+'.bam' for i in range(num_partitions)]
 
+def partition_by_read_name(sam_filename, output_prefix, num_partitions, io_threads=1, random_frac=1., max_reads=None):
+    """
+    Spill the records of <sam_filename> into <num_partitions> BAM files by a hash of the read name,
+    so that all the records of a read are in the same (smaller) partition, whatever the input order.
+    If <random_frac> < 1, only the records of the reads kept by is_read_sampled are spilled.
+    If <max_reads> is given, only the records of the first <max_reads> (sampled) reads are spilled, but the whole input
+    is still read, as the other alignments of these reads can be anywhere.
 
-    if DEBUG_GLOBAL_FLAG:
-        print("Combining chunk data...")
-    for i in range(1, num_chunks):
-        o = output_prefix + '.' + str(i+1)
-        with open(o+'.nonmatch_stat.csv') as h:
-            h.readline() # ignore the header
-            f1.write(h.read().encode())
-        with open(o+'.per_read.csv') as h:
-            h.readline() # ignore the header
-            f2.write(h.read())
-        with open(o+'.summary.csv') as h:
-            h.readline() # ignore the header
-            f3.write(h.read())
-        for r in pysam.AlignmentFile(open(o+'.tagged.bam'), 'rb', check_sq=False):
-            f4.write(r)
-
-    f1.close()
-    f2.close()
-    f3.close()
-    f4.close()
+    :return: list of partition BAM filenames (<output_prefix>.partition.<i>.bam)
+    """
+    reader = pysam.AlignmentFile(sam_filename, check_sq=False, threads=io_threads)
+    header = reader.header.to_dict()
+    header['HD'] = dict(header.get('HD', {'VN': '1.6'}), SO='unknown', GO='query')
+    filenames = get_partition_filenames(output_prefix, num_partitions)
+    writers = [pysam.AlignmentFile(f, 'wb', header=header) for f in filenames]
+    kept = set() # names of the reads spilled so far, with <max_reads>
+    for r in reader:
+        if random_frac < 1 and not is_read_sampled(r.qname, random_frac):
+            continue
+        if max_reads is not None and r.qname not in kept:
+            if len(kept) >= max_reads:
+                continue
+            kept.add(r.qname)
+        writers[zlib.crc32(r.qname.encode()) % num_partitions].write(r)
     reader.close()
-    # delete the chunk data
-    if DEBUG_GLOBAL_FLAG:
-        print("Data combining complete. Deleting chunk data.")
-    for i in range(num_chunks):
-        o = output_prefix + '.' + str(i + 1)
-        os.remove(o + '.nonmatch_stat.csv')
-        os.remove(o + '.per_read.csv')
-        os.remove(o + '.summary.csv')
-        os.remove(o + '.tagged.bam')
+    for w in writers:
+        w.close()
+    return filenames
+
+def iter_partition_records(filenames, io_threads=1):
+    """
+    Iterate over the records of each partition written by partition_by_read_name, grouped by read
+    (primary first, then the supplementary alignments in input order). Only one partition is in memory at a time,
+    and each is deleted once read.
+    """
+    for f in filenames:
+        with pysam.AlignmentFile(f, check_sq=False, threads=io_threads) as reader:
+            records = list(reader)
+        os.remove(f)
+        records.sort(key=lambda r: (r.qname, r.is_supplementary))
+        yield from records
+        del records
+
+def run_processing_partitioned(sam_filename, d, output_prefix, num_chunks=1, nonmatch_hist=False, event_table=True, split_categories=False, sort_mem=SORT_MEM, table_format='tsv', io_threads=IO_THREADS, flipflop=False, cprofile=False, report_aggregates=False, random_frac=1., max_reads=None):
+    """
+    Process a coordinate-sorted SAM/BAM file, where the records of a read are scattered, without sorting it by read name:
+    the records are first spilled into read name hash partitions (see partition_by_read_name), each small enough
+    to be grouped by read in memory. The partitions are then divided between <num_chunks> chunks (run like
+    run_processing_parallel), or processed directly into <output_prefix> if <num_chunks> is 1.
+    <sort_mem> is shared by all the chunks: each gets <sort_mem>/<num_chunks>, half for the partition it is grouping
+    and half for its category buffers.
+    Only the first <max_reads> reads kept by is_read_sampled(<random_frac>) are spilled (see partition_by_read_name).
+    The partition files are deleted as they are read, and in any case once the chunks are done or have failed.
+    """
+    chunk_mem = parse_mem(sort_mem) // num_chunks
+    num_partitions = get_num_partitions(sam_filename, chunk_mem // 2, num_chunks)
+    print(f"Input is coordinate-sorted, grouping reads into {num_partitions} partitions by read name...")
+    try:
+        with PROFILER.stage('partition'):
+            partitions = partition_by_read_name(sam_filename, output_prefix, num_partitions, split_io_threads(io_threads, 1),
+                                                random_frac, max_reads)
+        kwargs = {'nonmatch_hist': nonmatch_hist,
+                  'event_table': event_table,
+                  'gzip_nonmatch': num_chunks > 1,
+                  'split_categories': split_categories,
+                  'sort_mem': str(chunk_mem // 2),
+                  'table_format': table_format,
+                  'io_threads': split_io_threads(io_threads, num_chunks),
+                  'flipflop': flipflop,
+                  'report_aggregates': report_aggregates,
+                  'profile': PROFILER.enabled,
+                  'cprofile': cprofile}
+        if num_chunks == 1:
+            with PROFILER.stage('workers'):
+                process_alignment_bam(None, d, output_prefix, partitions=partitions, **kwargs)
+            chunk_prefixes = [output_prefix]
+        else:
+            chunk_prefixes = [output_prefix+'.'+str(i+1) for i in range(num_chunks)]
+            pool = []
+            for i, o in enumerate(chunk_prefixes):
+                p = Process(target=process_alignment_bam, args=(None, d, o),
+                            kwargs=dict(kwargs, partitions=partitions[i::num_chunks]))
+                p.start()
+                pool.append(p)
+            PROFILER.start('workers')
+            for p in pool:
+                p.join()
+            for i, p in enumerate(pool):
+                if p.exitcode != 0:
+                    raise Exception("Chunk {0} failed with exit code {1}. Abort!".format(i+1, p.exitcode))
+            PROFILER.stop(count=num_chunks)
+            with PROFILER.stage('merge'):
+                merge_chunk_outputs(output_prefix, num_chunks, d, nonmatch_hist, event_table, table_format, flipflop, report_aggregates)
+        if split_categories:
+            with PROFILER.stage('sort_index', count=len(SUBSET_CATEGORIES)):
+                sort_and_index_category_bams(output_prefix, chunk_prefixes, cpus=num_chunks, sort_mem=sort_mem)
+    finally:
+        # partitions left by a failed chunk
+        for f in get_partition_filenames(output_prefix, num_partitions):
+            if os.path.exists(f):
+                os.remove(f)
+    return get_table_filename(output_prefix+'.per_read', table_format), output_prefix+'.tagged.bam'
+
+CATEGORY_FRACTION_FIELDS = ['category', 'num_reads', 'total_reads', 'fraction', 'ci_low', 'ci_high']
+FRACTION_CI_Z = 1.959964 # 95% confidence intervals
+
+def get_wilson_interval(count, total, z=FRACTION_CI_Z):
+    """
+    :return: (low, high) Wilson score interval of the fraction <count>/<total>
+    """
+    p = count / total
+    denom = 1 + z * z / total
+    center = (p + z * z / (2 * total)) / denom
+    half = z * math.sqrt(p * (1 - p) / total + z * z / (4 * total * total)) / denom
+    return max(0., center - half), min(1., center + half)
+
+def write_category_fractions(output_prefix, table_format='tsv', random_sample=True):
+    """
+    Fraction of reads in each subset category (see get_subset_category) with its 95% confidence interval, from the per_read
+    table, to <output_prefix>.category_fractions.csv. For subsampled runs (--random_frac, --max_reads).
+    Fractions are of the number of reads, not of the effective_count used by plotAAVreport.R.
+
+    :param random_sample: if False (--max_reads alone keeps the first reads of the input), the confidence intervals are NA
+    :return: dict of category --> (num_reads, fraction, ci_low, ci_high)
+    """
+    counts = Counter(get_subset_category(r['assigned_type'], r['assigned_subtype'])
+                     for r in iter_table_rows(get_table_filename(output_prefix+'.per_read', table_format),
+                                              columns=['assigned_type', 'assigned_subtype']))
+    total = sum(counts.values())
+    result = {}
+    with open(output_prefix+'.category_fractions.csv', 'w') as f:
+        writer = DictWriter(f, CATEGORY_FRACTION_FIELDS, delimiter='\t')
+        writer.writeheader()
+        for c in SUBSET_CATEGORIES:
+            if total == 0:
+                result[c] = (0, 'NA', 'NA', 'NA')
+            elif not random_sample:
+                result[c] = (counts[c], round(counts[c] / total, 4), 'NA', 'NA')
+            else:
+                low, high = get_wilson_interval(counts[c], total)
+                result[c] = (counts[c], round(counts[c] / total, 4), round(low, 4), round(high, 4))
+            writer.writerow(dict(zip(CATEGORY_FRACTION_FIELDS, (c, result[c][0], total) + result[c][1:])))
+    return result
+
+def get_itr_call_options(args):
+    """
+    :return: arguments of get_flipflop_config.set_call_options() from the --flipflop options of <args>, None if none is given
+    """
+    if args.left_window_pad is None and args.right_window_pad is None and args.itr_cache_size is None and not args.no_kmer_prescreen:
+        return None
+    import get_flipflop_config as ff # imported here, get_flipflop_config imports this module
+    return (ff.ITR_LEFT_WINDOW_PAD if args.left_window_pad is None else args.left_window_pad,
+            ff.ITR_RIGHT_WINDOW_PAD if args.right_window_pad is None else args.right_window_pad,
+            ff.ITR_CACHE_SIZE if args.itr_cache_size is None else args.itr_cache_size,
+            not args.no_kmer_prescreen)
+
+def get_output_files(output_prefix, nonmatch_hist=False, event_table=True, table_format='tsv', gzip_nonmatch=False, flipflop=False, report_aggregates=False, category_fractions=False):
+    """
+    :return: all output files of a complete run (single CPU: <gzip_nonmatch> False, --cpus: True)
+    """
+    files = [get_table_filename(output_prefix+'.per_read', table_format), get_table_filename(output_prefix+'.summary', table_format)]
+    if event_table:
+        files.append(get_table_filename(output_prefix+'.nonmatch_stat', table_format, gzip_nonmatch))
+    if nonmatch_hist:
+        files.append(output_prefix+'.nonmatch_hist.csv')
+    if report_aggregates:
+        files.append(output_prefix+'.report_aggregates.json')
+    if category_fractions:
+        files.append(output_prefix+'.category_fractions.csv')
+    files.append(output_prefix+'.tagged.bam')
+    for c in SUBSET_CATEGORIES:
+        files += [output_prefix+'.'+c+'.tagged.sorted.bam', output_prefix+'.'+c+'.tagged.sorted.bam.bai']
+    if flipflop:
+        files.append(output_prefix+'.flipflop_assignments.txt')
+        files += [output_prefix+name for name in FLIPFLOP_BAM_NAMES]
+    return files
+
+def get_result_cache_key(sorted_sam_filename, d, params, sampling=None):
+    """
+    :param params: dict of the options that change the outputs (see get_output_files)
+    :param sampling: dict of the subsampling options (--random_frac, --max_reads and the number of chunks), if any
+    :return: key of the outputs in the result cache (see aav_cache), from the input content and everything else they depend on
+    """
+    from aav_cache import get_cache_key, get_file_digest
+    fields = {'version': __version__,
+              'input_sha256': get_file_digest(sorted_sam_filename),
+              'annotation': d,
+              'max_diff_w_ref': MAX_DIFF_W_REF,
+              'target_gap_threshold': TARGET_GAP_THRESHOLD,
+              'min_prim_supp_cov': MIN_PRIM_SUPP_COV,
+              'params': params}
+    if params.get('flipflop'):
+        fields['itr'] = get_flipflop_settings()
+    if sampling is not None:
+        fields['sampling'] = sampling
+    return get_cache_key(fields)
 
-    return output_prefix+'.per_read.csv', output_prefix+'.tagged.bam'
 
 if __name__ == "__main__":
     from argparse import ArgumentParser
     parser = ArgumentParser()
-    parser.add_argument("sam_filename", help="Sorted by read name SAM file")
+    parser.add_argument("sam_filename", help="Sorted by read name SAM file (coordinate-sorted input is grouped by read name first), or - to stream SAM/BAM from stdin (ex: piped from minimap2, the alignments of each read must be together)")
     parser.add_argument("annotation_txt", help="Annotation file")
     parser.add_argument("output_prefix", help="Output prefix")
     parser.add_argument("--max_allowed_missing_flanking", default=100, type=int, help="Maximum allowed missing flanking bp to be still considered 'full' (default:100)")
     parser.add_argument("--cpus", type=int, default=1, help="Number of CPUs (default: 1)")
+    parser.add_argument("--nonmatch_hist", action="store_true", default=False, help="Also output pre-aggregated nonmatch counts by reference position bin and length category (.nonmatch_hist.csv, for downstream analysis, plotAAVreport.R reads .report_aggregates.json)")
+    parser.add_argument("--no_event_table", "--no-event-table", dest="no_event_table", action="store_true", default=False, help="Do not output the per-event .nonmatch_stat.csv table, implies --nonmatch_hist and --report_aggregates (which plotAAVreport.R then reads instead)")
+    parser.add_argument("--report_aggregates", action="store_true", default=False, help="Also output the counts and histograms plotAAVreport.R needs (.report_aggregates.json), which the report then reads instead of the full tables")
+    parser.add_argument("--table_format", choices=TABLE_FORMATS, default='tsv', help="Format of the summary, per_read and nonmatch_stat tables: tsv (.csv, default) or parquet (.parquet, requires pyarrow)")
+    parser.add_argument("--io_threads", "--io-threads", dest="io_threads", type=int, default=IO_THREADS, help="BGZF compression/decompression threads for the input and the .tagged.bam output (not the smaller category and flip-flop BAMs), shared between the --cpus chunks (default: {0})".format(IO_THREADS))
+    parser.add_argument("--sort_mem", default=SORT_MEM, help="Memory budget, K/M/G suffix allowed (default: {0}). Each --cpus chunk buffers up to this much of category BAM records, and each category BAM sort uses up to this much. For coordinate-sorted input, it is shared by all the --cpus chunks instead: each groups one read name partition (about {1}x its share of the BAM size) within half of sort_mem/cpus, and buffers category records within the other half".format(SORT_MEM, GROUP_MEM_FACTOR))
+    parser.add_argument("--flipflop", action="store_true", default=False, help="Also call ITR flip/flop configurations in the same pass (same outputs as get_flipflop_config.py)")
+    parser.add_argument("--flipflop_fasta", default=None, help="(optional) flip flop fasta file for --flipflop (if not given, uses AAV2 default)")
+    parser.add_argument("--left_window_pad", type=int, default=None, help="For --flipflop, search the left ITR within the first len(ITR)+N bases of each read, negative to search the whole read (default: 200, as get_flipflop_config.py)")
+    parser.add_argument("--right_window_pad", type=int, default=None, help="For --flipflop, search the right ITR within the last len(ITR)+N bases of each read, negative to search the whole read (default: 10, as get_flipflop_config.py)")
+    parser.add_argument("--itr_cache_size", type=int, default=None, help="For --flipflop, max number of read-end ITR calls to cache per CPU, 0 to disable (default: 100000, get_flipflop_config.py --cache_size)")
+    parser.add_argument("--no_kmer_prescreen", action="store_true", default=False, help="For --flipflop, always align the ITRs (get_flipflop_config.py --no_kmer_prescreen)")
+    parser.add_argument("--profile", action="store_true", default=False, help="Record wall/CPU time and item counts per processing stage and per worker to <output_prefix>.profile.json, and log reads/sec progress")
+    parser.add_argument("--cprofile", action="store_true", default=False, help="Also dump cProfile stats of each worker to <output_prefix>[.<chunk>].pstats")
+    parser.add_argument("--resume", action="store_true", default=False, help="With --cpus > 1, reuse the chunks completed by an interrupted run with the same input, parameters and --cpus (recorded in <output_prefix>.checkpoint.json)")
+    parser.add_argument("--cache_dir", default=None, help="Reuse the outputs of an earlier run on the same input BAM, annotation and parameters stored in this directory, or store them there")
+    parser.add_argument("--cache_size", default=None, help="Maximum size of --cache_dir, least recently used results are evicted, K/M/G suffix allowed (default: 20G)")
     parser.add_argument("--debug", action="store_true", default=False)
-    #parser.add_argument("-f", "--random_frac", default=1., type=float, help="default: off. Random fraction of alignments to subsample.")
-    #parser.add_argument("-m", "--max_reads", type=int, default=None, \
-    #                    help="default: off. Maximum number of records to process. Can use in conjunction with --random_frac")
+    parser.add_argument("-f", "--random_frac", default=1., type=float, help="default: off. Fraction of reads to subsample, by read name hash (the same reads in every run), for a quick preview")
+    parser.add_argument("-m", "--max_reads", type=int, default=None, \
+                        help="default: off. Stop after this many (subsampled) reads, split between the --cpus chunks. Can use in conjunction with --random_frac (needed for confidence intervals of the category fractions). Coordinate-sorted input is still read to the end (the alignments of a read can be anywhere), but only the first reads are grouped and processed")
 
     args = parser.parse_args()
 
     if args.debug:
         DEBUG_GLOBAL_FLAG = True
+    if args.profile:
+        PROFILER = StageProfiler('main')
 
     MAX_DIFF_W_REF = args.max_allowed_missing_flanking
 
+    nonmatch_hist = args.nonmatch_hist or args.no_event_table
+    event_table = not args.no_event_table
+    if args.no_event_table: # plotAAVreport.R needs either the event table or the aggregates
+        args.report_aggregates = True
+
+    # the tagged BAM is subset into major categories (<output_prefix>.<category>.tagged.sorted.bam, see SUBSET_CATEGORIES)
+    # in the same pass, for ease of loading into IGV for viewing
+    if args.flipflop_fasta is not None:
+        if not args.flipflop:
+            raise Exception("--flipflop_fasta is only used with --flipflop. Abort!")
+        from get_flipflop_config import read_flip_flop_fasta
+        read_flip_flop_fasta(args.flipflop_fasta)
+    itr_options = get_itr_call_options(args)
+    if itr_options is not None:
+        if not args.flipflop:
+            raise Exception("--left_window_pad, --right_window_pad, --itr_cache_size and --no_kmer_prescreen are only used with --flipflop. Abort!")
+        from get_flipflop_config import set_call_options
+        set_call_options(*itr_options)
+
+    if args.resume and args.cpus == 1:
+        raise Exception("--resume is only used with --cpus > 1. Abort!")
+    if not 0 < args.random_frac <= 1:
+        raise Exception("--random_frac must be in (0, 1]. Abort!")
+    if args.max_reads is not None and args.max_reads < 1:
+        raise Exception("--max_reads must be at least 1. Abort!")
+    # subsampled runs also report the category fractions with their confidence intervals
+    preview = args.random_frac < 1 or args.max_reads is not None
+    stream_input = is_stream_input(args.sam_filename)
+    if stream_input and (args.resume or args.cache_dir is not None):
+        raise Exception("--resume and --cache_dir need an input file, not a stream. Abort!")
+    # coordinate-sorted input is grouped by read name first, see run_processing_partitioned
+    coordinate_sorted = not stream_input and get_file_sort_order(args.sam_filename) == 'coordinate'
+    if coordinate_sorted and args.resume:
+        raise Exception("--resume is not supported for coordinate-sorted input. Abort!")
+
     d = read_annotation_file(args.annotation_txt)
-    if args.cpus == 1:
-        per_read_csv, full_out_bam = process_alignment_bam(args.sam_filename, d, args.output_prefix)
+    output_params = {'nonmatch_hist': nonmatch_hist, 'event_table': event_table, 'table_format': args.table_format,
+                     'gzip_nonmatch': args.cpus > 1, 'flipflop': args.flipflop, 'report_aggregates': args.report_aggregates}
+    if preview:
+        output_params['category_fractions'] = True
+    cached_files = None
+    if args.cache_dir is not None:
+        from aav_cache import ResultCache, CACHE_SIZE
+        cache = ResultCache(args.cache_dir, parse_mem(CACHE_SIZE if args.cache_size is None else args.cache_size))
+        with PROFILER.stage('cache_key'):
+            sampling = {'random_frac': args.random_frac, 'max_reads': args.max_reads, 'cpus': args.cpus} if preview else None
+            cache_key = get_result_cache_key(args.sam_filename, d, output_params, sampling)
+        with PROFILER.stage('cache_fetch'):
+            cached_files = cache.fetch(cache_key, args.output_prefix)
+    elif args.cache_size is not None:
+        raise Exception("--cache_size is only used with --cache_dir. Abort!")
+
+    if cached_files is not None:
+        print("Outputs reused from the result cache: {0}".format(os.path.join(args.cache_dir, cache_key)))
+        chunk_prefixes = []
+    elif coordinate_sorted:
+        per_read_csv, full_out_bam = run_processing_partitioned(args.sam_filename, d, args.output_prefix, num_chunks=args.cpus,
+                                                                nonmatch_hist=nonmatch_hist, event_table=event_table,
+                                                                split_categories=True, sort_mem=args.sort_mem,
+                                                                table_format=args.table_format,
+                                                                io_threads=args.io_threads,
+                                                                flipflop=args.flipflop,
+                                                                cprofile=args.cprofile,
+                                                                report_aggregates=args.report_aggregates,
+                                                                random_frac=args.random_frac, max_reads=args.max_reads)
+        chunk_prefixes = [args.output_prefix] if args.cpus == 1 else [args.output_prefix+'.'+str(i+1) for i in range(args.cpus)]
+    elif args.cpus == 1:
+        with PROFILER.stage('workers'):
+            per_read_csv, full_out_bam = process_alignment_bam(args.sam_filename, d, args.output_prefix,
+                                                               nonmatch_hist=nonmatch_hist, event_table=event_table,
+                                                               split_categories=True, sort_mem=args.sort_mem,
+                                                               table_format=args.table_format,
+                                                               io_threads=split_io_threads(args.io_threads, 1),
+                                                               flipflop=args.flipflop,
+                                                               profile=args.profile, cprofile=args.cprofile,
+                                                               report_aggregates=args.report_aggregates,
+                                                               random_frac=args.random_frac, max_reads=args.max_reads)
+        # coordinate sort (if not already sorted in memory) and index the category BAM files
+        with PROFILER.stage('sort_index', count=len(SUBSET_CATEGORIES)):
+            sort_and_index_category_bams(args.output_prefix, [args.output_prefix], cpus=args.cpus, sort_mem=args.sort_mem)
+        chunk_prefixes = [args.output_prefix]
+    elif stream_input:
+        per_read_csv, full_out_bam = run_processing_stream(args.sam_filename, d, args.output_prefix, num_workers=args.cpus,
+                                                           nonmatch_hist=nonmatch_hist, event_table=event_table,
+                                                           split_categories=True, sort_mem=args.sort_mem,
+                                                           table_format=args.table_format,
+                                                           io_threads=args.io_threads,
+                                                           flipflop=args.flipflop,
+                                                           cprofile=args.cprofile,
+                                                           report_aggregates=args.report_aggregates,
+                                                           random_frac=args.random_frac, max_reads=args.max_reads)
+        chunk_prefixes = [args.output_prefix+'.'+str(i+1) for i in range(args.cpus)]
     else:
-        per_read_csv, full_out_bam = run_processing_parallel(args.sam_filename, d, args.output_prefix, num_chunks=args.cpus)
-
-    # subset BAM files into major categories for ease of loading into IGV for viewing
-    # subset_sam_by_readname_list(in_bam, out_bam, per_read_csv, wanted_types, wanted_subtypes)
-    subset_sam_by_readname_list(full_out_bam, args.output_prefix+'.scAAV-full.tagged.bam', per_read_csv, ['scAAV'], ['full'])
-    subset_sam_by_readname_list(full_out_bam, args.output_prefix+'.scAAV-partials.tagged.bam', per_read_csv, ['scAAV'], ['partial', 'left-partial', 'right-partial'])
-    subset_sam_by_readname_list(full_out_bam, args.output_prefix+'.scAAV-other.tagged.bam', per_read_csv, ['scAAV'], ['partial', 'left-partial', 'right-partial', 'full'], exclude_subtype=True)
-    subset_sam_by_readname_list(full_out_bam, args.output_prefix+'.ssAAV-full.tagged.bam', per_read_csv, ['ssAAV'], ['full'])
-    subset_sam_by_readname_list(full_out_bam, args.output_prefix+'.ssAAV-partials.tagged.bam', per_read_csv, ['ssAAV'], ['partial', 'left-partial', 'right-partial'])
-    subset_sam_by_readname_list(full_out_bam, args.output_prefix+'.ssAAV-other.tagged.bam', per_read_csv, ['ssAAV'], ['partial', 'left-partial', 'right-partial', 'full'], exclude_subtype=True)
-    subset_sam_by_readname_list(full_out_bam, args.output_prefix+'.others.tagged.bam', per_read_csv, ['ssAAV', 'scAAV'], None, exclude_type=True)
-
-    # samtools sort/index the above files
-    try: subprocess.check_call("samtools --help > /dev/null", shell=True)
-    except:
-        print("WARNING: unable to call samtools to sort the output BAM files. End.")
-        sys.exit(-1)
-  
-    o = args.output_prefix
-    files = [o+'.scAAV-full',
-             o+'.scAAV-partials',
-             o+'.scAAV-other',
-             o+'.ssAAV-full',
-             o+'.ssAAV-partials',
-             o+'.ssAAV-other',
-             o+'.others']
-    for p in files:
-        subprocess.check_call(f"samtools sort {p}.tagged.bam > {p}.tagged.sorted.bam", shell=True)
-        subprocess.check_call(f"samtools index {p}.tagged.sorted.bam", shell=True)
+        per_read_csv, full_out_bam = run_processing_parallel(args.sam_filename, d, args.output_prefix, num_chunks=args.cpus,
+                                                             nonmatch_hist=nonmatch_hist, event_table=event_table,
+                                                             split_categories=True, sort_mem=args.sort_mem,
+                                                             table_format=args.table_format,
+                                                             io_threads=args.io_threads,
+                                                             flipflop=args.flipflop,
+                                                             cprofile=args.cprofile,
+                                                             resume=args.resume,
+                                                             report_aggregates=args.report_aggregates,
+                                                             random_frac=args.random_frac, max_reads=args.max_reads)
+        chunk_prefixes = [args.output_prefix+'.'+str(i+1) for i in range(args.cpus)]
+    if preview and cached_files is None:
+        with PROFILER.stage('category_fractions'):
+            fractions = write_category_fractions(args.output_prefix, args.table_format, random_sample=args.random_frac < 1)
+        if args.random_frac >= 1:
+            print("WARNING: --max_reads without --random_frac keeps the first reads of the input, which are not a random sample: no confidence intervals.")
+        print("Subsampled read category fractions, by number of reads{0}:".format(' (95% CI)' if args.random_frac < 1 else ''))
+        for c, (count, fraction, ci_low, ci_high) in fractions.items():
+            print("  {0}: {1} reads, {2}".format(c, count, fraction) + (" ({0}-{1})".format(ci_low, ci_high) if args.random_frac < 1 else ''))
+        print("Category fractions written to {0}".format(args.output_prefix+'.category_fractions.csv'))
+    if args.cache_dir is not None and cached_files is None:
+        with PROFILER.stage('cache_store'):
+            if cache.store(cache_key, args.output_prefix, get_output_files(args.output_prefix, **output_params)):
+                print("Outputs stored in the result cache: {0}".format(os.path.join(args.cache_dir, cache_key)))
+
+    if args.profile:
+        # there may be fewer chunks than --cpus, see get_shard_offsets
+        workers = collect_worker_profiles([o for o in chunk_prefixes if os.path.exists(o+'.worker_profile.json')])
+        PROFILER.reads = sum(w['reads'] for w in workers)
+        PROFILER.write(args.output_prefix+'.profile.json', workers, cpus=args.cpus)
+        print("Profile written to {0}".format(args.output_prefix+'.profile.json'))
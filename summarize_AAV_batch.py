@@ -0,0 +1,277 @@
+import os, sys, queue
+from csv import DictReader, DictWriter
+from collections import deque, defaultdict
+from multiprocessing import Pool
+import summarize_AAV_alignment as sa
+
+"""
+Batch version of summarize_AAV_alignment.py: run many samples on one shared, bounded process pool
+
+Each sample is split into shards (see get_shard_offsets) that run as pool tasks. Once all the shards of a sample
+are done, its tail (merging the chunk outputs, and sorting/indexing each category BAM) is queued ahead of the
+remaining shards, so it overlaps with the classification of the next samples. Annotation files are parsed once.
+
+Sample sheet: tab-delimited with a header, columns
+ - bam: read name-sorted SAM/BAM file
+ - output_prefix: output prefix, same outputs as summarize_AAV_alignment.py
+ - annotation (optional): annotation file of the sample, if empty or missing, the --annotation file is used
+ - sample (optional): sample name in the combined count table, default is the output prefix file name
+
+Also writes <combined_prefix>.type_counts.csv: per sample read and effective counts by assigned type and subtype.
+"""
+
+TYPE_COUNT_FIELDS = ['sample', 'assigned_type', 'assigned_subtype', 'count', 'effective_count']
+
+
+class Sample:
+    def __init__(self, name, bam_filename, output_prefix, annotation_txt):
+        self.name = name
+        self.bam_filename = bam_filename
+        self.output_prefix = output_prefix
+        self.annotation_txt = annotation_txt
+        self.shards = None
+        self.remaining = 0 # number of shard tasks not done yet
+        self.in_flight = 0 # number of tasks in the pool
+        self.type_counts = None
+        self.error = None
+
+    def get_chunk_prefixes(self):
+        if len(self.shards) == 1: # same as summarize_AAV_alignment.py --cpus 1, written directly to the output prefix
+            return [self.output_prefix]
+        return [self.output_prefix + '.' + str(i + 1) for i in range(len(self.shards))]
+
+    def remove_outputs(self, options):
+        """
+        Delete the chunk outputs, partial category BAMs and merged outputs of a failed sample
+        """
+        prefixes = [self.output_prefix] + ([] if self.shards is None else self.get_chunk_prefixes())
+        for o in sorted(set(prefixes)):
+            files = [o + '.' + c + '.tagged.bam' for c in sa.SUBSET_CATEGORIES]
+            for gzip_nonmatch in (False, True):
+                files += sa.get_output_files(o, options['nonmatch_hist'], options['event_table'], options['table_format'],
+                                             gzip_nonmatch, options['flipflop'], options['report_aggregates'])
+            for f in set(files):
+                if os.path.exists(f):
+                    os.remove(f)
+
+
+def read_sample_sheet(filename, default_annotation=None):
+    """
+    :return: list of Sample
+    """
+    samples = []
+    names = set()
+    for i, r in enumerate(DictReader(open(filename), delimiter='\t')):
+        for field in ('bam', 'output_prefix'):
+            if r.get(field) in (None, ''):
+                raise Exception("Sample sheet {0} line {1} has no {2}. Abort!".format(filename, i + 2, field))
+        annotation_txt = r.get('annotation') or default_annotation
+        if annotation_txt is None:
+            raise Exception("Sample sheet {0} line {1} has no annotation and no --annotation is given. Abort!".format(filename, i + 2))
+        if not os.path.exists(r['bam']):
+            raise Exception("Sample sheet {0} line {1}: {2} does not exist. Abort!".format(filename, i + 2, r['bam']))
+        if sa.get_file_sort_order(r['bam']) == 'coordinate':
+            raise Exception("Sample sheet {0} line {1}: {2} is coordinate-sorted, the records of each read must be together (sort by read name). Abort!".format(filename, i + 2, r['bam']))
+        name = r.get('sample') or os.path.basename(r['output_prefix'])
+        if name in names:
+            raise Exception("Sample {0} is in the sample sheet {1} more than once. Abort!".format(name, filename))
+        names.add(name)
+        samples.append(Sample(name, r['bam'], r['output_prefix'], annotation_txt))
+    return samples
+
+
+def init_worker(max_diff_w_ref, flipflop_fasta, itr_options=None):
+    """
+    Pool initializer: use the same classification settings, ITR sequences and ITR call options as the main process
+    """
+    sa.MAX_DIFF_W_REF = max_diff_w_ref
+    if flipflop_fasta is not None:
+        from get_flipflop_config import read_flip_flop_fasta
+        read_flip_flop_fasta(flipflop_fasta)
+    if itr_options is not None:
+        from get_flipflop_config import set_call_options
+        set_call_options(*itr_options)
+
+
+def count_read_types(per_read_filename):
+    """
+    :return: dict of (assigned_type, assigned_subtype) --> [count, effective count]
+    """
+    counts = defaultdict(lambda: [0, 0])
+    for r in sa.iter_table_rows(per_read_filename, columns=['assigned_type', 'assigned_subtype', 'effective_count']):
+        c = counts[(r['assigned_type'], r['assigned_subtype'])]
+        c[0] += 1
+        c[1] += int(r['effective_count'])
+    return dict(counts)
+
+
+def finish_sample(output_prefix, num_chunks, d, options):
+    """
+    Merge the chunk outputs of a sample (if it has more than one chunk), then count its read types
+    """
+    if num_chunks > 1:
+        sa.merge_chunk_outputs(output_prefix, num_chunks, d, options['nonmatch_hist'], options['event_table'],
+                               options['table_format'], options['flipflop'], options['report_aggregates'])
+    return count_read_types(sa.get_table_filename(output_prefix + '.per_read', options['table_format']))
+
+
+class Task:
+    def __init__(self, sample, kind, func, args, kwargs=None):
+        self.sample = sample
+        self.kind = kind # shard, finish, sort
+        self.func = func
+        self.args = args
+        self.kwargs = {} if kwargs is None else kwargs
+
+
+def iter_shard_tasks(samples, annotations, chunks_per_sample, options):
+    """
+    Shard the samples one at a time, as their shards are needed
+    """
+    for s in samples:
+        try:
+            s.shards = sa.get_shard_offsets(s.bam_filename, chunks_per_sample)
+        except Exception as e:
+            print("ERROR: sample {0} failed: {1}".format(s.name, e), file=sys.stderr)
+            s.error = e
+            continue
+        s.remaining = len(s.shards)
+        print("Sample {0}: {1} chunk(s)".format(s.name, len(s.shards)))
+        for o, (start_offset, end_offset) in zip(s.get_chunk_prefixes(), s.shards):
+            if s.error is not None:
+                break
+            yield Task(s, 'shard', sa.process_alignment_bam,
+                       (s.bam_filename, annotations[s.annotation_txt], o, start_offset, end_offset),
+                       {'nonmatch_hist': options['nonmatch_hist'],
+                        'event_table': options['event_table'],
+                        'gzip_nonmatch': len(s.shards) > 1,
+                        'split_categories': True,
+                        'sort_mem': options['sort_mem'],
+                        'table_format': options['table_format'],
+                        'io_threads': 1,
+                        'flipflop': options['flipflop'],
+                        'report_aggregates': options['report_aggregates']})
+
+
+def get_tail_tasks(s, annotations, options):
+    """
+    :return: tasks to run once all the shards of sample <s> are done
+    """
+    tasks = [Task(s, 'finish', finish_sample, (s.output_prefix, len(s.shards), annotations[s.annotation_txt], options))]
+    for c in sa.SUBSET_CATEGORIES:
+        tasks.append(Task(s, 'sort', sa.sort_and_index_category_bam,
+                          (s.output_prefix, c, s.get_chunk_prefixes(), 1, options['sort_mem'])))
+    return tasks
+
+
+def run_batch(samples, cpus, chunks_per_sample, options, max_diff_w_ref=sa.MAX_DIFF_W_REF, flipflop_fasta=None, itr_options=None):
+    """
+    Run all samples on one pool of <cpus> processes. At most <cpus> tasks are queued at any time,
+    and the tail tasks of finished samples go before the remaining shards.
+    Once a sample fails, its remaining tasks are dropped, and its outputs are deleted when its tasks in the pool are done.
+
+    :param itr_options: arguments of get_flipflop_config.set_call_options(), None for the defaults
+    """
+    annotations = {} # annotation file --> parsed annotation, shared between the samples
+    for s in samples:
+        if s.annotation_txt not in annotations:
+            annotations[s.annotation_txt] = sa.read_annotation_file(s.annotation_txt)
+
+    done = queue.Queue() # (task, result, error) put by the pool callbacks
+    shard_tasks = iter_shard_tasks(samples, annotations, chunks_per_sample, options)
+    tail_tasks = deque()
+    in_flight = 0
+    with Pool(cpus, initializer=init_worker, initargs=(max_diff_w_ref, flipflop_fasta, itr_options)) as pool:
+        while True:
+            while in_flight < cpus:
+                if len(tail_tasks) > 0:
+                    task = tail_tasks.popleft()
+                else:
+                    task = next(shard_tasks, None)
+                    if task is None: break
+                if task.sample.error is not None:
+                    continue
+                pool.apply_async(task.func, task.args, task.kwargs,
+                                 callback=lambda result, task=task: done.put((task, result, None)),
+                                 error_callback=lambda error, task=task: done.put((task, None, error)))
+                in_flight += 1
+                task.sample.in_flight += 1
+            if in_flight == 0:
+                break
+            task, result, error = done.get()
+            in_flight -= 1
+            s = task.sample
+            s.in_flight -= 1
+            if error is not None and s.error is None:
+                print("ERROR: sample {0} failed: {1}".format(s.name, error), file=sys.stderr)
+                s.error = error
+            if s.error is not None:
+                if s.in_flight == 0:
+                    s.remove_outputs(options)
+            elif task.kind == 'shard':
+                s.remaining -= 1
+                if s.remaining == 0 and s.error is None:
+                    tail_tasks.extend(get_tail_tasks(s, annotations, options))
+            elif task.kind == 'finish':
+                s.type_counts = result
+                print("Sample {0}: done".format(s.name))
+
+
+def write_type_counts(samples, filename):
+    with open(filename, 'w') as f:
+        writer = DictWriter(f, TYPE_COUNT_FIELDS, delimiter='\t')
+        writer.writeheader()
+        for s in samples:
+            if s.type_counts is None:
+                continue
+            for (a_type, a_subtype), (count, e_count) in sorted(s.type_counts.items()):
+                writer.writerow({'sample': s.name, 'assigned_type': a_type, 'assigned_subtype': a_subtype,
+                                 'count': count, 'effective_count': e_count})
+
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("sample_sheet", help="Tab-delimited sample sheet with columns bam, output_prefix and optionally annotation, sample")
+    parser.add_argument("combined_prefix", help="Output prefix of the combined per-sample type count table (<combined_prefix>.type_counts.csv)")
+    parser.add_argument("--annotation", default=None, help="Annotation file for the samples without one in the sample sheet")
+    parser.add_argument("--cpus", type=int, default=1, help="Number of processes shared by all samples (default: 1)")
+    parser.add_argument("--chunks_per_sample", type=int, default=None, help="Number of chunks each sample is split into (default: --cpus)")
+    parser.add_argument("--max_allowed_missing_flanking", default=100, type=int, help="Maximum allowed missing flanking bp to be still considered 'full' (default:100)")
+    parser.add_argument("--nonmatch_hist", action="store_true", default=False, help="Also output pre-aggregated nonmatch counts by reference position bin and length category (.nonmatch_hist.csv, for downstream analysis, plotAAVreport.R reads .report_aggregates.json)")
+    parser.add_argument("--no_event_table", "--no-event-table", dest="no_event_table", action="store_true", default=False, help="Do not output the per-event .nonmatch_stat.csv table, implies --nonmatch_hist and --report_aggregates (which plotAAVreport.R then reads instead)")
+    parser.add_argument("--report_aggregates", action="store_true", default=False, help="Also output the counts and histograms plotAAVreport.R needs (.report_aggregates.json)")
+    parser.add_argument("--table_format", choices=sa.TABLE_FORMATS, default='tsv', help="Format of the summary, per_read and nonmatch_stat tables: tsv (.csv, default) or parquet (.parquet, requires pyarrow)")
+    parser.add_argument("--sort_mem", default=sa.SORT_MEM, help="Maximum memory for sorting each category BAM, K/M/G suffix allowed (default: {0})".format(sa.SORT_MEM))
+    parser.add_argument("--flipflop", action="store_true", default=False, help="Also call ITR flip/flop configurations in the same pass (same outputs as get_flipflop_config.py)")
+    parser.add_argument("--flipflop_fasta", default=None, help="(optional) flip flop fasta file for --flipflop (if not given, uses AAV2 default)")
+    parser.add_argument("--left_window_pad", type=int, default=None, help="For --flipflop, search the left ITR within the first len(ITR)+N bases of each read, negative to search the whole read (default: 200, as get_flipflop_config.py)")
+    parser.add_argument("--right_window_pad", type=int, default=None, help="For --flipflop, search the right ITR within the last len(ITR)+N bases of each read, negative to search the whole read (default: 10, as get_flipflop_config.py)")
+    parser.add_argument("--itr_cache_size", type=int, default=None, help="For --flipflop, max number of read-end ITR calls to cache per CPU, 0 to disable (default: 100000, get_flipflop_config.py --cache_size)")
+    parser.add_argument("--no_kmer_prescreen", action="store_true", default=False, help="For --flipflop, always align the ITRs (get_flipflop_config.py --no_kmer_prescreen)")
+
+    args = parser.parse_args()
+    if args.flipflop_fasta is not None and not args.flipflop:
+        raise Exception("--flipflop_fasta is only used with --flipflop. Abort!")
+    itr_options = sa.get_itr_call_options(args)
+    if itr_options is not None and not args.flipflop:
+        raise Exception("--left_window_pad, --right_window_pad, --itr_cache_size and --no_kmer_prescreen are only used with --flipflop. Abort!")
+
+    if args.no_event_table: # plotAAVreport.R needs either the event table or the aggregates
+        args.report_aggregates = True
+
+    samples = read_sample_sheet(args.sample_sheet, args.annotation)
+    options = {'nonmatch_hist': args.nonmatch_hist or args.no_event_table,
+               'event_table': not args.no_event_table,
+               'table_format': args.table_format,
+               'sort_mem': args.sort_mem,
+               'flipflop': args.flipflop,
+               'report_aggregates': args.report_aggregates}
+    run_batch(samples, args.cpus, args.cpus if args.chunks_per_sample is None else args.chunks_per_sample, options,
+              args.max_allowed_missing_flanking, args.flipflop_fasta, itr_options)
+
+    write_type_counts(samples, args.combined_prefix + '.type_counts.csv')
+    print("Combined type counts: {0}".format(args.combined_prefix + '.type_counts.csv'))
+    failed = [s.name for s in samples if s.error is not None]
+    if len(failed) > 0:
+        raise Exception("{0} sample(s) failed: {1}. Abort!".format(len(failed), ', '.join(failed)))
@@ -0,0 +1,18 @@
+import os, sys
+import pytest
+
+# the scripts are flat modules at the repository root, the synthetic data generator is in benchmarks/
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, 'benchmarks'))
+
+
+@pytest.fixture(scope='session')
+def synthetic_data(tmp_path_factory):
+    """
+    :return: read name-sorted synthetic BAM, annotation file (see benchmarks/generate_synthetic.py)
+    """
+    from generate_synthetic import generate
+    bam_filename, annotation_filename, _ = generate(str(tmp_path_factory.mktemp('synthetic') / 'synthetic'), num_reads=300,
+                                                    error_rate=0.02, seed=7)
+    return bam_filename, annotation_filename
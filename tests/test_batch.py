@@ -0,0 +1,51 @@
+import os
+import pysam
+import pytest
+import summarize_AAV_alignment as sa
+import summarize_AAV_batch as batch
+
+"""
+summarize_AAV_batch.py: input checks before any work is queued, and clean-up of failed samples
+"""
+
+OPTIONS = {'nonmatch_hist': False, 'event_table': True, 'table_format': 'tsv', 'sort_mem': sa.SORT_MEM,
+           'flipflop': False, 'report_aggregates': False}
+
+
+def write_sample_sheet(filename, rows):
+    with open(filename, 'w') as f:
+        f.write("bam\toutput_prefix\n")
+        for bam_filename, output_prefix in rows:
+            f.write("{0}\t{1}\n".format(bam_filename, output_prefix))
+
+
+def test_coordinate_sorted_sample_is_rejected(synthetic_data, tmp_path):
+    bam_filename, annotation_filename = synthetic_data
+    sorted_bam = str(tmp_path / 'coord.bam')
+    pysam.sort('-o', sorted_bam, bam_filename)
+    write_sample_sheet(str(tmp_path / 'sheet.tsv'), [(bam_filename, str(tmp_path / 'a')), (sorted_bam, str(tmp_path / 'b'))])
+    with pytest.raises(Exception, match='coordinate-sorted'):
+        batch.read_sample_sheet(str(tmp_path / 'sheet.tsv'), annotation_filename)
+
+
+def failing_process_alignment_bam(sorted_sam_filename, annotation, output_prefix, *args, **kwargs):
+    result = sa_process_alignment_bam(sorted_sam_filename, annotation, output_prefix, *args, **kwargs)
+    if os.path.basename(output_prefix) == 'bad.2':
+        raise Exception("shard failed after writing its outputs")
+    return result
+
+sa_process_alignment_bam = sa.process_alignment_bam
+
+
+def test_failed_sample_outputs_are_removed(synthetic_data, tmp_path, monkeypatch):
+    bam_filename, annotation_filename = synthetic_data
+    write_sample_sheet(str(tmp_path / 'sheet.tsv'), [(bam_filename, str(tmp_path / 'bad')), (bam_filename, str(tmp_path / 'good'))])
+    samples = batch.read_sample_sheet(str(tmp_path / 'sheet.tsv'), annotation_filename)
+    # the pool workers are forked, so they run the patched function
+    monkeypatch.setattr(sa, 'process_alignment_bam', failing_process_alignment_bam)
+    batch.run_batch(samples, 2, 3, OPTIONS)
+
+    assert samples[0].error is not None and samples[1].error is None
+    assert [f for f in os.listdir(str(tmp_path)) if f.startswith('bad')] == []
+    for f in sa.get_output_files(str(tmp_path / 'good'), gzip_nonmatch=True):
+        assert os.path.exists(f)
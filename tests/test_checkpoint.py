@@ -0,0 +1,55 @@
+import os
+import pytest
+import summarize_AAV_alignment as sa
+
+"""
+--cpus runs (run_processing_parallel): only the chunk outputs are removed or checksummed, and --resume reuses the
+completed chunks of an interrupted run
+"""
+
+
+def test_unrelated_files_survive(synthetic_data, tmp_path):
+    bam_filename, annotation_filename = synthetic_data
+    output_prefix = str(tmp_path / 'out')
+    unrelated = [output_prefix + '.1.foo', output_prefix + '.2.notes.txt', output_prefix + '.1.input.bam']
+    for f in unrelated:
+        with open(f, 'w') as h:
+            h.write('not an output\n')
+    # stale output of an interrupted run
+    with open(output_prefix + '.1.scAAV-full.tagged.bam', 'w') as h:
+        h.write('stale\n')
+
+    sa.run_processing_parallel(bam_filename, sa.read_annotation_file(annotation_filename), output_prefix, 2, split_categories=True)
+    for f in unrelated:
+        assert open(f).read() == 'not an output\n'
+    assert not os.path.exists(output_prefix + '.1.scAAV-full.tagged.bam')
+    for f in sa.get_output_files(output_prefix, gzip_nonmatch=True):
+        assert os.path.exists(f)
+
+
+def failing_process_alignment_bam(sorted_sam_filename, annotation, output_prefix, *args, **kwargs):
+    if output_prefix.endswith('.2'):
+        raise Exception("chunk failed")
+    return sa_process_alignment_bam(sorted_sam_filename, annotation, output_prefix, *args, **kwargs)
+
+sa_process_alignment_bam = sa.process_alignment_bam
+
+
+def test_resume(synthetic_data, tmp_path, monkeypatch, capsys):
+    bam_filename, annotation_filename = synthetic_data
+    d = sa.read_annotation_file(annotation_filename)
+    sa.run_processing_parallel(bam_filename, d, str(tmp_path / 'full'), 2, split_categories=True)
+
+    output_prefix = str(tmp_path / 'out')
+    with monkeypatch.context() as m:
+        # the chunk processes are forked, so they run the patched function
+        m.setattr(sa, 'process_alignment_bam', failing_process_alignment_bam)
+        with pytest.raises(Exception, match='Chunk 2 failed'):
+            sa.run_processing_parallel(bam_filename, d, output_prefix, 2, split_categories=True)
+    with open(output_prefix + '.1.foo', 'w') as h: # not a chunk output, does not invalidate the checkpoint
+        h.write('not an output\n')
+    capsys.readouterr()
+    sa.run_processing_parallel(bam_filename, d, output_prefix, 2, split_categories=True, resume=True)
+    assert 'Reusing chunk 1' in capsys.readouterr().out
+    for name in ('.per_read.csv', '.summary.csv'):
+        assert open(output_prefix + name).read() == open(str(tmp_path / 'full') + name).read()
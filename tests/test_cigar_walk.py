@@ -0,0 +1,104 @@
+import pysam
+import pytest
+import summarize_AAV_alignment as sa
+
+"""
+Equivalence of the per-operation CIGAR walk (iter_cigar_w_aligned_pair) with the original per-base walk over
+rec.get_aligned_pairs(), for the nonmatch rows and map_iden
+"""
+
+HEADER = pysam.AlignmentHeader.from_dict({'HD': {'VN': '1.6'}, 'SQ': [{'SN': 'myVector', 'LN': 10000}]})
+
+
+class RowCollector:
+    def __init__(self):
+        self.rows = []
+
+    def writerow(self, row):
+        self.rows.append(dict(row))
+
+
+def iter_cigar_w_aligned_pair_per_base(rec, writer):
+    """
+    The per-base walk of summarize_AAV_alignment.py before 2.1.0
+    """
+    ii = sa.iter_cigar(rec)
+    prev_cigar_type = None
+    prev_r_pos = 0
+    total_err = 0
+    total_len = 0
+    for q_pos, r_pos in rec.get_aligned_pairs():
+        cigar_type, cigar_count = next(ii)
+        if cigar_type == 'S':
+            assert r_pos is None
+            continue
+        total_len += cigar_count
+        if cigar_type != prev_cigar_type:
+            if cigar_type in ('I', 'D', 'X', 'N'):
+                total_err += cigar_count
+                info = {'read_id': rec.qname,
+                        'pos0': r_pos if cigar_type!='I' else prev_r_pos,
+                        'type': cigar_type,
+                        'type_len': cigar_count}
+                writer.writerow(info)
+            prev_cigar_type = cigar_type
+        if r_pos is not None: prev_r_pos = r_pos
+    return total_err, total_len
+
+
+def make_record(cigar, start=1000):
+    r = pysam.AlignedSegment(HEADER)
+    r.query_name = 'm64011_000000_000000/1/ccs'
+    r.reference_id = 0
+    r.reference_start = start
+    r.mapping_quality = 60
+    r.cigarstring = cigar
+    query_len = sum(n for op, n in r.cigartuples if op in (0, 1, 4, 7, 8))
+    r.query_sequence = ('ACGT' * (query_len // 4 + 1))[:query_len]
+    return r
+
+
+CIGARS = ['100=',
+          '10S50=2X30=5S',                  # soft clips
+          '200H10S50=1D40=3I20=7S300H',     # hard + soft clips
+          '10S3I50=2D40=',                  # insertion right after a soft clip
+          '5H4I60=',                        # insertion right after a hard clip
+          '30=500N40=1X20=',                # N (spliced) operation
+          '20=3D2D15=',                     # adjacent deletions
+          '20=2I4I15=',                     # adjacent insertions
+          '20=1X1X1X15=',                   # adjacent mismatches
+          '20=10N5N30=',                    # adjacent N operations
+          '10M1I10M2D10M',                  # M operations
+          '15=1X1I1D1X15=1I']               # alternating nonmatches, ending with an insertion
+
+
+@pytest.mark.parametrize('cigar', CIGARS)
+def test_per_operation_walk_matches_per_base_walk(cigar):
+    r = make_record(cigar)
+    expected_writer, writer = RowCollector(), RowCollector()
+    expected_err, expected_len = iter_cigar_w_aligned_pair_per_base(r, expected_writer)
+    total_err, total_len = sa.iter_cigar_w_aligned_pair(r, writer)
+    assert writer.rows == expected_writer.rows
+    assert (total_err, total_len) == (expected_err, expected_len)
+    # map_iden as computed by process_alignment_records_for_a_read
+    assert 1 - total_err*1./total_len == 1 - expected_err*1./expected_len
+
+
+@pytest.mark.parametrize('cigar', CIGARS)
+def test_events_match_nonmatch_rows(cigar):
+    r = make_record(cigar)
+    writer, events = RowCollector(), []
+    sa.iter_cigar_w_aligned_pair(r, writer, events=events)
+    assert events == [(row['pos0'], row['type'], row['type_len']) for row in writer.rows]
+
+
+def test_synthetic_reads(synthetic_data):
+    bam_filename, _ = synthetic_data
+    num_records = 0
+    for r in pysam.AlignmentFile(bam_filename, check_sq=False):
+        if r.is_unmapped: continue
+        expected_writer, writer = RowCollector(), RowCollector()
+        assert sa.iter_cigar_w_aligned_pair(r, writer) == iter_cigar_w_aligned_pair_per_base(r, expected_writer)
+        assert writer.rows == expected_writer.rows
+        num_records += 1
+    assert num_records > 0
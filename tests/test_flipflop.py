@@ -0,0 +1,50 @@
+import random
+import pytest
+import get_flipflop_config as ff
+
+"""
+The k-mer pre-screen of get_flipflop_config.py only calls read ends the same way as alignment would
+"""
+
+
+def mutate(rnd, seq, error_rate):
+    out = []
+    for c in seq:
+        x = rnd.random()
+        if x < error_rate / 3: out.append(rnd.choice('ACGT'))
+        elif x < error_rate * 2 / 3: pass
+        elif x < error_rate: out.append(c + rnd.choice('ACGT'))
+        else: out.append(c)
+    return ''.join(out)
+
+
+def call_by_alignment(seq_flip, seq_flop, window_flip, window_flop):
+    s1 = ff.get_itr_score(seq_flip, window_flip)
+    s2 = ff.get_itr_score(seq_flop, window_flop)
+    if s1 > s2 and s1 > ff.ITR_MIN_SCORE: return 'flip'
+    if s2 > s1 and s2 > ff.ITR_MIN_SCORE: return 'flop'
+    return 'unknown'
+
+
+@pytest.mark.parametrize('error_rate', [0., 0.01, 0.02, 0.05])
+def test_kmer_prescreen_matches_alignment(error_rate):
+    rnd = random.Random(11)
+    index = ff.get_itr_kmer_index(ff.SEQ_LEFT_FLIP, ff.SEQ_LEFT_FLOP)
+    num_called = 0
+    for _ in range(300):
+        itr = rnd.choice([ff.SEQ_LEFT_FLIP, ff.SEQ_LEFT_FLOP])
+        if rnd.random() < 0.3: # partial ITR
+            itr = itr[rnd.randint(1, 60):]
+        query = ''.join(rnd.choice('ACGT') for _ in range(rnd.randint(0, 50))) + mutate(rnd, itr, error_rate) + \
+                ''.join(rnd.choice('ACGT') for _ in range(300))
+        window_flip = ff.get_left_window(query, ff.SEQ_LEFT_FLIP)
+        window_flop = ff.get_left_window(query, ff.SEQ_LEFT_FLOP)
+        for seq, window, tiles in ((ff.SEQ_LEFT_FLIP, window_flip, index.tiles_flip),
+                                   (ff.SEQ_LEFT_FLOP, window_flop, index.tiles_flop)):
+            assert ff.get_anchored_score(seq, window, tiles) <= ff.get_itr_score(seq, window)
+        config = index.call(window_flip, window_flop)
+        if config is not None:
+            assert config == call_by_alignment(ff.SEQ_LEFT_FLIP, ff.SEQ_LEFT_FLOP, window_flip, window_flop)
+            num_called += 1
+    if error_rate == 0.:
+        assert num_called > 0
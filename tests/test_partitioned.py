@@ -0,0 +1,58 @@
+import os
+import pysam
+import pytest
+import summarize_AAV_alignment as sa
+
+"""
+Coordinate-sorted input (run_processing_partitioned): --max_reads, and no partition files are left behind
+"""
+
+
+@pytest.fixture(scope='module')
+def coordinate_sorted_data(synthetic_data, tmp_path_factory):
+    bam_filename, annotation_filename = synthetic_data
+    sorted_bam = str(tmp_path_factory.mktemp('coordinate') / 'coord.bam')
+    pysam.sort('-o', sorted_bam, bam_filename)
+    return sorted_bam, annotation_filename
+
+
+def get_partition_files(directory):
+    return [f for f in os.listdir(directory) if '.partition.' in f]
+
+
+def failing_process_alignment_bam(*args, **kwargs):
+    raise Exception("chunk failed")
+
+
+def test_partitions_removed_after_failed_chunk(coordinate_sorted_data, tmp_path, monkeypatch):
+    sorted_bam, annotation_filename = coordinate_sorted_data
+    # the chunk processes are forked, so they run the patched function
+    monkeypatch.setattr(sa, 'process_alignment_bam', failing_process_alignment_bam)
+    with pytest.raises(Exception, match='failed'):
+        sa.run_processing_partitioned(sorted_bam, sa.read_annotation_file(annotation_filename), str(tmp_path / 'out'), num_chunks=2)
+    assert get_partition_files(str(tmp_path)) == []
+
+
+@pytest.mark.parametrize('num_chunks', [1, 2])
+def test_max_reads(coordinate_sorted_data, tmp_path, num_chunks):
+    sorted_bam, annotation_filename = coordinate_sorted_data
+    output_prefix = str(tmp_path / 'out')
+    sa.run_processing_partitioned(sorted_bam, sa.read_annotation_file(annotation_filename), output_prefix,
+                                  num_chunks=num_chunks, max_reads=50)
+    read_ids = [r['read_id'] for r in sa.iter_table_rows(output_prefix + '.per_read.csv')]
+    assert len(read_ids) == len(set(read_ids)) == 50
+    # all the alignments of the kept reads are processed
+    num_records = sum(1 for r in pysam.AlignmentFile(sorted_bam, check_sq=False) if r.qname in set(read_ids))
+    assert sum(1 for r in pysam.AlignmentFile(output_prefix + '.tagged.bam', check_sq=False)) == num_records
+    assert get_partition_files(str(tmp_path)) == []
+
+
+def test_num_partitions_share_sort_mem(coordinate_sorted_data):
+    sorted_bam, _ = coordinate_sorted_data
+    size = os.path.getsize(sorted_bam)
+    # each of the chunks groups its partition within its share of the budget
+    partition_mem = size * sa.GROUP_MEM_FACTOR // 8 + 1
+    num_partitions = sa.get_num_partitions(sorted_bam, partition_mem, 2)
+    assert num_partitions == 8
+    assert size * sa.GROUP_MEM_FACTOR / num_partitions <= partition_mem
+    assert sa.get_num_partitions(sorted_bam, size * sa.GROUP_MEM_FACTOR, 2) == 2
@@ -0,0 +1,92 @@
+import json
+import pytest
+from collections import Counter
+import summarize_AAV_alignment as sa
+
+"""
+The .report_aggregates.json (--report_aggregates) has the same counts and histograms as plotAAVreport.R computes
+from the full summary, per_read and nonmatch_stat tables, for single-CPU and merged --cpus runs
+"""
+
+
+def bin_value(x):
+    return x // sa.REPORT_BIN_SIZE * sa.REPORT_BIN_SIZE
+
+
+def get_expected_aggregates(output_prefix, nonmatch_suffix):
+    """
+    :return: dict of aggregate name --> Counter, computed from the full tables the way plotAAVreport.R does
+    """
+    reads = list(sa.iter_table_rows(output_prefix + '.per_read.csv'))
+    summary = list(sa.iter_table_rows(output_prefix + '.summary.csv'))
+    events = list(sa.iter_table_rows(output_prefix + '.nonmatch_stat' + nonmatch_suffix))
+    read_types = {r['read_id']: r['assigned_type'] for r in reads}
+    vector_reads = set(k for k, v in read_types.items() if v in sa.REPORT_VECTOR_TYPES)
+
+    expected = {name: Counter() for name in ('read_types', 'read_len', 'alignments', 'nonmatch_pos', 'nonmatch_len', 'max_gap')}
+    for r in reads:
+        expected['read_types'][(r['assigned_type'], r['assigned_subtype'], 'count')] += 1
+        expected['read_types'][(r['assigned_type'], r['assigned_subtype'], 'effective_count')] += int(r['effective_count'])
+        if r['read_id'] in vector_reads:
+            len_bin = bin_value(int(r['read_len']))
+            expected['read_len'][(r['assigned_type'], r['assigned_subtype'], len_bin, 'count')] += 1
+            expected['read_len'][(r['assigned_type'], r['assigned_subtype'], len_bin, 'effective_count')] += int(r['effective_count'])
+    for r in summary:
+        group = sa.REPORT_ALIGNMENT_GROUPS.get(read_types[r['read_id']])
+        if group is None:
+            continue
+        expected['alignments'][(group, 'map_iden', r['map_subtype'], round(float(r['map_iden']), sa.REPORT_IDEN_DIGITS))] += 1
+        for metric in ('map_len', 'map_start0', 'map_end1'):
+            expected['alignments'][(group, metric, r['map_subtype'], bin_value(int(r[metric])))] += 1
+    max_gap = {}
+    for r in events:
+        if r['read_id'] not in vector_reads:
+            continue
+        pos0, type_len = int(r['pos0']), int(r['type_len'])
+        expected['nonmatch_pos'][(r['type'], pos0 // 10 * 10)] += 1 # pos0_div in plotAAVreport.R
+        expected['nonmatch_len'][(r['type'], '1-10' if type_len <= 10 else '11-100' if type_len <= 100 else
+                                  '100-500' if type_len <= 500 else '>500')] += 1
+        if r['type'] == 'N':
+            max_gap[r['read_id']] = max(max_gap.get(r['read_id'], 0), type_len)
+    expected['max_gap'] = Counter(bin_value(x) for x in max_gap.values())
+    return expected, sum(expected['nonmatch_len'].values())
+
+
+def read_aggregates(filename):
+    with open(filename) as f:
+        d = json.load(f)
+    def rows(name):
+        return zip(*[d[name][c] for c in d[name]])
+    found = {name: Counter() for name in ('read_types', 'read_len', 'alignments', 'nonmatch_pos', 'nonmatch_len', 'max_gap')}
+    for a_type, a_subtype, count, e_count in rows('read_types'):
+        found['read_types'][(a_type, a_subtype, 'count')] += count
+        found['read_types'][(a_type, a_subtype, 'effective_count')] += e_count
+    for a_type, a_subtype, len_bin, count, e_count in rows('read_len'):
+        found['read_len'][(a_type, a_subtype, len_bin, 'count')] += count
+        found['read_len'][(a_type, a_subtype, len_bin, 'effective_count')] += e_count
+    for group, metric, map_subtype, value, count in rows('alignments'):
+        found['alignments'][(group, metric, map_subtype, value)] += count
+    for name in ('nonmatch_pos', 'nonmatch_len'):
+        for _type, value, count in rows(name):
+            found[name][(_type, value)] += count
+    for max_gap, count in rows('max_gap'):
+        found['max_gap'][max_gap] += count
+    return found, len(d['nonmatch_sample']['key'])
+
+
+@pytest.mark.parametrize('num_chunks', [1, 2])
+def test_report_aggregates_match_full_tables(synthetic_data, tmp_path, num_chunks):
+    bam_filename, annotation_filename = synthetic_data
+    output_prefix = str(tmp_path / 'out')
+    d = sa.read_annotation_file(annotation_filename)
+    if num_chunks == 1:
+        sa.process_alignment_bam(bam_filename, d, output_prefix, report_aggregates=True)
+    else:
+        sa.run_processing_parallel(bam_filename, d, output_prefix, num_chunks, report_aggregates=True)
+
+    expected, total_err = get_expected_aggregates(output_prefix, '.csv' if num_chunks == 1 else '.csv.gz')
+    found, sample_size = read_aggregates(output_prefix + '.report_aggregates.json')
+    assert total_err > 0
+    for name in expected:
+        assert {k: v for k, v in found[name].items() if v != 0} == {k: v for k, v in expected[name].items() if v != 0}, name
+    assert sample_size == min(total_err, sa.REPORT_SAMPLE_SIZE)
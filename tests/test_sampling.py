@@ -0,0 +1,23 @@
+import summarize_AAV_alignment as sa
+
+"""
+Category fractions of subsampled runs (--random_frac, --max_reads)
+"""
+
+
+def test_category_fractions(synthetic_data, tmp_path):
+    bam_filename, annotation_filename = synthetic_data
+    output_prefix = str(tmp_path / 'out')
+    sa.process_alignment_bam(bam_filename, sa.read_annotation_file(annotation_filename), output_prefix, max_reads=100)
+
+    # --max_reads alone: the first reads of the input are not a random sample, no confidence intervals
+    fractions = sa.write_category_fractions(output_prefix, random_sample=False)
+    assert sum(x[0] for x in fractions.values()) == 100
+    assert all(x[2] == x[3] == 'NA' for x in fractions.values())
+    rows = list(sa.iter_table_rows(output_prefix + '.category_fractions.csv'))
+    assert [r['category'] for r in rows] == sa.SUBSET_CATEGORIES
+    assert all(r['total_reads'] == '100' and r['ci_low'] == 'NA' for r in rows)
+
+    fractions = sa.write_category_fractions(output_prefix, random_sample=True)
+    for num_reads, fraction, ci_low, ci_high in fractions.values():
+        assert ci_low <= fraction <= ci_high
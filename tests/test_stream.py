@@ -0,0 +1,45 @@
+import os, sys
+import subprocess
+import pysam
+import pytest
+from collections import Counter
+from conftest import REPO_DIR
+import summarize_AAV_alignment as sa
+
+"""
+SAM piped to summarize_AAV_alignment.py - gives the same per_read and summary rows as the file
+(as multisets, with --cpus the merged tables are in batch order)
+"""
+
+
+@pytest.fixture(scope='module')
+def stream_data(tmp_path_factory):
+    """
+    :return: synthetic BAM with enough reads for several STREAM_BATCH_SIZE batches, its SAM copy, annotation file
+    """
+    from generate_synthetic import generate
+    prefix = str(tmp_path_factory.mktemp('stream') / 'synthetic')
+    bam_filename, annotation_filename, _ = generate(prefix, num_reads=int(2.5 * sa.STREAM_BATCH_SIZE), error_rate=0.02, seed=3)
+    pysam.view('-h', '-o', prefix + '.sam', bam_filename, catch_stdout=False)
+    return bam_filename, prefix + '.sam', annotation_filename
+
+
+def get_rows(filename):
+    return Counter(tuple(sorted(r.items())) for r in sa.iter_table_rows(filename))
+
+
+@pytest.mark.parametrize('cpus', [1, 3])
+def test_stdin_matches_file(stream_data, tmp_path, cpus):
+    bam_filename, sam_filename, annotation_filename = stream_data
+    script = os.path.join(REPO_DIR, 'summarize_AAV_alignment.py')
+
+    subprocess.run([sys.executable, script, bam_filename, annotation_filename, str(tmp_path / 'file')],
+                   check=True, stdout=subprocess.DEVNULL)
+    with open(sam_filename) as f:
+        subprocess.run([sys.executable, script, '-', annotation_filename, str(tmp_path / 'stdin'), '--cpus', str(cpus)],
+                       stdin=f, check=True, stdout=subprocess.DEVNULL)
+
+    for name in ('per_read', 'summary'):
+        file_rows = get_rows(str(tmp_path / ('file.' + name + '.csv')))
+        assert len(file_rows) > 0
+        assert get_rows(str(tmp_path / ('stdin.' + name + '.csv'))) == file_rows
@@ -0,0 +1,28 @@
+import pytest
+import summarize_AAV_alignment as sa
+
+"""
+The Parquet tables (--table_format parquet) hold the same rows as the TSV tables, with 'NA' stored as nulls
+"""
+
+
+def test_parquet_matches_tsv(synthetic_data, tmp_path):
+    pytest.importorskip('pyarrow')
+    import pyarrow.parquet as pq
+    bam_filename, annotation_filename = synthetic_data
+    annotation = sa.read_annotation_file(annotation_filename)
+    sa.process_alignment_bam(bam_filename, annotation, str(tmp_path / 'tsv'))
+    sa.process_alignment_bam(bam_filename, annotation, str(tmp_path / 'parquet'), table_format='parquet')
+
+    for name in ('summary', 'per_read', 'nonmatch_stat'):
+        tsv_rows = list(sa.iter_table_rows(str(tmp_path / ('tsv.' + name + '.csv'))))
+        parquet_rows = [{k: str(v) for k, v in r.items()}
+                        for r in sa.iter_table_rows(str(tmp_path / ('parquet.' + name + '.parquet')))]
+        assert parquet_rows == tsv_rows
+
+        table = pq.read_table(str(tmp_path / ('parquet.' + name + '.parquet')))
+        for column in table.column_names:
+            if sa.TABLE_COLUMN_TYPES[column] != 'str':
+                num_na = sum(r[column] == 'NA' for r in tsv_rows)
+                assert table.column(column).null_count == num_na
+                assert 'NA' not in table.column(column).to_pylist()
@@ -0,0 +1,25 @@
+import pysam
+import summarize_AAV_alignment as sa
+
+"""
+The tagged output keeps the tags of the aligner (minimap2 AS:i alignment score, NM:i, tp:A)
+"""
+
+
+def test_tagged_bam_keeps_aligner_tags(synthetic_data, tmp_path):
+    bam_filename, annotation_filename = synthetic_data
+    output_prefix = str(tmp_path / 'out')
+    sa.process_alignment_bam(bam_filename, sa.read_annotation_file(annotation_filename), output_prefix)
+
+    aligner_tags = {}
+    for r in pysam.AlignmentFile(bam_filename, check_sq=False):
+        if not r.is_unmapped:
+            aligner_tags[(r.query_name, r.flag)] = (r.get_tag('AS'), r.get_tag('NM'), r.get_tag('tp'))
+    num_tagged = 0
+    for r in pysam.AlignmentFile(output_prefix + '.tagged.bam', check_sq=False):
+        if r.is_unmapped:
+            continue
+        assert (r.get_tag('AS'), r.get_tag('NM'), r.get_tag('tp')) == aligner_tags[(r.query_name, r.flag)]
+        assert r.get_tag('AX') == r.get_tag('AT') + '-' + r.get_tag('AY')
+        num_tagged += 1
+    assert num_tagged > 0